@@ -0,0 +1,59 @@
+# Shared state for the desktop fakes of the Inky Frame's MicroPython modules.
+#
+# The fakes record every call worth counting here, and charge a simulated
+# device clock for it, so paperthin-emulator.py can report what a wake cycle
+# would have cost on the real hardware. Nothing here sleeps for real.
+
+import collections
+import threading
+import typing
+
+# Per-call device costs in microseconds; paperthin-emulator.py fills these in
+# from picorle.DEVICE_COSTS_US plus its network model.
+costs: typing.Dict[str, float] = collections.defaultdict(float)
+# How many times each fake was called, e.g. 'set_pen', 'read', 'read_bytes'.
+calls: typing.Counter[str] = collections.Counter()
+# Simulated device time, in microseconds, split by phase. Anything charged from
+# a thread other than the main one lands in 'core1', since it would overlap.
+clock_us: typing.Dict[str, float] = collections.defaultdict(float)
+phase = 'startup'
+# Headers of the last HTTP response, and the last PicoGraphics created.
+response_headers: typing.Dict[str, str] = {}
+display = None
+
+class WakeCycleOver(BaseException):
+    """Raised by the fakes when the device would sleep, reset or power off.
+
+    A BaseException so that paperthin.py's own broad handlers don't eat it."""
+
+def reset() -> None:
+    global phase
+    calls.clear()
+    clock_us.clear()
+    response_headers.clear()
+    phase = 'startup'
+
+def set_phase(name: str) -> None:
+    global phase
+    phase = name
+
+_main_thread = threading.get_ident()
+
+def charge(call: str, count: int = 1, extra_us: float = 0.0) -> None:
+    calls[call] += count
+    bucket = phase if threading.get_ident() == _main_thread else 'core1'
+    clock_us[bucket] += (costs[call] * count) + extra_us
+
+def total_seconds() -> float:
+    """Device time for the cycle, with core1 overlapping decoding."""
+    serial = sum(micros for bucket, micros in clock_us.items()
+                 if bucket != 'core1')
+    overlap = max(0.0, clock_us.get('core1', 0.0) - clock_us.get('decode', 0.0))
+    return (serial + overlap) / 1000000.0
+
+def ticks_ms() -> int:
+    """MicroPython's time.ticks_ms(), on the simulated device clock."""
+    return int(total_seconds() * 1000)
+
+def ticks_diff(end: int, start: int) -> int:
+    return end - start
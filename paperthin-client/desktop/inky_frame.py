@@ -0,0 +1,75 @@
+# Desktop fake of Pimoroni's inky_frame module.
+#
+# Sleeping, powering off and resetting all end the emulated wake cycle by
+# raising emulator.WakeCycleOver.
+
+import emulator
+
+BLACK = 0
+WHITE = 1
+GREEN = 2
+BLUE = 3
+RED = 4
+YELLOW = 5
+ORANGE = 6
+TAUPE = 7
+
+# Set by the harness to simulate how we were woken.
+pressed_button = None  # Index 0-4 of a held button, or None.
+woken_by_timer = False
+
+class LED:
+    def __init__(self):
+        self.level = 0.0
+
+    def on(self):
+        self.level = 1.0
+
+    def off(self):
+        self.level = 0.0
+
+    def brightness(self, level):
+        self.level = level
+
+class Button:
+    def __init__(self, index):
+        self.index = index
+        self.led = LED()
+
+    def raw(self):
+        return pressed_button == self.index
+
+    def read(self):
+        return self.raw()
+
+    def led_on(self):
+        self.led.on()
+
+    def led_off(self):
+        self.led.off()
+
+button_a = Button(0)
+button_b = Button(1)
+button_c = Button(2)
+button_d = Button(3)
+button_e = Button(4)
+led_busy = LED()
+led_wifi = LED()
+
+def woken_by_button():
+    return pressed_button is not None
+
+def woken_by_rtc():
+    return woken_by_timer
+
+def pcf_to_pico_rtc():
+    pass
+
+def set_time():
+    pass
+
+def sleep_for(minutes):
+    raise emulator.WakeCycleOver(f'sleep_for({minutes})')
+
+def turn_off():
+    raise emulator.WakeCycleOver('turn_off()')
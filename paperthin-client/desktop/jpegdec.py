@@ -0,0 +1,22 @@
+# Desktop fake of Pimoroni's jpegdec module, decoding with PIL.
+
+import emulator
+import io
+from PIL import Image
+
+class JPEG:
+    def __init__(self, display):
+        self._display = display
+        self._source = None
+
+    def open_RAM(self, data):
+        self._source = io.BytesIO(bytes(data))
+
+    def open_file(self, filename):
+        with open(filename, 'rb') as source:
+            self._source = io.BytesIO(source.read())
+
+    def decode(self, x=0, y=0, scale=0, dither=True):
+        with Image.open(self._source, formats=['JPEG']) as image:
+            emulator.charge('jpeg_pixel', image.width * image.height)
+            self._display.blit_image(image, x, y)
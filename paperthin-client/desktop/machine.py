@@ -0,0 +1,41 @@
+# Desktop fake of MicroPython's machine module, just enough for PaperThin.
+
+import emulator
+import time
+
+# Battery voltage seen by ADC(29), and whether VBUS (USB power) is present.
+voltage = 4.5
+usb_power = False
+
+class Pin:
+    IN = 0
+    OUT = 1
+
+    def __init__(self, pin, mode=IN):
+        self.pin = pin
+        self._value = 0
+
+    def value(self, value=None):
+        if value is not None:
+            self._value = value
+            return None
+        if self.pin == 'WL_GPIO2':
+            return 1 if usb_power else 0
+        return self._value
+
+class ADC:
+    def __init__(self, pin):
+        self.pin = pin
+
+    def read_u16(self) -> int:
+        # paperthin.py scales this by 3 * 3.3 / 65535.
+        return min(65535, int(voltage * 65535 / (3 * 3.3)))
+
+class RTC:
+    def datetime(self):
+        now = time.localtime()
+        return (now.tm_year, now.tm_mon, now.tm_mday, now.tm_wday,
+                now.tm_hour, now.tm_min, now.tm_sec, 0)
+
+def reset():
+    raise emulator.WakeCycleOver('machine.reset()')
@@ -0,0 +1,10 @@
+# Desktop fake of MicroPython's micropython module.
+
+def native(function):
+    return function
+
+def viper(function):
+    return function
+
+def const(value):
+    return value
@@ -0,0 +1,49 @@
+# Desktop fake of MicroPython's network module; always connects instantly.
+
+STA_IF = 0
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = -3
+STAT_NO_AP_FOUND = -2
+STAT_CONNECT_FAIL = -1
+STAT_GOT_IP = 3
+
+def country(code=None):
+    return code
+
+def hostname(name=None):
+    return name
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self._active = False
+        self._connected = False
+
+    def active(self, active=None):
+        if active is not None:
+            self._active = active
+            if not active:
+                self._connected = False
+        return self._active
+
+    def connect(self, ssid, psk):
+        self._connected = True
+
+    def disconnect(self):
+        self._connected = False
+
+    def deinit(self):
+        self._active = False
+        self._connected = False
+
+    def isconnected(self):
+        return self._connected
+
+    def status(self):
+        return STAT_GOT_IP if self._connected else STAT_IDLE
+
+    def config(self, **kwargs):
+        pass
+
+    def ifconfig(self):
+        return ('127.0.0.1', '255.0.0.0', '127.0.0.1', '127.0.0.1')
@@ -0,0 +1,115 @@
+# Desktop fake of Pimoroni's picographics module, drawing into an RGB
+# framebuffer and counting calls.
+
+import emulator
+
+DISPLAY_INKY_FRAME = 0  # 5.7"
+DISPLAY_INKY_FRAME_4 = 1  # 4.0"
+DISPLAY_INKY_FRAME_7 = 2  # 7.3"
+_SIZES = {
+    DISPLAY_INKY_FRAME: (600, 448),
+    DISPLAY_INKY_FRAME_4: (640, 400),
+    DISPLAY_INKY_FRAME_7: (800, 480),
+}
+# Pens 0-7 are the inks, in inky_frame's order.
+_INKS = [
+    (0x00, 0x00, 0x00), (0xFF, 0xFF, 0xFF), (0x00, 0xFF, 0x00),
+    (0x00, 0x00, 0xFF), (0xFF, 0x00, 0x00), (0xFF, 0xFF, 0x00),
+    (0xFF, 0x80, 0x00), (0xDC, 0xB4, 0xC8),
+]
+# create_pen() pens are packed RGB with this bit set, to keep them distinct.
+_RGB_PEN = 0x1000000
+
+class PicoGraphics:
+    def __init__(self, display=DISPLAY_INKY_FRAME_7):
+        self.width, self.height = _SIZES[display]
+        self.framebuffer = bytearray(self.width * self.height * 3)
+        self.updates = 0
+        self._color = bytes(_INKS[0])
+        emulator.display = self
+
+    def _pen_rgb(self, pen: int) -> bytes:
+        if pen & _RGB_PEN:
+            return bytes(((pen >> 16) & 0xFF, (pen >> 8) & 0xFF, pen & 0xFF))
+        return bytes(_INKS[pen % len(_INKS)])
+
+    def _fill(self, x: int, y: int, w: int, h: int) -> None:
+        x0 = max(0, x)
+        x1 = min(self.width, x + w)
+        if x1 <= x0:
+            return
+        run = self._color * (x1 - x0)
+        for row in range(max(0, y), min(self.height, y + h)):
+            start = ((row * self.width) + x0) * 3
+            self.framebuffer[start:start + len(run)] = run
+
+    def get_bounds(self):
+        return (self.width, self.height)
+
+    def create_pen(self, r, g, b):
+        emulator.charge('create_pen')
+        return _RGB_PEN | (r << 16) | (g << 8) | b
+
+    def set_pen(self, pen):
+        emulator.charge('set_pen')
+        self._color = self._pen_rgb(pen)
+
+    def pixel(self, x, y):
+        emulator.charge('pixel')
+        self._fill(x, y, 1, 1)
+
+    def pixel_span(self, x, y, length):
+        emulator.charge('pixel_span')
+        emulator.charge('span_pixel', length)
+        self._fill(x, y, length, 1)
+
+    def clear(self):
+        emulator.charge('clear')
+        self._fill(0, 0, self.width, self.height)
+
+    def rectangle(self, x, y, w, h):
+        emulator.charge('rectangle')
+        self._fill(x, y, w, h)
+
+    def line(self, x1, y1, x2, y2, thickness=1):
+        emulator.charge('line')
+
+    def text(self, text, x, y, wordwrap=None, scale=2, angle=0, spacing=1,
+             fixed_width=False):
+        emulator.charge('text')
+
+    def measure_text(self, text, scale=2, spacing=1, fixed_width=False):
+        return len(text) * 6 * scale
+
+    def set_font(self, font):
+        pass
+
+    def set_thickness(self, thickness):
+        pass
+
+    def update(self):
+        previous = emulator.phase
+        emulator.set_phase('refresh')
+        emulator.charge('update')
+        emulator.set_phase(previous)
+        self.updates += 1
+
+    def blit_image(self, image, x: int, y: int) -> None:
+        """Draw a PIL image, for the fake JPEG/PNG decoders."""
+        image = image.convert('RGB')
+        data = image.tobytes()
+        for row in range(image.height):
+            if y + row < 0 or y + row >= self.height:
+                continue
+            w = min(image.width, self.width - x)
+            if w <= 0:
+                break
+            start = (((y + row) * self.width) + x) * 3
+            src = row * image.width * 3
+            self.framebuffer[start:start + (w * 3)] = data[src:src + (w * 3)]
+
+    def save(self, filename: str) -> None:
+        """Save the framebuffer as an image file (needs PIL)."""
+        from PIL import Image
+        Image.frombytes('RGB', (self.width, self.height),
+                        bytes(self.framebuffer)).save(filename)
@@ -0,0 +1,26 @@
+# Desktop fake of Pimoroni's pngdec module, decoding with PIL.
+
+import emulator
+import io
+from PIL import Image
+
+PNG_POSTERISE = 0
+PNG_DITHER = 1
+PNG_COPY = 2
+
+class PNG:
+    def __init__(self, display):
+        self._display = display
+        self._source = None
+
+    def open_RAM(self, data):
+        self._source = io.BytesIO(bytes(data))
+
+    def open_file(self, filename):
+        with open(filename, 'rb') as source:
+            self._source = io.BytesIO(source.read())
+
+    def decode(self, x=0, y=0, scale=0, mode=PNG_POSTERISE):
+        with Image.open(self._source, formats=['PNG']) as image:
+            emulator.charge('png_pixel', image.width * image.height)
+            self._display.blit_image(image, x, y)
@@ -0,0 +1,72 @@
+# Desktop fake of MicroPython's usocket module, over real sockets.
+#
+# Data arrives as fast as the host can provide it, but every call and byte is
+# charged to the emulated device clock, so slow-network behaviour shows up in
+# the timings rather than as real waiting.
+
+import emulator
+import socket as _socket
+
+SOCK_STREAM = _socket.SOCK_STREAM
+SOL_SOCKET = _socket.SOL_SOCKET
+SO_REUSEADDR = _socket.SO_REUSEADDR
+
+def getaddrinfo(host, port, af=0, type=0, proto=0, flags=0):
+    return _socket.getaddrinfo(host, port, af, type, proto, flags)
+
+class socket:
+    def __init__(self, family=_socket.AF_INET, type=SOCK_STREAM, proto=0):
+        self._sock = _socket.socket(family, type, proto)
+        self._reader = None
+
+    def settimeout(self, timeout):
+        self._sock.settimeout(timeout)
+
+    def setsockopt(self, level, option, value):
+        self._sock.setsockopt(level, option, value)
+
+    def connect(self, address):
+        emulator.set_phase('fetch')
+        emulator.response_headers.clear()
+        emulator.charge('connect')
+        self._sock.connect(address)
+        self._reader = self._sock.makefile('rb')
+
+    def write(self, data):
+        emulator.charge('write')
+        emulator.charge('write_bytes', len(data))
+        self._sock.sendall(data)
+        return len(data)
+
+    def _received(self, size: int) -> None:
+        emulator.charge('read')
+        emulator.charge('read_bytes', size)
+
+    def readline(self):
+        line = self._reader.readline()
+        self._received(len(line))
+        if emulator.phase == 'fetch' and b": " in line:
+            key, value = line.decode().strip().split(": ", 1)
+            emulator.response_headers[key] = value
+        if line == b"\r\n":
+            # End of headers; whatever happens next is decoding the body.
+            emulator.set_phase('decode')
+        return line
+
+    def read(self, size=-1):
+        data = self._reader.read(size)
+        self._received(len(data))
+        return data
+
+    def readinto(self, buf, size=None):
+        if size is not None:
+            buf = memoryview(buf)[:size]
+        count = self._reader.readinto(buf)
+        self._received(count)
+        return count
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        self._sock.close()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# Run one PaperThin wake cycle on a desktop, as a regression benchmark.
+#
+# This runs the real paperthin.py under CPython, against the fake MicroPython
+# modules in desktop/ and a PaperThin server (by default, a local Flask copy of
+# ../paperthin-server started just for the run). The fakes count every socket
+# read and PicoGraphics call and charge them to an emulated device clock, so
+# changes to picorle_decode(), http_request() or display_using_decoder() can be
+# compared without hardware. It always emulates battery power, so the cycle
+# ends when the client would go to sleep.
+#
+# The per-call costs come from picorle.DEVICE_COSTS_US, plus a simple network
+# model. They are estimates; if you time a real frame, pass --measured to get
+# the factor to scale them by, and --costs to feed corrected numbers back in.
+#
+# Copyright 2023 Philip Boulain.
+# Licensed under the EUPL-1.2-or-later.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import runpy
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+_CLIENT_DIR = os.path.dirname(os.path.abspath(__file__))
+_SERVER_DIR = os.path.join(os.path.dirname(_CLIENT_DIR), "paperthin-server")
+sys.path.insert(0, os.path.join(_CLIENT_DIR, "desktop"))
+sys.path.append(_SERVER_DIR)  # Only for picorle's cost table.
+
+import emulator
+import inky_frame
+import machine
+import picographics
+import picorle
+
+_DISPLAYS = {
+    "4": picographics.DISPLAY_INKY_FRAME_4,
+    "5.7": picographics.DISPLAY_INKY_FRAME,
+    "7.3": picographics.DISPLAY_INKY_FRAME_7,
+}
+# Roughly how long each display takes for a full e-ink refresh.
+_REFRESH_SECONDS = {"4": 30.0, "5.7": 30.0, "7.3": 40.0}
+
+def device_costs(bandwidth: float, connect_ms: float, refresh_s: float
+                 ) -> dict[str, float]:
+    """Per-call costs in microseconds for the emulator's fakes."""
+    costs = dict(picorle.DEVICE_COSTS_US)
+    # The fakes can't see the decoder's loop, so fold its overhead into the
+    # calls each iteration makes.
+    costs["pixel_span"] += costs.pop("span_loop")
+    costs["pixel"] += costs.pop("unspan_loop")
+    costs.update({
+        "connect": connect_ms * 1000.0,
+        "read_bytes": (1000000.0 / bandwidth) + costs.pop("read_byte"),
+        "write": costs["read"],
+        "write_bytes": 1000000.0 / bandwidth,
+        "update": refresh_s * 1000000.0,
+        "clear": 20000.0,
+        "rectangle": 100.0,
+        "text": 1000.0,
+        # JPEGDEC/PNGDEC are native, so per pixel rather than per call.
+        "jpeg_pixel": 5.0,
+        "png_pixel": 5.0,
+    })
+    return costs
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def start_server(server_dir: str, port: int, verbose: bool
+                 ) -> subprocess.Popen:
+    """Start the Flask app on localhost and wait for it to accept requests."""
+    output = None if verbose else subprocess.DEVNULL
+    server = subprocess.Popen(
+        [sys.executable, "-m", "flask",
+         "--app", os.path.join(_SERVER_DIR, "app.py"), "run",
+         "--host", "127.0.0.1", "--port", str(port)],
+        cwd=server_dir, stdout=output, stderr=output)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("Server exited during startup")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("Server did not start listening")
+
+def client_config(config_path: str, base_url: str, display: int,
+                  threaded: bool) -> types.ModuleType:
+    """Load the client config, pointed at our server and made debuggable."""
+    config = types.ModuleType("paperthin_config")
+    with open(config_path) as config_file:
+        exec(compile(config_file.read(), config_path, "exec"), config.__dict__)
+    config.DISPLAY = display
+    config._BASE_URL = base_url
+    # Crash out with the real exception instead of sleeping on an RSOD.
+    config._ERROR_RERAISE = True
+    config._ERROR_NETWORK_RETRY_TIME = None
+    config._PRI_READER_THREAD = threaded
+    return config
+
+def run_cycle(config: types.ModuleType, button: int|None, url: str|None,
+              quiet: bool) -> tuple[str, float]:
+    """Run paperthin.py until it sleeps. Returns outcome and host seconds."""
+    inky_frame.pressed_button = button
+    inky_frame.woken_by_timer = url is not None
+    if url is not None:
+        with open(config._URLFILE_NAME, "w") as urlfile:
+            urlfile.write(url)
+    fake_secrets = types.ModuleType("secrets")
+    fake_secrets.WIFI_SSID = "emulator"
+    fake_secrets.WIFI_PASSWORD = "emulator"
+    # Swap these in only for the run; the real secrets module is stdlib.
+    saved = {name: sys.modules.get(name)
+             for name in ("secrets", "paperthin_config")}
+    sys.modules["secrets"] = fake_secrets
+    sys.modules["paperthin_config"] = config
+    # MicroPython's time has these extras, which the client times itself with.
+    time.ticks_ms = emulator.ticks_ms
+    time.ticks_diff = emulator.ticks_diff
+    outcome = "failed"
+    output = io.StringIO() if quiet else sys.stdout
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output):
+            runpy.run_path(os.path.join(_CLIENT_DIR, "paperthin.py"),
+                           run_name="__main__")
+    except emulator.WakeCycleOver as e:
+        outcome = f"slept ({e})"
+    except Exception as e:
+        outcome = f"failed ({type(e).__name__}: {e})"
+    finally:
+        del time.ticks_ms, time.ticks_diff
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+    return outcome, time.perf_counter() - start
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description="Run one PaperThin wake cycle against fake hardware.")
+    wake = arg_parser.add_mutually_exclusive_group()
+    wake.add_argument("--button", choices="abcde",
+        help="Wake as if this button was pressed (POST)")
+    wake.add_argument("--url", help="Wake as if refreshing to this path (GET)")
+    arg_parser.add_argument("--server",
+        help="Base URL of an existing server (default: start ../paperthin-server)")
+    arg_parser.add_argument("--server-dir", default=_SERVER_DIR,
+        help="Directory to run the server in, with its responses/ "
+             "(default: %(default)s)")
+    arg_parser.add_argument("--config",
+        default=os.path.join(_CLIENT_DIR, "paperthin_config_example.py"),
+        help="Client config to start from (default: %(default)s)")
+    arg_parser.add_argument("--display", choices=_DISPLAYS.keys(),
+        default="7.3", help="Inky Frame size in inches (default: 7.3)")
+    arg_parser.add_argument("--voltage", type=float, default=4.5,
+        help="Battery voltage to report (default: %(default)s)")
+    arg_parser.add_argument("--bandwidth", type=float, default=100 * 1024,
+        help="Effective WiFi bytes per second (default: %(default)s)")
+    arg_parser.add_argument("--connect-ms", type=float, default=50.0,
+        help="Connection setup time (default: %(default)s)")
+    arg_parser.add_argument("--threaded", action="store_true",
+        help="Turn on _PRI_READER_THREAD, reading PRI on a second thread")
+    arg_parser.add_argument("--costs",
+        help="JSON file of per-call microsecond costs to override")
+    arg_parser.add_argument("--measured", type=float,
+        help="Seconds the real device took to decode this response, to "
+             "calibrate against")
+    arg_parser.add_argument("--workdir",
+        help="Keep the client's files (e.g. its content cache) in this "
+             "directory between runs (default: a fresh temporary one)")
+    arg_parser.add_argument("--save", help="Save the framebuffer to this image")
+    arg_parser.add_argument("--json", action="store_true",
+        help="Print the report as JSON")
+    arg_parser.add_argument("--verbose", action="store_true",
+        help="Show client and server output")
+    args = arg_parser.parse_args()
+
+    emulator.reset()
+    emulator.costs.update(device_costs(args.bandwidth, args.connect_ms,
+                                       _REFRESH_SECONDS[args.display]))
+    if args.costs:
+        with open(args.costs) as costs_file:
+            emulator.costs.update(json.load(costs_file))
+    machine.voltage = args.voltage
+    machine.usb_power = False
+
+    server = None
+    base_url = args.server
+    if base_url is None:
+        port = free_port()
+        server = start_server(args.server_dir, port, args.verbose)
+        base_url = f"http://127.0.0.1:{port}/"
+    if not base_url.endswith("/"):
+        base_url += "/"
+    config = client_config(args.config, base_url, _DISPLAYS[args.display],
+                           args.threaded)
+    button = None if args.button is None else "abcde".index(args.button)
+    url = None if args.url is None else base_url + args.url.lstrip("/")
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        workdir = contextlib.nullcontext(args.workdir)
+    else:
+        workdir = tempfile.TemporaryDirectory(prefix="paperthin-emulator-")
+    previous_dir = os.getcwd()
+    save = os.path.abspath(args.save) if args.save else None
+    try:
+        with workdir as workdir_name:
+            os.chdir(workdir_name)
+            try:
+                outcome, host_seconds = run_cycle(config, button, url,
+                                                  not args.verbose)
+            finally:
+                os.chdir(previous_dir)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    device_seconds = {phase: micros / 1000000.0
+                      for phase, micros in emulator.clock_us.items()}
+    report = {
+        "outcome": outcome,
+        "response": {
+            "content_type": emulator.response_headers.get("Content-Type"),
+            "content_length": int(emulator.response_headers.get(
+                "Content-Length", 0)),
+            "refresh": emulator.response_headers.get("Refresh"),
+        },
+        "calls": dict(sorted(emulator.calls.items())),
+        "device_seconds": device_seconds,
+        "device_seconds_total": emulator.total_seconds(),
+        "host_seconds": host_seconds,
+    }
+    if args.measured is not None and device_seconds.get("decode"):
+        report["calibration_factor"] = (args.measured /
+                                        device_seconds["decode"])
+    if save and emulator.display is not None:
+        emulator.display.save(save)
+
+    if args.json:
+        print(json.dumps(report, indent=1))
+        return
+    response = report["response"]
+    print(f"Outcome: {outcome}")
+    print(f"Response: {response['content_type']}, "
+          f"{response['content_length']} bytes, refresh {response['refresh']}")
+    print("Calls: " + ", ".join(f"{call} {count}"
+                                for call, count in report["calls"].items()))
+    print("Estimated device time: " + ", ".join(
+        f"{phase} {seconds:.2f}s" for phase, seconds in device_seconds.items())
+        + f"; total {report['device_seconds_total']:.2f}s")
+    print(f"Host time: {host_seconds:.2f}s")
+    if "calibration_factor" in report:
+        print(f"Calibration: multiply decode costs by "
+              f"{report['calibration_factor']:.3f} to match the device")
+
+if __name__ == "__main__":
+    main()
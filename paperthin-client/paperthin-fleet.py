@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# Load a PaperThin server with a simulated fleet of clients, to size it.
+#
+# Each simulated client behaves like paperthin.py on battery: it POSTs button
+# presses and GETs whatever its last Refresh header said, with the same
+# HTTP/1.0 request line, User-Agent, Accept and hostname/w/h/v query
+# parameters, and sleeps for the Refresh time in whole minutes (or until its
+# next button press, if there was none). It reads each body at a configurable
+# device-like pace, through a small receive buffer, so the server sees the same
+# back-pressure it would from a frame busy drawing.
+#
+# Alternatively, --replay a recorded gunicorn access log to repeat real traffic
+# at its recorded times.
+#
+# Times on the device's scale (Refresh, button presses, e-ink refresh) can be
+# compressed with --time-scale; reading pace isn't, since that is what holds
+# server workers. The report gives time-to-first-byte percentiles (which is
+# where a saturated server's queueing shows), how many requests the server had
+# in hand at once, and bytes served.
+#
+# Copyright 2023 Philip Boulain.
+# Licensed under the EUPL-1.2-or-later.
+
+import argparse
+import asyncio
+import collections
+import json
+import random
+import re
+import socket
+import time
+import urllib.parse
+
+_USER_AGENT = "PaperThin/1"
+_ACCEPT = ("image/x.pico-rle; version=4, image/x.pico-rle; version=3, "
+           "image/x.pico-rle; version=2, image/png, image/jpeg, text/plain")
+_DISPLAY_SIZES = {"4": (640, 400), "5.7": (600, 448), "7.3": (800, 480)}
+_BUTTON_PATHS = ["a", "b", "c", "d", "e"]
+# gunicorn's default access log format:
+# %(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"
+_ACCESS_LOG_LINE = re.compile(
+    r'\S+ \S+ \S+ \[(?P<time>[^]]+)\] "(?P<method>\S+) (?P<target>\S+) [^"]*"')
+
+class Stats:
+    """What the fleet saw, and how many requests the server held at once."""
+
+    def __init__(self) -> None:
+        self.start = time.monotonic()
+        self.first_byte_s: dict[str, list[float]] = collections.defaultdict(list)
+        self.total_s: dict[str, list[float]] = collections.defaultdict(list)
+        self.statuses: collections.Counter[str] = collections.Counter()
+        self.body_bytes = 0
+        self.errors: collections.Counter[str] = collections.Counter()
+        # Seconds spent with each number of requests outstanding.
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.seconds_at: collections.Counter[int] = collections.Counter()
+        self._changed = self.start
+
+    def _count(self, delta: int) -> None:
+        now = time.monotonic()
+        self.seconds_at[self.in_flight] += now - self._changed
+        self._changed = now
+        self.in_flight += delta
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def begin(self) -> None:
+        self._count(1)
+
+    def end(self) -> None:
+        self._count(-1)
+
+    def report(self, workers: int|None) -> dict:
+        self._count(0)
+        elapsed = time.monotonic() - self.start
+        requests = sum(self.statuses.values())
+        report = {
+            "elapsed_seconds": elapsed,
+            "requests": requests,
+            "statuses": dict(sorted(self.statuses.items())),
+            "errors": dict(sorted(self.errors.items())),
+            "body_bytes": self.body_bytes,
+            "body_bytes_per_second": self.body_bytes / elapsed,
+            "first_byte_seconds": {path: percentiles(times) for path, times
+                                   in sorted(self.first_byte_s.items())},
+            "total_seconds": {path: percentiles(times) for path, times
+                              in sorted(self.total_s.items())},
+            "in_flight": {
+                "mean": sum(count * seconds for count, seconds
+                            in self.seconds_at.items()) / elapsed,
+                "peak": self.peak_in_flight,
+            },
+        }
+        if workers is not None:
+            # Requests are in flight from sending to the last byte read, which
+            # is as long as a sync worker is held without a buffering proxy.
+            report["in_flight"]["saturated_fraction"] = sum(
+                seconds for count, seconds in self.seconds_at.items()
+                if count >= workers) / elapsed
+        return report
+
+def percentiles(times: list[float]) -> dict[str, float]:
+    ordered = sorted(times)
+    def rank(fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    return {"count": len(ordered), "p50": rank(0.5), "p90": rank(0.9),
+            "p99": rank(0.99), "max": ordered[-1]}
+
+async def fetch(args: argparse.Namespace, stats: Stats, method: str, url: str,
+                headers: dict[str, str]) -> tuple[int, dict[str, str]]|None:
+    """Make one request like paperthin.py. Returns status and headers."""
+    parsed = urllib.parse.urlsplit(url)
+    path = parsed.path or "/"
+    target = path + ("?" + parsed.query if parsed.query else "")
+    headers = {"Host": parsed.netloc, "User-Agent": _USER_AGENT,
+               "Accept": _ACCEPT, "Connection": "close", **headers}
+    if method == "POST":
+        headers["Content-Length"] = "0"
+    request = f"{method} {target} HTTP/1.0\r\n" + "".join(
+        f"{key}: {value}\r\n" for key, value in headers.items()) + "\r\n"
+
+    sock = socket.socket()
+    # The Pico's lwIP window is small; a big one here would hide back-pressure.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, args.receive_buffer)
+    sock.setblocking(False)
+    loop = asyncio.get_running_loop()
+    stats.begin()
+    sent = time.monotonic()
+    try:
+        await asyncio.wait_for(loop.sock_connect(
+            sock, (parsed.hostname, parsed.port or 80)), args.timeout)
+        # The stream's own buffer is only as big as a response head needs.
+        reader, writer = await asyncio.open_connection(
+            sock=sock, limit=max(args.chunk, 4096))
+        try:
+            writer.write(request.encode())
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"),
+                                          args.timeout)
+            first_byte = time.monotonic()
+            lines = head.decode("iso-8859-1").split("\r\n")
+            status = int(lines[0].split(" ", 2)[1])
+            response_headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    key, value = line.split(":", 1)
+                    response_headers[key.strip()] = value.strip()
+            # Like _DOUBLE_UPDATE_CLEAR, if asked.
+            await asyncio.sleep(args.read_delay)
+            while True:
+                chunk = await asyncio.wait_for(reader.read(args.chunk),
+                                               args.timeout)
+                if not chunk:
+                    break
+                stats.body_bytes += len(chunk)
+                if args.read_rate:
+                    await asyncio.sleep(len(chunk) / args.read_rate)
+        finally:
+            writer.close()
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError, ValueError, IndexError) as e:
+        stats.errors[type(e).__name__] += 1
+        return None
+    finally:
+        stats.end()
+        sock.close()
+    done = time.monotonic()
+    stats.statuses[str(status)] += 1
+    stats.first_byte_s[path].append(first_byte - sent)
+    stats.total_s[path].append(done - sent)
+    return (status, response_headers)
+
+async def simulated_client(args: argparse.Namespace, stats: Stats,
+                           index: int, deadline: float) -> None:
+    """One frame, from power-on with a button press until the deadline."""
+    rng = random.Random(args.seed * 100003 + index)
+    display = rng.choice(args.display)
+    (w, h) = _DISPLAY_SIZES[display]
+    voltage = (args.voltage if args.voltage is not None
+               else round(rng.uniform(3.6, 4.2), 2))
+    params = urllib.parse.urlencode({"hostname": f"{args.hostname}{index}",
+                                     "w": w, "h": h, "v": voltage})
+    showing = None
+
+    def press() -> tuple[str, str]:
+        return ("POST", args.server + rng.choice(args.buttons))
+
+    def next_press() -> float:
+        if not args.press_interval:
+            return float("inf")
+        return rng.expovariate(1.0 / args.press_interval)
+
+    await asyncio.sleep(rng.uniform(0, args.ramp))
+    (method, url) = press()
+    while time.monotonic() < deadline:
+        headers = {}
+        if showing is not None:
+            headers["X-PaperThin-Showing"] = showing
+        result = await fetch(args, stats, method, f"{url}?{params}", headers)
+        if result is None:
+            # Retry the same request, as after the red screen of death.
+            await asyncio.sleep(args.error_retry / args.time_scale)
+            continue
+        (_, response_headers) = result
+        showing = response_headers.get("X-Content-Hash", showing)
+        sleep_s = None
+        try:
+            when, what = response_headers["Refresh"].split(";", 1)
+            # sleep_for() takes whole minutes.
+            sleep_s = (max(60, int(when)) // 60 * 60) + args.refresh_seconds
+            next_url = what.strip()
+        except (KeyError, ValueError):
+            pass
+        press_s = next_press()
+        if sleep_s is None or press_s < sleep_s:
+            # No Refresh means sleeping until a button is pressed.
+            if press_s == float("inf"):
+                return
+            await asyncio.sleep(press_s / args.time_scale)
+            (method, url) = press()
+        else:
+            await asyncio.sleep(sleep_s / args.time_scale)
+            (method, url) = ("GET", next_url)
+
+def read_access_log(path: str) -> list[tuple[float, str, str]]:
+    """(Seconds since the first request, method, target) from a log."""
+    requests = []
+    with open(path) as log:
+        for line in log:
+            match = _ACCESS_LOG_LINE.search(line)
+            if match is None:
+                continue
+            when = time.mktime(time.strptime(match["time"].split()[0],
+                                             "%d/%b/%Y:%H:%M:%S"))
+            requests.append((when, match["method"], match["target"]))
+    if not requests:
+        return []
+    first = min(when for when, _, _ in requests)
+    return [(when - first, method, target)
+            for when, method, target in requests]
+
+async def replay(args: argparse.Namespace, stats: Stats) -> None:
+    base = urllib.parse.urlsplit(args.server)
+    start = time.monotonic()
+    tasks = []
+    for (when, method, target) in read_access_log(args.replay):
+        delay = start + (when / args.time_scale) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        url = urllib.parse.urlunsplit((base.scheme, base.netloc, "", "", ""))
+        tasks.append(asyncio.create_task(
+            fetch(args, stats, method, url + target, {})))
+    await asyncio.gather(*tasks)
+
+async def simulate(args: argparse.Namespace, stats: Stats) -> None:
+    deadline = time.monotonic() + args.duration
+    await asyncio.gather(*(simulated_client(args, stats, index, deadline)
+                           for index in range(args.clients)))
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description="Load a PaperThin server with simulated clients.")
+    arg_parser.add_argument("--server", default="http://127.0.0.1:5000/",
+        help="Base URL of the server (default: %(default)s)")
+    arg_parser.add_argument("--replay",
+        help="Replay this gunicorn access log instead of simulating clients")
+    arg_parser.add_argument("--clients", type=int, default=10,
+        help="Number of simulated clients (default: %(default)s)")
+    arg_parser.add_argument("--duration", type=float, default=60.0,
+        help="Seconds of real time to simulate for; clients finish the "
+             "request they are on (default: %(default)s)")
+    arg_parser.add_argument("--ramp", type=float, default=10.0,
+        help="Spread client power-ons over this many real seconds "
+             "(default: %(default)s)")
+    arg_parser.add_argument("--time-scale", type=float, default=1.0,
+        help="Run device sleeps this many times faster, e.g. 60 to make "
+             "ten-minute Refreshes ten seconds (default: %(default)s)")
+    arg_parser.add_argument("--display", choices=_DISPLAY_SIZES.keys(),
+        action="append",
+        help="Inky Frame size in inches; repeatable to mix (default: 7.3)")
+    arg_parser.add_argument("--buttons", default="abcde",
+        type=lambda buttons: [_BUTTON_PATHS["abcde".index(button)]
+                              for button in buttons],
+        help="Buttons the simulated users press (default: abcde)")
+    arg_parser.add_argument("--press-interval", type=float, default=3600.0,
+        help="Mean device seconds between button presses per client; 0 for "
+             "none (default: %(default)s)")
+    arg_parser.add_argument("--voltage", type=float,
+        help="Battery voltage to report (default: random 3.6 to 4.2 per "
+             "client)")
+    arg_parser.add_argument("--hostname", default="fleet",
+        help="Hostname prefix; clients append their number "
+             "(default: %(default)s)")
+    arg_parser.add_argument("--read-rate", type=float, default=20 * 1024,
+        help="Bytes per second each client reads bodies at, as fast as it "
+             "can draw them; 0 for unlimited (default: %(default)s)")
+    arg_parser.add_argument("--read-delay", type=float, default=0.0,
+        help="Seconds before reading each body; 40 is like "
+             "_DOUBLE_UPDATE_CLEAR (default: %(default)s)")
+    arg_parser.add_argument("--refresh-seconds", type=float, default=40.0,
+        help="Device seconds of e-ink refresh after each picture "
+             "(default: %(default)s)")
+    arg_parser.add_argument("--chunk", type=int, default=1024,
+        help="Bytes read at a time (default: %(default)s)")
+    arg_parser.add_argument("--receive-buffer", type=int, default=4096,
+        help="Socket receive buffer in bytes (default: %(default)s)")
+    arg_parser.add_argument("--timeout", type=float, default=120.0,
+        help="Seconds to give up on a stalled request (default: %(default)s)")
+    arg_parser.add_argument("--error-retry", type=float, default=15.0,
+        help="Device seconds before retrying after an error, like "
+             "_ERROR_RETRY_TIME (default: %(default)s)")
+    arg_parser.add_argument("--workers", type=int,
+        help="Server worker count, to report how long they were all busy")
+    arg_parser.add_argument("--seed", type=int, default=0,
+        help="Random seed, for repeatable fleets (default: %(default)s)")
+    arg_parser.add_argument("--json", action="store_true",
+        help="Print the report as JSON")
+    args = arg_parser.parse_args()
+    args.display = args.display or ["7.3"]
+    if not args.server.endswith("/"):
+        args.server += "/"
+
+    stats = Stats()
+    asyncio.run(replay(args, stats) if args.replay else simulate(args, stats))
+    report = stats.report(args.workers)
+
+    if args.json:
+        print(json.dumps(report, indent=1))
+        return
+    print(f"{report['requests']} requests in {report['elapsed_seconds']:.1f}s: "
+          + ", ".join(f"{status} x{count}"
+                      for status, count in report["statuses"].items()))
+    if report["errors"]:
+        print("Errors: " + ", ".join(f"{error} x{count}" for error, count
+                                     in report["errors"].items()))
+    print(f"Bodies: {report['body_bytes']} bytes, "
+          f"{report['body_bytes_per_second']:.0f} bytes/s")
+    for title, key in (("Time to first byte", "first_byte_seconds"),
+                       ("Time to last byte", "total_seconds")):
+        print(f"{title}:")
+        for path, times in report[key].items():
+            print(f"  {path}: {times['count']} requests, "
+                  f"p50 {times['p50']:.3f}s, p90 {times['p90']:.3f}s, "
+                  f"p99 {times['p99']:.3f}s, max {times['max']:.3f}s")
+    in_flight = report["in_flight"]
+    line = (f"In flight: mean {in_flight['mean']:.2f}, "
+            f"peak {in_flight['peak']}")
+    if "saturated_fraction" in in_flight:
+        line += (f"; all {args.workers} workers busy "
+                 f"{in_flight['saturated_fraction'] * 100:.1f}% of the time")
+    print(line)
+
+if __name__ == "__main__":
+    main()
@@ -34,6 +34,21 @@ from paperthin_config import (PicoGraphics, DISPLAY, _BASE_URL, _HELLO_PATH,
                               _WIFI_LED_STANDBY_BRIGHTNESS,
                               _WIFI_FORCE_RECONNECT,
                               _DOUBLE_UPDATE_CLEAR)
+try:
+    from paperthin_config import _PRI_READER_THREAD
+except ImportError:
+    # Newer option; older configs won't have it.
+    _PRI_READER_THREAD = False
+try:
+    from paperthin_config import _CONTENT_CACHE_DIR, _CONTENT_CACHE_BUDGET
+except ImportError:
+    # Newer options; default to SD if it's been mounted, else flash.
+    _CONTENT_CACHE_DIR = None
+    _CONTENT_CACHE_BUDGET = 256 * 1024
+try:
+    import _thread
+except ImportError:
+    _thread = None
 
 # Set up the display and pin that indicates USB power.
 # https://forums.pimoroni.com/t/inky-frame-deep-sleep-explanation/19965/9
@@ -83,6 +98,27 @@ def set_wakeup_url(url: typing.Optional[str]) -> None:
         with open(_URLFILE_NAME, "w") as urlfile:
             urlfile.write(url)
 
+# Remembers the X-Content-Hash of what's on the display, so the server can
+# tell us not to bother redrawing it.
+_SHOWNFILE_NAME = "paperthin.shown"
+
+def get_shown_hash() -> typing.Optional[str]:
+    try:
+        with open(_SHOWNFILE_NAME) as shownfile:
+            return shownfile.read().strip() or None
+    except OSError:
+        return None
+
+def set_shown_hash(content_hash: typing.Optional[str]) -> None:
+    if content_hash is None:
+        try:
+            os.remove(_SHOWNFILE_NAME)
+        except OSError:
+            return  # Shrug.
+    elif get_shown_hash() != content_hash:
+        with open(_SHOWNFILE_NAME, "w") as shownfile:
+            shownfile.write(content_hash)
+
 def red_screen_of_death(message: str,
                         autoreboot: bool,
                         exception: typing.Optional[Exception] = None
@@ -93,6 +129,9 @@ def red_screen_of_death(message: str,
     # flush=True print() form, or the full sys.stdout.flush().
     print(f"RSOD: {message}")  # Should flush.
     time.sleep(0.1)  # Try to encourage serial to flush BEFORE display.update().
+    global framebuffer_hash
+    set_shown_hash(None)  # Whatever it was, it's about to be covered up.
+    framebuffer_hash = None
     inky_frame.led_busy.on()  # Warning light on, wifi light off.
     # (This used to christmas-tree light up all the buttons, but it seems it
     # can cause enough voltage sag to sometimes mess up the display refresh.)
@@ -287,6 +326,40 @@ def form_urlencode(params: typing.Dict[str, str]) -> str:
     return "&".join([f"{aggressive_urlencode(k)}={aggressive_urlencode(v)}"
                      for k, v in params.items()])
 
+# Milliseconds each phase of this wake cycle took. They're saved, and reported
+# to the server on the next cycle, so it can schedule Refresh around them.
+_TIMINGFILE_NAME = "paperthin.timing"
+_TIMING_PHASES = ("connect", "fetch", "decode", "refresh")
+cycle_ms: typing.Dict[str, int] = {}
+
+def get_last_timings() -> typing.Dict[str, str]:
+    """Query parameters for the last cycle's timings, if we have them."""
+    try:
+        with open(_TIMINGFILE_NAME) as timingfile:
+            values = timingfile.read().split()
+    except OSError:
+        return {}
+    if len(values) != len(_TIMING_PHASES):
+        return {}
+    return {f"{phase}_ms": value
+            for (phase, value) in zip(_TIMING_PHASES, values)}
+
+def save_timings() -> None:
+    with open(_TIMINGFILE_NAME, "w") as timingfile:
+        timingfile.write(" ".join(str(cycle_ms.get(phase, 0))
+                                  for phase in _TIMING_PHASES))
+
+def timed_update() -> None:
+    """display.update(), counting its time towards this cycle's refresh."""
+    start = time.ticks_ms()
+    display.update()
+    cycle_ms["refresh"] = (cycle_ms.get("refresh", 0) +
+                           time.ticks_diff(time.ticks_ms(), start))
+
+# What display_response() can handle, for the server to pick formats.
+_ACCEPT = ("image/x.pico-rle; version=4, image/x.pico-rle; version=3, "
+           "image/x.pico-rle, image/png, image/jpeg, text/plain")
+
 def http_request(url: str,
                  data: typing.Optional[bytes]=None,
                  method: str="GET",
@@ -299,6 +372,7 @@ def http_request(url: str,
 
     # Set some default headers.
     headers.setdefault("User-Agent", _USER_AGENT)
+    headers.setdefault("Accept", _ACCEPT)
     headers.setdefault("Connection", "close")
     headers.setdefault("Accept-Encoding", "identity")
     if data is not None:
@@ -413,91 +487,538 @@ def any_button_down() -> tuple[typing.Optional[inky_frame.Button], int]:
     else:
         return None, -1
 
+# Size of the preallocated buffer picorle_decode() parses from. Must be at least
+# the largest unspan (255 truecolor pixels, plus its two header bytes).
+_PRI_BUFFER_SIZE = 2048
+
+# Truecolor PRI pens are cached in a direct-mapped table of this many slots
+# (a power of two), keyed by 24-bit RGB. Photos repeat colors constantly.
+_PEN_CACHE_SIZE = 256
+
+class BlockReader:
+    """Reads a socket in blocks into a preallocated buffer, to parse from.
+
+    Rather than hitting the socket (and allocating) for every couple of bytes,
+    callers ensure() that enough bytes are buffered, then index buf directly
+    from pos and advance it themselves."""
+    def __init__(self, stream: usocket.socket, size: int,
+                 block_size: int = _PRI_BUFFER_SIZE) -> None:
+        self.stream = stream
+        self.buf = bytearray(block_size)
+        self.view = memoryview(self.buf)
+        self.pos = 0  # Next unparsed byte in buf.
+        self.end = 0  # End of valid data in buf.
+        self.remaining = size  # Bytes of the body still in the socket.
+
+    def ensure(self, count: int) -> bool:
+        """Make count bytes available from pos; False if the data runs out."""
+        if self.end - self.pos >= count:
+            return True
+        # Move any leftover to the front, and top up.
+        leftover = self.end - self.pos
+        if leftover > 0:
+            self.buf[0:leftover] = self.view[self.pos:self.end]
+        self.pos = 0
+        self.end = leftover
+        while self.end < count:
+            got = self._fill(self.view[self.end:])
+            if not got:
+                break
+            self.end += got
+        return self.end >= count
+
+    def _fill(self, into: memoryview) -> int:
+        """Read some more of the body into into; 0 at the end of it."""
+        # Never ask for more than the body has left, or we'd wait on a read
+        # that cannot complete.
+        if self.remaining <= 0:
+            return 0
+        want = min(len(into), self.remaining)
+        got = self.stream.readinto(into[0:want])
+        if got:
+            self.remaining -= got
+        return got
+
+    def close(self) -> None:
+        pass
+
+# Ring of blocks the second core reads the socket into, ahead of the decoder.
+_PRI_RING_BLOCKS = 4
+_PRI_RING_BLOCK_SIZE = 1024
+# How long either side naps when the ring is full (or empty), in seconds.
+_PRI_RING_WAIT = 0.001
+
+class ThreadedBlockReader(BlockReader):
+    """BlockReader whose socket reads run in a thread, i.e. on the other core.
+
+    The reader thread fills a ring of preallocated blocks, and waits when they
+    are all full until the decoder has caught up; the decoder copies out of
+    them, and waits if it catches up with the reader. Each counter is only
+    written by one side, so no locking is needed. Socket errors in the thread
+    are re-raised to the decoder."""
+    def __init__(self, stream: usocket.socket, size: int,
+                 block_size: int = _PRI_BUFFER_SIZE) -> None:
+        super().__init__(stream, size, block_size)
+        self.ring = [bytearray(_PRI_RING_BLOCK_SIZE)
+                     for _ in range(_PRI_RING_BLOCKS)]
+        self.ring_views = [memoryview(block) for block in self.ring]
+        self.ring_lengths = [0] * _PRI_RING_BLOCKS
+        self.produced = 0  # Blocks filled; written only by the reader thread.
+        self.consumed = 0  # Blocks emptied; written only by _fill().
+        self.offset = 0  # How much of the current block _fill() has used.
+        self.error = None
+        self.stopping = False
+        self.finished = False
+        _thread.start_new_thread(self._reader, ())
+
+    def _reader(self) -> None:
+        try:
+            while self.remaining > 0 and not self.stopping:
+                if self.produced - self.consumed >= _PRI_RING_BLOCKS:
+                    # Backpressure: the decoder is behind, so stop reading.
+                    time.sleep(_PRI_RING_WAIT)
+                    continue
+                slot = self.produced % _PRI_RING_BLOCKS
+                want = min(_PRI_RING_BLOCK_SIZE, self.remaining)
+                got = self.stream.readinto(self.ring_views[slot][0:want])
+                if not got:
+                    break
+                self.remaining -= got
+                self.ring_lengths[slot] = got
+                self.produced += 1
+        except Exception as e:
+            self.error = e
+        self.finished = True
+
+    def _fill(self, into: memoryview) -> int:
+        while self.consumed == self.produced:
+            # Only trust finished if nothing was produced just before it.
+            if self.finished and self.consumed == self.produced:
+                if self.error is not None:
+                    raise self.error
+                return 0
+            time.sleep(_PRI_RING_WAIT)
+        slot = self.consumed % _PRI_RING_BLOCKS
+        length = self.ring_lengths[slot]
+        count = min(len(into), length - self.offset)
+        into[0:count] = self.ring_views[slot][self.offset:self.offset + count]
+        self.offset += count
+        if self.offset == length:
+            self.offset = 0
+            self.consumed += 1
+        return count
+
+    def close(self) -> None:
+        """Stop the reader thread, so it's done with the socket."""
+        self.stopping = True
+        while not self.finished:
+            time.sleep(_PRI_RING_WAIT)
+
+def picorle_decode(pri: usocket.socket, size: int,
+                   left: int = 0, top: int = 0) -> None:
+    """Decode a PRI2, PRI3 or PRI4 image to the display, with its top-left
+    corner at the given position."""
+    print("Decoding PRI...")
+    reader = None
+    if _PRI_READER_THREAD and _thread is not None:
+        try:
+            reader = ThreadedBlockReader(pri, size)
+            print("...reading on the second core...")
+        except (OSError, RuntimeError) as e:
+            # Most likely the second core is already busy.
+            print(f"...no reader thread ({e}), continuing without...")
+    if reader is None:
+        reader = BlockReader(pri, size)
+    try:
+        picorle_decode_from(reader, left, top)
+    finally:
+        reader.close()
+
 # viper doesn't support the streaming byte reads we do
 @micropython.native
-def picorle_decode(pri: usocket.socket) -> None:
-    print("Decoding PRI2...")
+def picorle_decode_from(reader: BlockReader, left: int, top: int) -> None:
+    buf = reader.buf
     # Header
-    if pri.read(4) != b"PRI2":
+    if not reader.ensure(9) or bytes(reader.view[0:3]) != b"PRI":
         raise ValueError("Incorrect magic header")
-    width = int.from_bytes(pri.read(2), 'little')
-    height = int.from_bytes(pri.read(2), 'little')
+    version = buf[3] - ord("0")
+    if version < 2 or version > 4:
+        raise ValueError(f"Unsupported PRI version {version}")
+    right = left + (buf[4] | (buf[5] << 8))
+    bottom = top + (buf[6] | (buf[7] << 8))
 
     # Palette
-    palette_size = int.from_bytes(pri.read(1), 'little')
+    palette_size = buf[8]
+    reader.pos = 9
     truecolor: bool
     palette: list[int]  # PicoGraphics pens
-    if palette_size == 0:
+    if palette_size == 0 and version == 2:
         truecolor = True
         print("...truecolor...")
     else:
         truecolor = False
         palette_size += 1
+        if not reader.ensure(palette_size * 3):
+            raise ValueError("File truncated in palette")
         palette = [0] * palette_size
-        rgb = bytearray(3)
+        pos = reader.pos
         for i in range(0, palette_size):
-            pri.readinto(rgb)
-            palette[i] = display.create_pen(rgb[0], rgb[1], rgb[2])
+            palette[i] = display.create_pen(buf[pos], buf[pos+1], buf[pos+2])
+            pos += 3
+        reader.pos = pos
         print(f"...palette of size {palette_size}...")
+    if version >= 3:
+        picorle_small_palette_decode_from(reader, palette, version,
+                                          left, top, right, bottom)
+        return
 
     # Image data
+    # Spans are <count> <pixel>, unspans are 0 <count> <pixels...>. Pixels are
+    # 1 byte palette indices or 3 byte RGB. Truecolor pens go through a small
+    # cache, rather than create_pen() for every pixel, and set_pen() is skipped
+    # if the pen hasn't changed.
     bytes_per_pixel = 3 if truecolor else 1
-    span_data = bytearray(2)  # 2, even for truecolor
-    for y in range(0, height):
-        x = 0
-        while x < width:
-            if pri.readinto(span_data) != 2:
+    cache_mask = _PEN_CACHE_SIZE - 1
+    if truecolor:
+        cache_keys = [-1] * _PEN_CACHE_SIZE
+        cache_pens = [0] * _PEN_CACHE_SIZE
+    current_pen = -1
+    for y in range(top, bottom):
+        x = left
+        while x < right:
+            if not reader.ensure(2):
                 raise ValueError(f"File truncated after x={x}, y={y}")
-            count = int(span_data[0])
-            value = int(span_data[1])
+            pos = reader.pos
+            count = buf[pos]
             if count == 0:
-                # This is actually an unspan; value is the number of pixels.
-                unspan_data = pri.read(value * bytes_per_pixel)
-                pixels: typing.List[typing.Union[int,typing.Tuple[int,int,int]]]
-                if truecolor:
-                    pixels = []
-                    for i in range(0, len(unspan_data), 3):
-                        pixels.append((unspan_data[i],
-                                       unspan_data[i+1],
-                                       unspan_data[i+2]))
-                else:
-                    pixels = unspan_data
-                for pixel in pixels:
+                # This is actually an unspan; next is the number of pixels.
+                unspan_bytes = buf[pos+1] * bytes_per_pixel
+                if not reader.ensure(2 + unspan_bytes):
+                    raise ValueError(f"File truncated after x={x}, y={y}")
+                pos = reader.pos + 2  # ensure() may have moved things.
+                reader.pos = pos + unspan_bytes
+                for i in range(pos, pos + unspan_bytes, bytes_per_pixel):
                     if truecolor:
-                        display.set_pen(display.create_pen(
-                            pixel[0], pixel[1], pixel[2]))
+                        rgb = (buf[i] << 16) | (buf[i+1] << 8) | buf[i+2]
+                        slot = (rgb ^ (rgb >> 7) ^ (rgb >> 15)) & cache_mask
+                        if cache_keys[slot] == rgb:
+                            pen = cache_pens[slot]
+                        else:
+                            pen = display.create_pen(buf[i], buf[i+1], buf[i+2])
+                            cache_keys[slot] = rgb
+                            cache_pens[slot] = pen
                     else:
-                        display.set_pen(palette[pixel])
+                        pen = palette[buf[i]]
+                    if pen != current_pen:
+                        display.set_pen(pen)
+                        current_pen = pen
                     display.pixel(x, y)
                     x += 1
             else:
                 # Normal RLE span.
-                pixel: typing.Union[int,typing.Tuple[int,int,int]]
-                if truecolor:
-                    # We need to read two more bytes to complete the pixel.
-                    green_blue = bytearray(2)
-                    pri.readinto(green_blue)
-                    pixel = (value, int(green_blue[0]), int(green_blue[1]))
-                else:
-                    pixel = value
                 if truecolor:
-                    display.set_pen(display.create_pen(
-                        pixel[0], pixel[1], pixel[2]))
+                    # We need two more bytes to complete the pixel.
+                    if not reader.ensure(4):
+                        raise ValueError(f"File truncated after x={x}, y={y}")
+                    pos = reader.pos
+                    reader.pos = pos + 4
+                    rgb = (buf[pos+1] << 16) | (buf[pos+2] << 8) | buf[pos+3]
+                    slot = (rgb ^ (rgb >> 7) ^ (rgb >> 15)) & cache_mask
+                    if cache_keys[slot] == rgb:
+                        pen = cache_pens[slot]
+                    else:
+                        pen = display.create_pen(
+                            buf[pos+1], buf[pos+2], buf[pos+3])
+                        cache_keys[slot] = rgb
+                        cache_pens[slot] = pen
                 else:
-                    display.set_pen(palette[pixel])
+                    pen = palette[buf[pos+1]]
+                    reader.pos = pos + 2
+                if pen != current_pen:
+                    display.set_pen(pen)
+                    current_pen = pen
                 display.pixel_span(x, y, count)
                 x += count
 
     print("...PRI2 decoded!")
 
+def picorle_read_varint(reader: BlockReader) -> int:
+    value = 0
+    shift = 0
+    while True:
+        if not reader.ensure(1):
+            raise ValueError("File truncated in varint")
+        byte = reader.buf[reader.pos]
+        reader.pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value
+        shift += 7
+
+@micropython.native
+def picorle_draw_indices(indices: bytearray, start: int, count: int,
+                         x: int, y: int, palette: list[int],
+                         current_pen: int) -> int:
+    """Draw a row's palette indices, a span per run; return the pen used."""
+    end = start + count
+    while start < end:
+        index = indices[start]
+        run_end = start + 1
+        while run_end < end and indices[run_end] == index:
+            run_end += 1
+        pen = palette[index]
+        if pen != current_pen:
+            display.set_pen(pen)
+            current_pen = pen
+        display.pixel_span(x, y, run_end - start)
+        x += run_end - start
+        start = run_end
+    return current_pen
+
+@micropython.native
+def picorle_small_palette_decode_from(reader: BlockReader, palette: list[int],
+                                      version: int, left: int, top: int,
+                                      right: int, bottom: int) -> None:
+    """Decode PRI3/4 image data, after picorle_decode_from() has the palette."""
+    # Span bytes are 0LLLIIII, with L=7 meaning a varint follows for longer
+    # runs. Unspan bytes are 1NNNNNNN (PRI4: 10NNNNNN), with 0 meaning a
+    # varint follows, then 3- or 4-bit palette indices packed least
+    # significant bit first. PRI4 also has 110NNNNN to copy pixels from the
+    # row above and 111NNNNN to repeat it, so keeps the indices of the row
+    # above and the one being drawn.
+    buf = reader.buf
+    bits = 3 if len(palette) <= 8 else 4
+    mask = (1 << bits) - 1
+    row_ops = (version >= 4)
+    unspan_field = 0x3F if row_ops else 0x7F
+    width = right - left
+    if row_ops:
+        above = bytearray(width)
+        row = bytearray(width)
+        # Slicing memoryviews copies without allocating.
+        above_view = memoryview(above)
+        row_view = memoryview(row)
+        # Rows of each index, to copy spans into row without allocating.
+        fills = [memoryview(bytes((i,)) * width) for i in range(len(palette))]
+    current_pen = -1
+    y = top
+    while y < bottom:
+        x = left
+        repeated = False
+        while x < right:
+            if not reader.ensure(1):
+                raise ValueError(f"File truncated after x={x}, y={y}")
+            token = buf[reader.pos]
+            reader.pos += 1
+            if row_ops and (token & 0xC0) == 0xC0:
+                count = token & 0x1F
+                if count == 0:
+                    count = 32 + picorle_read_varint(reader)
+                if y == top:
+                    raise ValueError(f"No row above to copy at y={y}")
+                if token & 0x20:
+                    if x != left or y + count > bottom:
+                        raise ValueError(f"Bad row repeat at x={x}, y={y}")
+                    for i in range(y, y + count):
+                        current_pen = picorle_draw_indices(
+                            above, 0, width, left, i, palette, current_pen)
+                    # The row above is still the row above.
+                    y += count - 1
+                    repeated = True
+                    break
+                i = x - left
+                current_pen = picorle_draw_indices(
+                    above, i, count, x, y, palette, current_pen)
+                row_view[i:i + count] = above_view[i:i + count]
+                x += count
+            elif token & 0x80:
+                count = token & unspan_field
+                if count == 0:
+                    count = unspan_field + 1 + picorle_read_varint(reader)
+                packed_left = ((count * bits) + 7) >> 3
+                pos = reader.pos
+                acc = 0
+                acc_bits = 0
+                for i in range(x, x + count):
+                    if acc_bits < bits:
+                        if pos >= reader.end:
+                            # Top up, in chunks the buffer can hold.
+                            reader.pos = pos
+                            if not reader.ensure(min(packed_left,
+                                                     _PRI_BUFFER_SIZE)):
+                                raise ValueError(
+                                    f"File truncated after x={i}, y={y}")
+                            pos = reader.pos
+                        acc |= buf[pos] << acc_bits
+                        acc_bits += 8
+                        pos += 1
+                        packed_left -= 1
+                    index = acc & mask
+                    acc >>= bits
+                    acc_bits -= bits
+                    if row_ops:
+                        row[i - left] = index
+                    pen = palette[index]
+                    if pen != current_pen:
+                        display.set_pen(pen)
+                        current_pen = pen
+                    display.pixel(i, y)
+                reader.pos = pos
+                x += count
+            else:
+                count = (token >> 4) + 1
+                if count == 8:
+                    count += picorle_read_varint(reader)
+                index = token & 0x0F
+                if row_ops:
+                    row_view[x - left:x - left + count] = fills[index][0:count]
+                pen = palette[index]
+                if pen != current_pen:
+                    display.set_pen(pen)
+                    current_pen = pen
+                display.pixel_span(x, y, count)
+                x += count
+        if row_ops and not repeated:
+            (above, row) = (row, above)
+            (above_view, row_view) = (row_view, above_view)
+        y += 1
+
+    print(f"...PRI{version} decoded!")
+
+# Custom type of a response telling us to show something from our content
+# cache; the body is the content hash.
+_CACHED_TYPE = "application/x.paperthin-cached"
+# Custom type of a response that's a PRI of only part of the display, to draw
+# over the image named by X-Patch-Base at the X-Patch-Offset "x,y".
+_PATCH_TYPE = "image/x.pico-rle-patch"
+# How many hashes we'll offer the server, to keep the request header sane.
+_CONTENT_CACHE_MAX_ENTRIES = 32
+# File extensions for each cacheable type.
+_CACHEABLE_TYPES = {
+    "image/x.pico-rle": "pri",
+    "image/png": "png",
+    "image/jpeg": "jpg",
+}
+
+class ContentCache:
+    """Images kept on flash (or SD), keyed by a server-provided hash.
+
+    The server tags images with an X-Content-Hash header, and we tell it which
+    hashes we hold in X-PaperThin-Cached; it can then answer with a tiny
+    _CACHED_TYPE response instead of resending an image. Entries are evicted
+    least-recently-used to stay within a byte budget. The index is a text file
+    of "hash extension size dither" lines, oldest first."""
+    def __init__(self, directory: str, budget: int) -> None:
+        self.directory = directory
+        self.budget = budget
+        self.index_name = directory + "/index.txt"
+        self.entries: list[list] = []
+        try:
+            os.mkdir(directory)
+        except OSError:
+            pass  # Probably already exists.
+        try:
+            with open(self.index_name) as index_file:
+                for line in index_file:
+                    fields = line.split()
+                    if len(fields) == 4:
+                        self.entries.append([fields[0], fields[1],
+                                             int(fields[2]), fields[3] == "1"])
+        except (OSError, ValueError):
+            self.entries = []
+
+    def save(self) -> None:
+        with open(self.index_name, "w") as index_file:
+            for (content_hash, extension, size, dither) in self.entries:
+                index_file.write(f"{content_hash} {extension} {size} "
+                                 f"{1 if dither else 0}\n")
+
+    def path(self, content_hash: str, extension: str) -> str:
+        return f"{self.directory}/{content_hash}.{extension}"
+
+    def hashes(self) -> list[str]:
+        """Hashes we hold, most recently used first."""
+        return [entry[0] for entry in reversed(self.entries)]
+
+    def find(self, content_hash: str) -> typing.Optional[list]:
+        """Look up an entry, and mark it most recently used."""
+        for i, entry in enumerate(self.entries):
+            if entry[0] == content_hash:
+                if i != len(self.entries) - 1:
+                    self.entries.append(self.entries.pop(i))
+                    self.save()
+                return entry
+        return None
+
+    def forget(self, content_hash: str) -> None:
+        for i, entry in enumerate(self.entries):
+            if entry[0] == content_hash:
+                self.entries.pop(i)
+                try:
+                    os.remove(self.path(entry[0], entry[1]))
+                except OSError:
+                    pass
+                self.save()
+                return
+
+    def make_room(self, size: int) -> bool:
+        """Evict until size more bytes fit; False if they never could."""
+        if size > self.budget:
+            return False
+        used = sum(entry[2] for entry in self.entries)
+        while self.entries and (
+            used + size > self.budget or
+            len(self.entries) >= _CONTENT_CACHE_MAX_ENTRIES):
+            oldest = self.entries.pop(0)
+            used -= oldest[2]
+            try:
+                os.remove(self.path(oldest[0], oldest[1]))
+            except OSError:
+                pass
+        return True
+
+    def add(self, content_hash: str, extension: str, size: int, dither: bool,
+            temp_name: str) -> None:
+        """Move a completely written file into the cache."""
+        self.forget(content_hash)
+        os.rename(temp_name, self.path(content_hash, extension))
+        self.entries.append([content_hash, extension, size, dither])
+        self.save()
+        print(f"...cached as {content_hash}.")
+
+def content_cache_dir() -> str:
+    if _CONTENT_CACHE_DIR is not None:
+        return _CONTENT_CACHE_DIR
+    try:
+        os.stat("/sd")
+        return "/sd/paperthin-cache"
+    except OSError:
+        return "paperthin-cache"
+
+class TeeStream:
+    """Wraps a socket so everything readinto() reads is also written out."""
+    def __init__(self, stream: usocket.socket, copy) -> None:
+        self.stream = stream
+        self.copy = copy
+
+    def readinto(self, buf) -> int:
+        got = self.stream.readinto(buf)
+        if got:
+            self.copy.write(buf[0:got])
+        return got
+
 def maybe_buffer_to_file(size: int, socket: usocket.socket) -> bool:
     """Read all the data to a file, if large enough, and return True."""
     if size > _TEMPFILE_THRESHOLD:
         print(f"{size} bytes is too large, buffering to flash!")
         buf = bytearray(1024)
+        view = memoryview(buf)
         with open(_TEMPFILE_NAME, "wb") as buf_file:
-            while socket.readinto(buf) != 0:
-                buf_file.write(buf)
+            while True:
+                got = socket.readinto(buf)
+                if not got:
+                    break
+                buf_file.write(view[0:got])
         del buf
         gc.collect()
         return True
@@ -510,12 +1031,13 @@ def maybe_double_clear() -> None:
         # Clear to a random solid colour; these are 0 (black) to 6 (orange)
         display.set_pen(random.randint(0, 6))
         display.clear()
-        display.update()
+        timed_update()
         print("...proceeding to update framebuffer...")
 
 def display_using_decoder(headers: typing.Dict[str, str],
                           socket: usocket.socket,
                           decoder,
+                          cache_entry: typing.Optional[list] = None,
                           **decoder_args: typing.Dict[str, typing.Any]) -> None:
     size: int = int(headers.get("Content-Length", 0))
     too_big = maybe_buffer_to_file(size, socket)
@@ -533,20 +1055,87 @@ def display_using_decoder(headers: typing.Dict[str, str],
     gc.collect()
     maybe_double_clear()
     decoder.decode(0, 0, **decoder_args)
+    if cache_entry is not None:
+        (content_hash, extension, _, dither) = cache_entry
+        if not too_big:
+            with open(_TEMPFILE_NAME, "wb") as buf_file:
+                buf_file.write(data)
+            too_big = True  # So it's tidied up if caching fails.
+        content_cache.add(content_hash, extension, size, dither,
+                          _TEMPFILE_NAME)
+        too_big = False  # It's been moved into the cache.
     if too_big:
         os.remove(_TEMPFILE_NAME)
 
+def display_pri(stream, size: int,
+                cache_entry: typing.Optional[list] = None) -> None:
+    """Decode PRI straight to the display, optionally keeping a copy."""
+    if cache_entry is None:
+        picorle_decode(stream, size)
+        return
+    temp_name = _TEMPFILE_NAME + ".pri"
+    try:
+        with open(temp_name, "wb") as copy:
+            picorle_decode(TeeStream(stream, copy), size)
+    except Exception:
+        os.remove(temp_name)
+        raise
+    (content_hash, extension, _, dither) = cache_entry
+    content_cache.add(content_hash, extension, size, dither, temp_name)
+
+def display_cached(content_hash: str) -> bool:
+    """Display an image from the content cache, if we still have it."""
+    entry = content_cache.find(content_hash)
+    if entry is None:
+        # We shouldn't have offered it; leave the screen alone.
+        print(f"Server asked for cached {content_hash}, but it's gone!")
+        return False
+    (_, extension, size, dither) = entry
+    path = content_cache.path(content_hash, extension)
+    print(f"Rendering cached {path}...")
+    inky_frame.led_wifi.brightness(_WIFI_LED_DECODING_BRIGHTNESS)
+    try:
+        if extension == "pri":
+            maybe_double_clear()
+            with open(path, "rb") as cached:
+                picorle_decode(cached, size)
+        else:
+            if extension == "png":
+                decoder = pngdec.PNG(display)
+                mode = pngdec.PNG_DITHER if dither else pngdec.PNG_POSTERISE
+                decoder_args = {"mode": mode}
+            else:
+                decoder = jpegdec.JPEG(display)
+                decoder_args = {"dither": dither}
+            decoder.open_file(path)
+            maybe_double_clear()
+            decoder.decode(0, 0, **decoder_args)
+    except (OSError, ValueError):
+        # Corrupt or missing; make sure the server sends it properly next time.
+        content_cache.forget(content_hash)
+        raise
+    return True
+
 def display_response(headers: typing.Dict[str, str],
-                     socket: usocket.socket) -> None:
-    """Display one of the supported HTTP responses."""
+                     socket: usocket.socket) -> bool:
+    """Display one of the supported HTTP responses; False if it was a no-op."""
     type: str = headers.get("Content-Type", "")
     type = type.split(";", 1)[0]  # Ignore any MIME options (UTF-8 or bust!)
     size: int = int(headers.get("Content-Length", 0))
+    dither = (headers.get("X-Dither", "") != "")
     if size == 0:
         # Ah, we've been told it's a no-op.
         print("No-op response.")
-        return
-    elif type == "text/plain":
+        return False
+    # Keep a copy of this if the server gave us a hash, and it can fit. Only
+    # whole images are kept (patches and replays aren't _CACHEABLE_TYPES), so
+    # this only evicts older ones for something that will be stored.
+    cache_entry = None
+    content_hash = headers.get("X-Content-Hash")
+    if (content_hash is not None and type in _CACHEABLE_TYPES and
+        content_cache.make_room(size)):
+        cache_entry = [content_hash, _CACHEABLE_TYPES[type], size, dither]
+    if type == "text/plain":
         print("Rendering plaintext...")
         display.set_pen(inky_frame.WHITE)
         display.clear()
@@ -555,19 +1144,34 @@ def display_response(headers: typing.Dict[str, str],
         text = socket.read(size).decode()
         display.text(text, 4, 4,
                      wordwrap=display_w-8, scale=2, fixed_width=True)
+    elif type == _CACHED_TYPE:
+        if not display_cached(socket.read(size).decode().strip()):
+            return False
+    elif type == _PATCH_TYPE:
+        base_hash = headers.get("X-Patch-Base")
+        if base_hash != framebuffer_hash:
+            # Not still in RAM (we've been asleep), so redraw it from flash.
+            print(f"Restoring {base_hash} to patch over...")
+            if not display_cached(base_hash):
+                return False
+        # Else it's still there, so no maybe_double_clear(); that'd wipe it.
+        left, top = headers.get("X-Patch-Offset", "0,0").split(",", 1)
+        print(f"Rendering partial update at {left},{top}...")
+        inky_frame.led_wifi.brightness(_WIFI_LED_DECODING_BRIGHTNESS)
+        picorle_decode(socket, size, int(left), int(top))
+        socket.close()
     elif type == "image/jpeg":
         # This is a little painful, because we can't stream to the deocder.
         print("Rendering JPEG...")
         decoder = jpegdec.JPEG(display)
-        dither = (headers.get("X-Dither", "") != "")
-        display_using_decoder(headers, socket, decoder, dither=dither)
+        display_using_decoder(headers, socket, decoder, cache_entry,
+                              dither=dither)
     elif type == "image/png":
         # Ditto.
         print("Rendering PNG...")
         decoder = pngdec.PNG(display)
-        dither = (headers.get("X-Dither", "") != "")
         mode = pngdec.PNG_DITHER if dither else pngdec.PNG_POSTERISE
-        display_using_decoder(headers, socket, decoder, mode=mode)
+        display_using_decoder(headers, socket, decoder, cache_entry, mode=mode)
     elif type == "image/x.pico-rle":
         # While slow and dumb, this format streams directly to the display.
         if _DOUBLE_UPDATE_CLEAR:
@@ -580,14 +1184,15 @@ def display_response(headers: typing.Dict[str, str],
             socket.settimeout(_HTTP_TIMEOUT + 40)
         inky_frame.led_wifi.brightness(_WIFI_LED_DECODING_BRIGHTNESS)
         maybe_double_clear()
-        picorle_decode(socket)
+        display_pri(socket, size, cache_entry)
         socket.close()
     else:
         # This is *really* borderline use of "fatal", but.
         red_screen_of_death(f"Cannot display server response of type '{type}'!",
                             True)
     print("...done!")  # Should flush.
-    display.update()
+    timed_update()
+    return True
 
 # Ok. Time to do stuff. Reset LEDs and get us online.
 # Read the initial button state BEFORE doing things that take time.
@@ -611,7 +1216,12 @@ if not on_usb_power:
     # re-reading voltage anyway, so even forcing a read here (which will get
     # you a sensible 5v-ish) will rapidly become stale.
 # Get us online.
+connect_start = time.ticks_ms()
 wlan = connect_wifi_or_die()
+cycle_ms["connect"] = time.ticks_diff(time.ticks_ms(), connect_start)
+content_cache = ContentCache(content_cache_dir(), _CONTENT_CACHE_BUDGET)
+# Hash of what's in the PicoGraphics framebuffer; lost if we sleep.
+framebuffer_hash: typing.Optional[str] = None
 
 # Figure out when it is.
 inky_frame.pcf_to_pico_rtc()
@@ -664,6 +1274,15 @@ while True:
             url = maybe_wakeup_url
 
     headers = {}  # User-Agent is set in our own http_request().
+    cached_hashes = content_cache.hashes()
+    if cached_hashes:
+        headers["X-PaperThin-Cached"] = ",".join(cached_hashes)
+    shown_hash = get_shown_hash()
+    if shown_hash is not None:
+        headers["X-PaperThin-Showing"] = shown_hash
+        # We can take a partial update over it if we can draw it again.
+        if shown_hash == framebuffer_hash or shown_hash in cached_hashes:
+            headers["X-PaperThin-Base"] = shown_hash
     query_params = {
         "hostname": _HOSTNAME,
         "w": str(display_w),
@@ -673,6 +1292,7 @@ while True:
         query_params["error"] = error
     if voltage is not None:
         query_params["v"] = str(voltage)
+    query_params.update(get_last_timings())
     # We don't have urllib.parse on the Inky Frame, else this could be:
     # url = url + "?" + urllib.parse.urlencode(query_args)
     encoded_query_params = form_urlencode(query_params)
@@ -683,6 +1303,7 @@ while True:
 
     # Do the fetch.
     inky_frame.led_wifi.brightness(_WIFI_LED_FETCHING_BRIGHTNESS)
+    fetch_start = time.ticks_ms()
     try:
         # I'm not entirely convinced this can succeed on retry if it fails.
         attempts = 5
@@ -708,6 +1329,7 @@ while True:
         print("Forgetting any saved wakeup URL in case it's bad.")
         set_wakeup_url(None)
         red_screen_of_death(f"Failed to {method} {url}:\n\n{e}", True, e)
+    cycle_ms["fetch"] = time.ticks_diff(time.ticks_ms(), fetch_start)
 
     # Parse the response.
     reload_time = None  # seconds
@@ -726,11 +1348,20 @@ while True:
         # error handler and set up for a restart. Grab as much free memory as
         # we can first.
         gc.collect()
-        display_response(response_headers, response_socket)
+        display_start = time.ticks_ms()
+        shown = display_response(response_headers, response_socket)
+        cycle_ms["decode"] = (time.ticks_diff(time.ticks_ms(), display_start) -
+                              cycle_ms.get("refresh", 0))
+        if shown:
+            framebuffer_hash = response_headers.get("X-Content-Hash")
+            set_shown_hash(framebuffer_hash)
     except Exception as e:
         red_screen_of_death(f"Unhandled exception rendering response:\n\n{e}",
                             True, e)
     response_socket.close()  # Possibly a double-close, but should be safe.
+    # For the next cycle to report; on USB, it won't need to connect again.
+    save_timings()
+    cycle_ms.clear()
     inky_frame.led_wifi.brightness(_WIFI_LED_STANDBY_BRIGHTNESS)
     inky_frame.button_a.led_off()
     inky_frame.button_b.led_off()
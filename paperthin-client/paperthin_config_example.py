@@ -59,4 +59,15 @@ _WIFI_FORCE_RECONNECT = True
 # necessary when only powering from the battery connector.
 # https://forums.pimoroni.com/t/inky-frame-7-3-burn-in/24574
 # Error screens ignore this; they're delayed enough as it is.
-_DOUBLE_UPDATE_CLEAR = False
\ No newline at end of file
+_DOUBLE_UPDATE_CLEAR = False
+# Read PRI responses from the socket on the RP2040's second core, while the
+# first decodes and draws them, rather than taking turns. Experimental: the
+# wireless stack isn't known to be happy being used from the second core, and
+# nothing else may be running a thread there.
+_PRI_READER_THREAD = False
+# Keep recently shown images, so the server can tell us to show one again
+# rather than resending it. None picks "/sd/paperthin-cache" if you've mounted
+# an SD card at /sd, else "paperthin-cache" on flash.
+_CONTENT_CACHE_DIR = None
+# Maximum bytes of images to keep; set to 0 to disable the cache.
+_CONTENT_CACHE_BUDGET = 256 * 1024
@@ -1,7 +1,13 @@
+import asyncio
+import battery
+import cadence
 import flask
+import inspect
 import os
 import paperutils
 import random
+import rawstore
+import rendercache
 from PIL import Image
 
 have_overlay = True
@@ -12,6 +18,23 @@ except ModuleNotFoundError:
     have_overlay = False
 # ImportError, however, means customization was attempted and is bad.
 # Let it propagate.
+try:
+    import httpcache
+except ModuleNotFoundError:
+    # It needs requests, which only overlays that scrape do.
+    httpcache = None
+
+# Optional pre-decoded images; see rawstore-cli.py.
+_PREDECODED_DIR = "predecoded"
+# Decoded sources and finished pictures, shared by all workers and display
+# sizes; see rendercache.py. Set to None to do without.
+_RENDER_CACHE_DIR: str|None = "rendercache"
+
+# Get the one-off setup out of the way now, so that with gunicorn --preload
+# workers fork with it done instead of each paying for it on first request.
+paperutils.warm_up()
+if have_overlay and hasattr(overlay, 'warm_up'):
+    overlay.warm_up()
 
 app = flask.Flask(__name__)
 
@@ -47,37 +70,183 @@ def button_e():
 def heartbeat():
     return "", 204
 
-def button(index: int, request: flask.Request) -> flask.Response:
-    if have_overlay and hasattr(overlay, 'button_override'):
-        maybe_response = overlay.button_override(index, request)
-        if maybe_response:
-            return maybe_response
-    directory = os.path.join("responses", "abcde"[index])
+@app.route("/metrics")
+def metrics():
+    body = cadence.metrics() + battery.metrics()
+    if httpcache is not None:
+        body += httpcache.metrics()
+    response = flask.make_response(body)
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+def load_fitted(index: int, directory: str, filename: str,
+                request: flask.Request) -> Image.Image:
+    """Load a source image fitted to the display, pre-decoded if possible."""
+    return load_fitted_to(index, directory, filename,
+                          *paperutils.display_size(request))
+
+def load_fitted_to(index: int, directory: str, filename: str,
+                   want_w: int, want_h: int) -> Image.Image:
+    """load_fitted() for explicit dimensions, rather than a request's."""
+    mapped = rawstore.open_if_fresh(_PREDECODED_DIR, "abcde"[index],
+                                    directory, filename, want_w, want_h)
+    if mapped is not None:
+        # The mapping is shared between workers; this is our private copy, but
+        # at memcpy speed rather than decode and resize.
+        fitted_im = mapped.convert('RGB')
+        mapped.close()
+        return fitted_im
+    if _RENDER_CACHE_DIR is not None:
+        return rendercache.load_fitted_to(_RENDER_CACHE_DIR,
+                                          os.path.join(directory, filename),
+                                          want_w, want_h)
+    # Oversized sources are decoded at reduced resolution, not shrunk after
+    # the fact.
+    im = Image.open(os.path.join(directory, filename))
+    fitted_im = paperutils.load_and_fit_to(im, want_w, want_h)
+    if fitted_im is not im:
+        im.close()
+    return fitted_im
+
+def call_hook(result):
+    """Finish an overlay hook's result, if it was an async def."""
+    if inspect.isawaitable(result):
+        return asyncio.run(result)
+    return result
+
+def choose_file(index: int, request: flask.Request
+                ) -> tuple[str, str]|flask.Response:
+    """A random file from a button's directory, or an error response.
+
+    If there is a responses/WIDTHxHEIGHT/ directory for the display asking,
+    as picorle-cli.py --batch makes, its button directory is used instead."""
+    (want_w, want_h) = paperutils.display_size(request)
+    directory = os.path.join("responses", f"{want_w}x{want_h}", "abcde"[index])
+    if not os.path.isdir(directory):
+        directory = os.path.join("responses", "abcde"[index])
     try:
-        filename = random.choice(os.listdir(directory))
+        return (directory, random.choice(os.listdir(directory)))
     except FileNotFoundError:
         return paperutils.respond_txt("Directory for that button is missing")
     except IndexError:
         return paperutils.respond_txt("Directory for that button has no files")
-    response: flask.Response
-    refresh_time = None
-    if filename.lower().endswith(('jpg', 'png', 'pri')):
-        with Image.open(os.path.join(directory, filename)) as im:
-            if have_overlay and hasattr(overlay, 'overlay'):
-                (overlaid_im, refresh_time) = overlay.overlay(im, request)
-            else:
-                overlaid_im = im.copy()
-            response = paperutils.encode_for_inky(overlaid_im, request)
-            overlaid_im.close()
-    else:
-        response = paperutils.respond_file(directory, filename, True)
 
+def is_image(filename: str) -> bool:
+    """Whether a response file needs encoding, rather than sending as-is."""
+    return filename.lower().endswith(('jpg', 'png'))
+
+def respond_file(directory: str, filename: str) -> flask.Response:
+    # Flask would resolve a relative directory against the app's location,
+    # not the working directory we listed it from.
+    return paperutils.respond_file(os.path.abspath(directory), filename, True)
+
+def send_less(response: flask.Response, request: flask.Request
+              ) -> flask.Response:
+    """Don't make the client redraw what it's showing, resend what it has, or
+    send the parts of the picture that haven't changed."""
+    response = paperutils.skip_unchanged(response, request)
+    response = paperutils.offer_cached(response, request)
+    return paperutils.offer_patch(response, request)
+
+def finish(response: flask.Response, request: flask.Request,
+           refresh_time: int|None) -> flask.Response:
+    response = send_less(response, request)
     if refresh_time is None:
-        # 10 minutes less one, for PRI decode and e-ink refresh.
-        refresh_time = 540
+        # Every 10 minutes, less the client's own decode and e-ink refresh.
+        refresh_time = cadence.refresh_after(request)
+    refresh_time = battery.stretch_refresh(refresh_time, request)
     if response.headers.get('Refresh') is None:
         paperutils.add_refresh(response, refresh_time, request.base_url)
     return response
+
+def battery_notice(request: flask.Request) -> flask.Response|None:
+    """A notice to charge the client, instead of its picture, if this is a
+    timed wake and its battery is all but empty."""
+    if request.method == 'POST' or battery.level(request) < battery.EMPTY:
+        return None
+    return finish(paperutils.respond_txt(battery.EMPTY_NOTICE), request,
+                  battery.EMPTY_REFRESH_SECONDS)
+
+def use_overlay(request: flask.Request) -> bool:
+    """Whether to draw the overlay; not if the battery is saving itself."""
+    return (have_overlay and hasattr(overlay, 'overlay') and
+            battery.level(request) < battery.SAVING)
+
+def render_cacheable(request: flask.Request) -> bool:
+    """Whether this request's picture can come from, and go in, the render
+    cache: it's for a PaperThin client, and nothing is drawn over it."""
+    return (_RENDER_CACHE_DIR is not None and
+            request.user_agent.string == "PaperThin/1" and
+            not use_overlay(request))
+
+def load_render(source: str, request: flask.Request
+                ) -> tuple[Image.Image, dict[str, tuple[bytes, float]]]|None:
+    """The cached dither_and_encode() of a source for this display, if any."""
+    if not render_cacheable(request):
+        return None
+    return rendercache.load_render(_RENDER_CACHE_DIR, source,
+                                   *paperutils.display_size(request),
+                                   paperutils.accepted_pri_versions(request))
+
+def save_render(source: str, request: flask.Request, dithered: Image.Image,
+                candidates: dict[str, tuple[bytes, float]]) -> None:
+    """Keep a dither_and_encode() of a source for this display, if allowed."""
+    if render_cacheable(request):
+        rendercache.save_render(_RENDER_CACHE_DIR, source,
+                                *paperutils.display_size(request),
+                                paperutils.accepted_pri_versions(request),
+                                dithered, candidates)
+
+def encode_for_inky(image: Image.Image, source: str, request: flask.Request,
+                    thrifty: bool) -> flask.Response:
+    """paperutils.encode_for_inky(), keeping the result in the render cache
+    if it's just the source fitted to the display."""
+    if not render_cacheable(request):
+        return paperutils.encode_for_inky(image, request, thrifty)
+    (dithered, candidates) = paperutils.dither_and_encode(
+        image, paperutils.accepted_pri_versions(request))
+    save_render(source, request, dithered, candidates)
+    return paperutils.respond_dithered(dithered, candidates, request, thrifty)
+
+def button(index: int, request: flask.Request) -> flask.Response:
+    cadence.record(request)
+    battery.record(request)
+    notice = battery_notice(request)
+    if notice is not None:
+        return notice
+    if have_overlay and hasattr(overlay, 'button_override'):
+        maybe_response = call_hook(overlay.button_override(index, request))
+        if maybe_response:
+            return send_less(maybe_response, request)
+    chosen = choose_file(index, request)
+    if isinstance(chosen, flask.Response):
+        return chosen
+    (directory, filename) = chosen
+    response: flask.Response
+    refresh_time = None
+    if is_image(filename):
+        source = os.path.join(directory, filename)
+        thrifty = battery.level(request) >= battery.LOW
+        rendered = load_render(source, request)
+        if rendered is not None:
+            return finish(paperutils.respond_dithered(*rendered, request,
+                                                      thrifty),
+                          request, None)
+        fitted_im = load_fitted(index, directory, filename, request)
+        if use_overlay(request):
+            (overlaid_im, refresh_time) = call_hook(
+                overlay.overlay(fitted_im, request))
+            # The overlay has its own copy; don't hold two frames at once.
+            if overlaid_im is not fitted_im:
+                fitted_im.close()
+        else:
+            # Encoding only reads the image, so needs no copy of its own.
+            overlaid_im = fitted_im
+        response = encode_for_inky(overlaid_im, source, request, thrifty)
+        overlaid_im.close()
+    else:
+        response = respond_file(directory, filename)
+    return finish(response, request, refresh_time)
     # Encoding findings:
     # inky_dither(suggested_enhance(im), use_wand=False)  # <-- Oversaturates
     # suggested_enhance(im)  # <-- Looks best
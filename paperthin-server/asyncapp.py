@@ -0,0 +1,160 @@
+# The PaperThin app again, with async views and image work in other processes.
+#
+# app.py handles one request per worker, start to finish, so a worker waiting
+# on a slow button_override() scrape or a Prometheus query in overlay() can't
+# do anything else, and the CPU-heavy decode, dither and encode only ever use
+# one core. Run this instead as a single worker with several threads:
+#
+#   gunicorn --workers 1 --threads 8 ... 'asyncapp:app'
+#
+# Each thread handles a request; decoding and fitting the source, then
+# dithering and PRI-encoding it, go to a shared, bounded pool of processes, so
+# up to _RENDER_PROCESSES pictures are worked on at once. Overlay hooks may be
+# async defs, and are awaited, so one can make several requests concurrently.
+#
+# Flask needs its async extra for this ("pip install flask[async]", or
+# python3-asgiref in Debian). Everything but the button routes is app.py's.
+
+import app as sync_app
+import asyncio
+import battery
+import cadence
+import concurrent.futures
+import flask
+import inspect
+import multiprocessing
+import os
+import paperutils
+import threading
+from PIL import Image
+
+# How many pictures to decode or encode at once. Each process holds a decoded
+# picture or two while it works.
+_RENDER_PROCESSES = os.cpu_count() or 1
+# Dither each picture in this many bands at once, rather than in one pass; see
+# paperutils.inky_dither_banded(). This makes a lone request faster on a
+# multi-core Pi, but the dither pattern (not the colors) differs from app.py's.
+_DITHER_BANDS = 1
+
+app = flask.Flask(__name__)
+app.add_url_rule("/", view_func=sync_app.index)
+app.add_url_rule("/hello", view_func=sync_app.hello)
+app.add_url_rule("/heartbeat", view_func=sync_app.heartbeat)
+app.add_url_rule("/metrics", view_func=sync_app.metrics)
+
+_pool: concurrent.futures.ProcessPoolExecutor|None = None
+_pool_lock = threading.Lock()
+
+def _start_render_process() -> None:
+    """Import app.py, and so overlay.py, before a render process does any
+    work, so that it dithers and encodes with whatever palettes and cost
+    tables the overlay set, as this worker does (and as the render cache's
+    keys say)."""
+    import app  # Only for what importing it does.
+
+async def in_pool(function, *args):
+    """Run a function in the render processes, started on first use.
+
+    By then this worker has threads, one of which might be holding a lock
+    (logging's, say, or PIL's) that a plain fork() would copy held into the
+    new process, forever. So they are forked from a clean forkserver process
+    instead, which has the app, overlay and image libraries imported
+    already."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['app'])
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                _RENDER_PROCESSES, mp_context=context,
+                initializer=_start_render_process)
+    return await asyncio.get_running_loop().run_in_executor(
+        _pool, function, *args)
+
+async def call_hook(result):
+    """Await an overlay hook's result, if it was an async def."""
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+async def encode_for_inky(image: Image.Image, source: str,
+                          request: flask.Request, thrifty: bool
+                          ) -> flask.Response:
+    """app.encode_for_inky(), dithering in the render processes."""
+    if request.user_agent.string != "PaperThin/1":
+        return paperutils.encode_for_inky(image, request, thrifty)
+    accepted = paperutils.accepted_pri_versions(request)
+    if _DITHER_BANDS <= 1:
+        (dithered, candidates) = await in_pool(paperutils.dither_and_encode,
+                                               image, accepted)
+    else:
+        pieces = paperutils.split_bands(image, _DITHER_BANDS)
+        dithered_bands = await asyncio.gather(*(
+            in_pool(paperutils.inky_dither, band) for (band, _, _) in pieces))
+        dithered = paperutils.join_bands(image.size, [
+            (band, top, skip)
+            for (band, (_, top, skip)) in zip(dithered_bands, pieces)])
+        candidates = await in_pool(paperutils.encode_dithered, dithered,
+                                   accepted)
+    sync_app.save_render(source, request, dithered, candidates)
+    # Chosen here, not in the pool, as offer_patch() needs the frame later.
+    return paperutils.respond_dithered(dithered, candidates, request, thrifty)
+
+async def button(index: int, request: flask.Request) -> flask.Response:
+    cadence.record(request)
+    battery.record(request)
+    notice = sync_app.battery_notice(request)
+    if notice is not None:
+        return notice
+    overlay = sync_app.overlay if sync_app.have_overlay else None
+    if hasattr(overlay, 'button_override'):
+        maybe_response = await call_hook(
+            overlay.button_override(index, request))
+        if maybe_response:
+            return sync_app.send_less(maybe_response, request)
+    chosen = sync_app.choose_file(index, request)
+    if isinstance(chosen, flask.Response):
+        return chosen
+    (directory, filename) = chosen
+    if not sync_app.is_image(filename):
+        return sync_app.finish(sync_app.respond_file(directory, filename),
+                               request, None)
+    source = os.path.join(directory, filename)
+    thrifty = battery.level(request) >= battery.LOW
+    rendered = sync_app.load_render(source, request)
+    if rendered is not None:
+        return sync_app.finish(paperutils.respond_dithered(
+            *rendered, request, thrifty), request, None)
+    refresh_time = None
+    fitted_im = await in_pool(sync_app.load_fitted_to, index, directory,
+                              filename, *paperutils.display_size(request))
+    if sync_app.use_overlay(request):
+        (overlaid_im, refresh_time) = await call_hook(
+            overlay.overlay(fitted_im, request))
+        if overlaid_im is not fitted_im:
+            fitted_im.close()
+    else:
+        overlaid_im = fitted_im
+    response = await encode_for_inky(overlaid_im, source, request, thrifty)
+    overlaid_im.close()
+    return sync_app.finish(response, request, refresh_time)
+
+@app.route("/a", methods=("GET", "POST"))
+async def button_a():
+    return await button(0, flask.request)
+
+@app.route("/b", methods=("GET", "POST"))
+async def button_b():
+    return await button(1, flask.request)
+
+@app.route("/c", methods=("GET", "POST"))
+async def button_c():
+    return await button(2, flask.request)
+
+@app.route("/d", methods=("GET", "POST"))
+async def button_d():
+    return await button(3, flask.request)
+
+@app.route("/e", methods=("GET", "POST"))
+async def button_e():
+    return await button(4, flask.request)
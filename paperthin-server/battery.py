@@ -0,0 +1,141 @@
+# Response shaping for PaperThin clients running low on battery.
+#
+# On battery, a client sends its VSYS voltage as the v query parameter every
+# time it wakes; on USB power it leaves it out. Each wake costs charge, mostly
+# in the e-ink refresh, so as the voltage falls the app steps through:
+#
+#   LOW:    Refresh intervals are stretched, and encode_for_inky() sends
+#           whatever the client will draw soonest, counting partial updates.
+#   SAVING: Also, overlay() isn't called, so a clock or caption doesn't force a
+#           redraw of a picture the display is already showing.
+#   EMPTY:  Timed wakes just get a notice to charge it and a long sleep.
+#           Button presses are still answered, but then also sleep long.
+#
+# The thresholds are compared against the median of the last few readings, so
+# one sagging read doesn't flip it back and forth. They suit the LiPo cells
+# sold for the Inky Frame; override them from overlay.py for other batteries,
+# e.g. "battery.LOW_VOLTS = 3.9".
+#
+# Like cadence.py, the history is per-process.
+
+import cadence
+import collections
+import flask
+import time
+import typing
+
+# The voltage below which each step applies.
+LOW_VOLTS = 3.6
+SAVING_VOLTS = 3.45
+EMPTY_VOLTS = 3.3
+# How many times longer to sleep once LOW.
+LOW_REFRESH_FACTOR = 3
+# How long to sleep once EMPTY.
+EMPTY_REFRESH_SECONDS = 24 * 60 * 60
+EMPTY_NOTICE = "Battery low!\nPlease charge me."
+
+(OK, LOW, SAVING, EMPTY) = range(4)
+# Readings to take the median of.
+_READINGS = 3
+# Readings kept per hostname, with when they were taken.
+_HISTORY = 48
+
+class _History:
+    def __init__(self) -> None:
+        self.readings: typing.Deque[typing.Tuple[float, float]] = (
+            collections.deque(maxlen=_HISTORY))
+        self.on_usb = False
+
+    def volts(self) -> typing.Optional[float]:
+        """Median of the latest readings, or None if on USB power."""
+        if self.on_usb or not self.readings:
+            return None
+        latest = sorted(v for (_, v) in list(self.readings)[-_READINGS:])
+        return latest[len(latest) // 2]
+
+    def volts_per_day(self) -> typing.Optional[float]:
+        """How fast the voltage has been falling (or rising), if it's been
+        on battery long enough to tell."""
+        if self.on_usb or len(self.readings) < 2:
+            return None
+        ((first_time, first_volts), (last_time, last_volts)) = (
+            self.readings[0], self.readings[-1])
+        if last_time - first_time < 60 * 60:
+            return None
+        return ((last_volts - first_volts) /
+                ((last_time - first_time) / (24 * 60 * 60)))
+
+_histories: typing.Dict[str, _History] = {}
+
+def record(request: flask.Request) -> None:
+    """Note the voltage a client reported, or that it's on USB power."""
+    hostname = request.args.get('hostname', '')
+    volts = request.args.get('v', type=float)
+    history = _histories.get(hostname)
+    if volts is None:
+        if history is not None:
+            # Charging, so whatever it read before is stale.
+            history.on_usb = True
+            history.readings.clear()
+        return
+    history = _histories.setdefault(hostname, _History())
+    history.on_usb = False
+    history.readings.append((time.time(), volts))
+
+def _level(volts: typing.Optional[float]) -> int:
+    if volts is None:
+        return OK
+    if volts < EMPTY_VOLTS:
+        return EMPTY
+    if volts < SAVING_VOLTS:
+        return SAVING
+    if volts < LOW_VOLTS:
+        return LOW
+    return OK
+
+def level(request: flask.Request) -> int:
+    """How far the requesting client is into the policy; OK if unknown."""
+    history = _histories.get(request.args.get('hostname', ''))
+    return _level(history.volts() if history is not None else None)
+
+def stretch_refresh(seconds: int, request: flask.Request) -> int:
+    """A Refresh time, lengthened as the client's battery runs down."""
+    current = level(request)
+    if current >= EMPTY:
+        return max(seconds, EMPTY_REFRESH_SECONDS)
+    if current >= LOW:
+        return seconds * LOW_REFRESH_FACTOR
+    return seconds
+
+def metrics() -> str:
+    """Per-hostname voltages in the Prometheus text exposition format."""
+    lines = [
+        '# HELP paperthin_battery_volts Battery voltage a client last '
+        'reported.',
+        '# TYPE paperthin_battery_volts gauge',
+    ]
+    for hostname, history in sorted(_histories.items()):
+        if history.readings:
+            (_, volts) = history.readings[-1]
+            lines.append(f'paperthin_battery_volts{{hostname='
+                         f'"{cadence.label(hostname)}"}} {volts:.3f}')
+    lines += [
+        '# HELP paperthin_battery_volts_per_day How fast a client\'s battery '
+        'voltage has been changing.',
+        '# TYPE paperthin_battery_volts_per_day gauge',
+    ]
+    for hostname, history in sorted(_histories.items()):
+        rate = history.volts_per_day()
+        if rate is not None:
+            lines.append(f'paperthin_battery_volts_per_day{{hostname='
+                         f'"{cadence.label(hostname)}"}} {rate:.4f}')
+    lines += [
+        '# HELP paperthin_battery_level Battery policy step a client is at: '
+        '0 ok, 1 low, 2 saving, 3 empty.',
+        '# TYPE paperthin_battery_level gauge',
+    ]
+    for hostname, history in sorted(_histories.items()):
+        lines.append(f'paperthin_battery_level{{hostname='
+                     f'"{cadence.label(hostname)}"}} '
+                     f'{_level(history.volts())}')
+    return '\n'.join(lines) + '\n'
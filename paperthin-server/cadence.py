@@ -0,0 +1,127 @@
+# Refresh scheduling from the timings PaperThin clients report.
+#
+# A client's Refresh countdown starts after it has finished painting, and the
+# next wake then spends time connecting, fetching, decoding and painting before
+# the new picture is up. So to change the picture every INTERVAL_SECONDS, the
+# Refresh time has to be that interval less all of those. Clients report how
+# long each phase took on their previous wake as connect_ms, fetch_ms,
+# decode_ms and refresh_ms query parameters; these are smoothed per hostname.
+#
+# On battery (when it sends v), the client can only sleep for whole minutes,
+# rounding its Refresh time down. So for those, the Refresh time is rounded to
+# a whole minute here instead, and what that added or dropped is carried over
+# to the next one, so that on average the picture still changes every
+# INTERVAL_SECONDS.
+#
+# The estimates are per-process, so each gunicorn worker learns its own; with
+# smoothing that's fine, as every worker sees every client eventually.
+
+import flask
+import typing
+
+# How often the display should change, by default.
+INTERVAL_SECONDS = 600
+PHASES = ('connect', 'fetch', 'decode', 'refresh')
+# Weight of each new report in the moving average.
+_SMOOTHING = 0.3
+# Booting MicroPython and reading the battery, before the client times anything.
+_UNMEASURED_SECONDS = 5.0
+# What we assume before a client has reported; this was the old fixed 540s.
+_DEFAULT_BUSY_SECONDS = 60.0
+# The client won't sleep for less than this anyway.
+_MINIMUM_REFRESH = 60
+
+class _Estimate:
+    def __init__(self) -> None:
+        self.smoothed: typing.Dict[str, float] = {}
+        self.last: typing.Dict[str, float] = {}
+        self.reports = 0
+
+    def update(self, phase: str, seconds: float) -> None:
+        self.last[phase] = seconds
+        if phase in self.smoothed:
+            self.smoothed[phase] += (_SMOOTHING *
+                                     (seconds - self.smoothed[phase]))
+        else:
+            self.smoothed[phase] = seconds
+
+    def busy_seconds(self) -> float:
+        if not all(phase in self.smoothed for phase in PHASES):
+            return _DEFAULT_BUSY_SECONDS
+        return _UNMEASURED_SECONDS + sum(self.smoothed.values())
+
+_estimates: typing.Dict[str, _Estimate] = {}
+# Seconds per hostname that whole-minute Refresh times have left out so far.
+_carried: typing.Dict[str, float] = {}
+
+def record(request: flask.Request) -> None:
+    """Fold the timings a client reported, if any, into its estimate."""
+    reported = {}
+    for phase in PHASES:
+        millis = request.args.get(f'{phase}_ms', type=int)
+        if millis is not None and millis >= 0:
+            reported[phase] = millis / 1000.0
+    if not reported:
+        return
+    hostname = request.args.get('hostname', '')
+    estimate = _estimates.setdefault(hostname, _Estimate())
+    estimate.reports += 1
+    for phase, seconds in reported.items():
+        if phase in ('decode', 'refresh') and reported.get('refresh') == 0:
+            # Nothing was drawn (an empty response), which says nothing about
+            # how long drawing takes.
+            continue
+        estimate.update(phase, seconds)
+
+def refresh_after(request: flask.Request,
+                  interval: int = INTERVAL_SECONDS) -> int:
+    """Refresh time for this client to change its picture every interval."""
+    hostname = request.args.get('hostname', '')
+    estimate = _estimates.get(hostname)
+    busy = (estimate.busy_seconds() if estimate is not None
+            else _DEFAULT_BUSY_SECONDS)
+    if request.args.get('v') is None:
+        # On USB power, the client counts down in seconds.
+        return max(_MINIMUM_REFRESH, round(interval - busy))
+    wanted = interval - busy + _carried.get(hostname, 0.0)
+    minutes = max(_MINIMUM_REFRESH // 60, round(wanted / 60))
+    # Rounding leaves at most half a minute either way; more means the
+    # minimum applied, and that shortfall can never be made up, so cap it.
+    _carried[hostname] = max(-60.0, min(60.0, wanted - minutes * 60))
+    return minutes * 60
+
+def label(value: str) -> str:
+    """A string escaped for a Prometheus label value, as metrics() uses."""
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+def metrics() -> str:
+    """Per-hostname timings in the Prometheus text exposition format."""
+    lines = [
+        '# HELP paperthin_phase_seconds Smoothed time a client spends on each '
+        'phase of a wake.',
+        '# TYPE paperthin_phase_seconds gauge',
+    ]
+    for hostname, estimate in sorted(_estimates.items()):
+        for phase, seconds in estimate.smoothed.items():
+            lines.append(f'paperthin_phase_seconds{{hostname='
+                         f'"{label(hostname)}",phase="{phase}"}} '
+                         f'{seconds:.3f}')
+    lines += [
+        '# HELP paperthin_phase_last_seconds Time a client last reported '
+        'spending on each phase of a wake.',
+        '# TYPE paperthin_phase_last_seconds gauge',
+    ]
+    for hostname, estimate in sorted(_estimates.items()):
+        for phase, seconds in estimate.last.items():
+            lines.append(f'paperthin_phase_last_seconds{{hostname='
+                         f'"{label(hostname)}",phase="{phase}"}} '
+                         f'{seconds:.3f}')
+    lines += [
+        '# HELP paperthin_timing_reports_total Timing reports from a client.',
+        '# TYPE paperthin_timing_reports_total counter',
+    ]
+    for hostname, estimate in sorted(_estimates.items()):
+        lines.append(f'paperthin_timing_reports_total{{hostname='
+                     f'"{label(hostname)}"}} {estimate.reports}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# Benchmark paperutils.inky_dither_banded() against a single inky_dither().
+#
+# For each size, the image is fitted to it and dithered once serially, then in
+# 1 to --processes bands on that many processes. It reports each time, the
+# speedup, and how the output differs from the serial one: the fraction of
+# pixels with a different ink, and the mean and largest difference in the
+# average color of an 8x8 block, as a fraction of full scale. Timings exclude
+# starting the processes, which a server would keep running.
+#
+# Copyright 2023 Philip Boulain.
+# Licensed under the EUPL-1.2-or-later.
+
+import argparse
+import concurrent.futures
+import json
+import paperutils
+import time
+from PIL import Image, ImageChops, ImageStat
+
+def parse_size(size: str) -> tuple[int, int]:
+    try:
+        w, h = size.lower().split('x', 1)
+        return (int(w), int(h))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'"{size}" is not WIDTHxHEIGHT')
+
+def best_of(repeat: int, function, *args) -> tuple[float, Image.Image]:
+    """Fastest of several runs, and the last result."""
+    fastest = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        fastest = min(fastest, time.perf_counter() - start)
+    return (fastest, result)
+
+def differing(serial: Image.Image, banded: Image.Image
+              ) -> tuple[float, float, float]:
+    """How banded output differs: the fraction of pixels with another ink,
+    and the mean and largest difference in a channel of an 8x8 block's
+    average color."""
+    # Compare ink indices, not whatever colors the palette gives them.
+    (serial_ink, banded_ink) = (Image.frombytes('L', im.size, im.tobytes())
+                                for im in (serial, banded))
+    with ImageChops.difference(serial_ink, banded_ink) as diff:
+        changed = 1.0 - (diff.histogram()[0] / (diff.width * diff.height))
+    # Error diffusion is chaotic, so any change upsets the pattern from there
+    # on; what should match is the color each area averages out to.
+    (serial_avg, banded_avg) = (im.convert('RGB').reduce(8)
+                                for im in (serial, banded))
+    with ImageChops.difference(serial_avg, banded_avg) as diff:
+        worst = max(high for (_, high) in diff.getextrema())
+        mean = sum(ImageStat.Stat(diff).mean) / 3
+    return (changed, mean / 255.0, worst / 255.0)
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description="Time inky_dither_banded() against inky_dither().")
+    arg_parser.add_argument("image", help="Image to dither")
+    arg_parser.add_argument("--size", type=parse_size, action="append",
+        help="Size to fit the image to as WIDTHxHEIGHT; repeatable "
+             "(default: 800x480, 1600x960 and 3200x1920)")
+    arg_parser.add_argument("--processes", type=int, default=4,
+        help="Most processes (and bands) to try (default: %(default)s)")
+    arg_parser.add_argument("--repeat", type=int, default=3,
+        help="Runs of each, taking the fastest (default: %(default)s)")
+    arg_parser.add_argument("--pil", action="store_true",
+        help="Dither with PIL's Floyd-Steinberg rather than ImageMagick's")
+    arg_parser.add_argument("--json", action="store_true",
+        help="Print the results as JSON")
+    args = arg_parser.parse_args()
+    sizes = args.size or [(800, 480), (1600, 960), (3200, 1920)]
+    use_wand = not args.pil
+
+    results = []
+    with Image.open(args.image) as source:
+        source = source.convert('RGB')
+        for (width, height) in sizes:
+            image = paperutils.resize_image_to(source, width, height)
+            (serial_s, serial) = best_of(args.repeat, paperutils.inky_dither,
+                                         image, False, use_wand)
+            for processes in range(1, args.processes + 1):
+                with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+                    # Start the processes before timing anything.
+                    list(pool.map(int, range(processes)))
+                    (banded_s, banded) = best_of(
+                        args.repeat, paperutils.inky_dither_banded, image,
+                        pool, processes, False, use_wand)
+                (changed, mean_block, worst_block) = differing(serial, banded)
+                results.append({
+                    "size": f"{width}x{height}",
+                    "processes": processes,
+                    "serial_seconds": serial_s,
+                    "banded_seconds": banded_s,
+                    "speedup": serial_s / banded_s,
+                    "changed_pixels": changed,
+                    "mean_block_difference": mean_block,
+                    "worst_block_difference": worst_block,
+                })
+                banded.close()
+            serial.close()
+            image.close()
+
+    if args.json:
+        print(json.dumps(results, indent=1))
+        return
+    print(f"{'size':>10} {'procs':>5} {'serial':>8} {'banded':>8} "
+          f"{'speedup':>7} {'changed':>7} {'mean 8x8':>8} {'worst 8x8':>9}")
+    for result in results:
+        print(f"{result['size']:>10} {result['processes']:>5} "
+              f"{result['serial_seconds']:8.3f} "
+              f"{result['banded_seconds']:8.3f} {result['speedup']:7.2f} "
+              f"{result['changed_pixels'] * 100:6.2f}% "
+              f"{result['mean_block_difference'] * 100:7.2f}% "
+              f"{result['worst_block_difference'] * 100:8.2f}%")
+
+if __name__ == "__main__":
+    main()
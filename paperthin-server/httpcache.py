@@ -0,0 +1,284 @@
+# A small on-disk HTTP cache for button_override() and friends that scrape
+# remote sources, so the same pages and pictures aren't re-downloaded on every
+# button press.
+#
+# Bodies are stored alongside their ETag/Last-Modified validators, and are
+# revalidated with If-None-Match/If-Modified-Since once Cache-Control max-age
+# (or Expires) says they are stale. Total body bytes are capped, evicting the
+# least-recently-used entries first. Writes are atomic renames, so several
+# gunicorn workers can share the same cache directory.
+#
+# This is not a general RFC 9111 implementation; it only handles GETs of 200
+# responses, ignores Vary, and treats private/public the same (it's all ours).
+#
+# Each cache's counters are per-process, like cadence.py's, and metrics()
+# reports those of every cache this process has made.
+
+import cadence
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import requests
+import tempfile
+import time
+import typing
+
+_DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Response headers worth keeping to rebuild a response from the cache.
+_KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control',
+                 'Expires', 'Date')
+
+# Every HTTPCache made in this process, for metrics().
+_caches: typing.List['HTTPCache'] = []
+
+def _parse_cache_control(value: str) -> typing.Dict[str, typing.Optional[str]]:
+    directives: typing.Dict[str, typing.Optional[str]] = {}
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '=' in part:
+            key, arg = part.split('=', 1)
+            directives[key.strip().lower()] = arg.strip().strip('"')
+        else:
+            directives[part.lower()] = None
+    return directives
+
+def _parse_http_date(value: typing.Optional[str]) -> typing.Optional[float]:
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def _freshness_lifetime(headers: typing.Mapping[str, str]
+                        ) -> typing.Optional[float]:
+    """Seconds the response may be used without revalidation, if known."""
+    directives = _parse_cache_control(headers.get('Cache-Control', ''))
+    if 'no-cache' in directives:
+        return 0.0
+    for key in ('s-maxage', 'max-age'):
+        if directives.get(key):
+            try:
+                return max(0.0, float(directives[key]))
+            except ValueError:
+                pass
+    expires = _parse_http_date(headers.get('Expires'))
+    if expires is not None:
+        date = _parse_http_date(headers.get('Date')) or time.time()
+        return max(0.0, expires - date)
+    return None
+
+class HTTPCache:
+    """Conditional-request cache wrapping a requests.Session."""
+
+    def __init__(self, directory: str,
+                 session: typing.Optional[requests.Session] = None,
+                 max_bytes: int = _DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.session = session if session is not None else requests.Session()
+        self.max_bytes = max_bytes
+        # Per-process counters, for monitoring.
+        self.stats = {
+            'hits': 0,  # Served fresh from disk, no network at all.
+            'misses': 0,  # Nothing usable on disk; full fetch.
+            'revalidated': 0,  # Stale, but the server said 304 Not Modified.
+            'refetched': 0,  # Stale, and the server sent a new body.
+            'stored': 0,
+            'evicted': 0,
+        }
+        os.makedirs(directory, exist_ok=True)
+        _caches.append(self)
+
+    def _paths(self, url: str) -> typing.Tuple[str, str]:
+        key = hashlib.sha256(url.encode()).hexdigest()
+        base = os.path.join(self.directory, key)
+        return f'{base}.json', f'{base}.body'
+
+    def _load(self, url: str
+              ) -> typing.Optional[typing.Tuple[typing.Dict[str, typing.Any],
+                                                bytes]]:
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            with open(body_path, 'rb') as body_file:
+                body = body_file.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url or meta.get('size') != len(body):
+            # Hash collision (ha) or a half-evicted entry; don't trust it.
+            return None
+        return meta, body
+
+    def _write_atomic(self, path: str, data: bytes) -> None:
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def _store(self, url: str, response: requests.Response) -> None:
+        directives = _parse_cache_control(
+            response.headers.get('Cache-Control', ''))
+        if 'no-store' in directives:
+            return
+        body = response.content
+        if len(body) > self.max_bytes:
+            return
+        meta = {
+            'url': url,
+            'size': len(body),
+            'stored_at': time.time(),
+            'headers': {key: response.headers[key] for key in _KEPT_HEADERS
+                        if key in response.headers},
+        }
+        meta_path, body_path = self._paths(url)
+        try:
+            # Body first, so a reader never sees metadata for a missing body
+            # (the size check in _load() covers the opposite race).
+            self._write_atomic(body_path, body)
+            self._write_atomic(meta_path, json.dumps(meta).encode())
+        except OSError:
+            logging.exception(f'Failed to cache {url}')
+            return
+        self.stats['stored'] += 1
+        self._evict()
+
+    def _touch(self, url: str) -> None:
+        # Metadata mtime is the LRU clock.
+        try:
+            os.utime(self._paths(url)[0])
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        """Drop least-recently-used entries until we're within max_bytes."""
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if not entry.name.endswith('.json'):
+                    continue
+                base = entry.path[:-len('.json')]
+                try:
+                    used = entry.stat().st_mtime
+                    size = os.stat(f'{base}.body').st_size
+                except OSError:
+                    continue
+                entries.append((used, size, base))
+                total += size
+        entries.sort()
+        for (_, size, base) in entries:
+            if total <= self.max_bytes:
+                break
+            for suffix in ('.json', '.body'):
+                try:
+                    os.remove(base + suffix)
+                except OSError:
+                    pass
+            total -= size
+            self.stats['evicted'] += 1
+
+    @staticmethod
+    def _build_response(url: str, meta: typing.Dict[str, typing.Any],
+                        body: bytes) -> requests.Response:
+        response = requests.Response()
+        response.url = url
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = requests.structures.CaseInsensitiveDict(
+            meta['headers'])
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers)
+        # Pretend we've already read it, so content/iter_lines() use this.
+        response._content = body
+        response._content_consumed = True
+        return response
+
+    def get(self, url: str, headers: typing.Optional[typing.Dict[str, str]]
+            = None, **kwargs) -> requests.Response:
+        """Like requests.Session.get(), but may be answered from the cache.
+
+        Non-200 responses are returned as-is (and not cached); use
+        raise_for_status() as usual. The body is always fully read, so any
+        stream=True argument only affects the underlying fetch."""
+        cached = self._load(url)
+        request_headers = dict(headers or {})
+        if cached is not None:
+            (meta, body) = cached
+            lifetime = _freshness_lifetime(meta['headers'])
+            if (lifetime is not None and
+                time.time() < meta['stored_at'] + lifetime):
+                self.stats['hits'] += 1
+                self._touch(url)
+                return self._build_response(url, meta, body)
+            if 'ETag' in meta['headers']:
+                request_headers['If-None-Match'] = meta['headers']['ETag']
+            if 'Last-Modified' in meta['headers']:
+                request_headers['If-Modified-Since'] = (
+                    meta['headers']['Last-Modified'])
+
+        response = self.session.get(url, headers=request_headers, **kwargs)
+        if cached is not None and response.status_code == 304:
+            (meta, body) = cached
+            # Take any updated freshness information from the 304.
+            for key in ('Cache-Control', 'Expires', 'Date', 'ETag'):
+                if key in response.headers:
+                    meta['headers'][key] = response.headers[key]
+            meta['stored_at'] = time.time()
+            meta_path, _ = self._paths(url)
+            try:
+                self._write_atomic(meta_path, json.dumps(meta).encode())
+            except OSError:
+                logging.exception(f'Failed to refresh cache entry for {url}')
+            self.stats['revalidated'] += 1
+            response.close()
+            return self._build_response(url, meta, body)
+
+        if cached is not None:
+            self.stats['refetched'] += 1
+        else:
+            self.stats['misses'] += 1
+        if response.status_code == 200:
+            self._store(url, response)
+        return response
+
+# How each way get() can go is reported, as the result label of one counter.
+_RESULTS = (('hits', 'hit'), ('misses', 'miss'),
+            ('revalidated', 'revalidated'), ('refetched', 'refetched'))
+
+def metrics() -> str:
+    """Every cache's counters in the Prometheus text exposition format,
+    labelled with its directory."""
+    lines = [
+        '# HELP paperthin_httpcache_requests_total Requests to a scraping '
+        'cache, by whether it had to go to the network.',
+        '# TYPE paperthin_httpcache_requests_total counter',
+    ]
+    for cache in _caches:
+        for (stat, result) in _RESULTS:
+            lines.append(f'paperthin_httpcache_requests_total{{cache='
+                         f'"{cadence.label(cache.directory)}",'
+                         f'result="{result}"}} {cache.stats[stat]}')
+    for (stat, help_text) in (('stored', 'Responses a scraping cache kept.'),
+                              ('evicted', 'Entries a scraping cache dropped '
+                                          'to stay within its size.')):
+        lines += [
+            f'# HELP paperthin_httpcache_{stat}_total {help_text}',
+            f'# TYPE paperthin_httpcache_{stat}_total counter',
+        ]
+        for cache in _caches:
+            lines.append(f'paperthin_httpcache_{stat}_total{{cache='
+                         f'"{cadence.label(cache.directory)}"}} '
+                         f'{cache.stats[stat]}')
+    return '\n'.join(lines) + '\n'
@@ -193,6 +193,18 @@ def overlay(image: Image.Image, request: flask.Request) -> typing.Tuple[Image.Im
     else:
         return image, None
 
+def warm_up() -> None:
+    # Called once at app import: have ImageMagick load our fonts now, so each
+    # worker doesn't on its first picture.
+    with paperutils.pil_to_wand(Image.new('RGB', (8, 8))) as wim:
+        with Drawing() as draw:
+            for font in ('Antonio-Bold.ttf', 'Mx437_Master_512.ttf'):
+                draw.font = font
+                draw.font_size = 24
+                draw.get_font_metrics(wim, "69")
+    with Image.new('RGB', (8, 8)) as tiny:
+        paperutils.caption(tiny, ' ').close()
+
 # Hacked-up get_metric_promethus from envsensors trend_display.
 # This is quick and dirty.
 
@@ -267,8 +279,9 @@ def button_override(index: int, request: flask.Request) -> flask.Response|None:
     if image is None:
         response = paperutils.respond_txt("Could not find wildlife image; see server log")
     else:
-        resized = paperutils.resize_image(image, request)
-        image.close()
+        resized = paperutils.load_and_fit(image, request)
+        if resized is not image:
+            image.close()
         image = paperutils.caption(resized, caption.split('.', 1)[0])
         resized.close()
         response = paperutils.encode_for_inky(image, request)
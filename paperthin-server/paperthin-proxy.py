@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# A buffering front proxy, so slow clients don't hold gunicorn workers.
+#
+# The client reads its response at the speed it can draw it, and with
+# _DOUBLE_UPDATE_CLEAR doesn't start reading for about 40 seconds. Behind a
+# sync gunicorn worker that means the worker is stuck in a blocking write for
+# the whole paint. Put this in front instead: it reads each response from
+# gunicorn over localhost as fast as gunicorn can send it, freeing the worker,
+# then trickles it out to the client from a single asyncio loop that doesn't
+# mind how many clients are slow.
+#
+# It only speaks as much HTTP as PaperThin does: one request per connection,
+# with a Content-Length body if any. Responses are held in memory in full,
+# which for PaperThin is at most a few hundred kilobytes each.
+#
+# Copyright 2023 Philip Boulain.
+# Licensed under the EUPL-1.2-or-later.
+
+import argparse
+import asyncio
+import logging
+
+# Longest request head we'll accept; PaperThin's are a few hundred bytes.
+_MAX_HEAD = 16 * 1024
+# Responses over this are refused rather than buffered.
+_MAX_RESPONSE = 16 * 1024 * 1024
+
+def parse_address(address: str) -> tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    try:
+        return (host or '127.0.0.1', int(port))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'"{address}" is not [HOST:]PORT')
+
+def rewrite_head(head: bytes, peer: str) -> tuple[bytes, int]:
+    """Make a request head safe to forward. Returns it and its body length.
+
+    The backend is told to close the connection after responding, so that
+    reading to EOF gets exactly one response, and who the client really was."""
+    lines = head.split(b'\r\n')
+    body_length = 0
+    kept = [lines[0]]
+    for line in lines[1:]:
+        if not line:
+            continue
+        name = line.split(b':', 1)[0].strip().lower()
+        if name == b'content-length':
+            body_length = int(line.split(b':', 1)[1])
+        if name in (b'connection', b'keep-alive', b'x-forwarded-for'):
+            continue
+        kept.append(line)
+    kept += [b'Connection: close', b'X-Forwarded-For: ' + peer.encode(),
+             b'', b'']
+    return (b'\r\n'.join(kept), body_length)
+
+def error_response(status: str, message: str) -> bytes:
+    body = (message + '\n').encode()
+    return (f'HTTP/1.0 {status}\r\nContent-Type: text/plain; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+            ).encode() + body
+
+async def fetch(backend: tuple[str, int], request: bytes, timeout: float
+                ) -> bytes:
+    """Send a request to the backend and read its whole response."""
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(*backend), timeout)
+    try:
+        writer.write(request)
+        await writer.drain()
+        response = bytearray()
+        while True:
+            more = await asyncio.wait_for(reader.read(64 * 1024), timeout)
+            if not more:
+                break
+            response += more
+            if len(response) > _MAX_RESPONSE:
+                raise ValueError('response too large to buffer')
+    finally:
+        writer.close()
+    return bytes(response)
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 args: argparse.Namespace) -> None:
+    peer = writer.get_extra_info('peername')
+    peer_host = peer[0] if peer else ''
+    try:
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                          args.request_timeout)
+            head, body_length = rewrite_head(head[:-4], peer_host)
+            body = await asyncio.wait_for(reader.readexactly(body_length),
+                                          args.request_timeout)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError, ValueError):
+            writer.write(error_response('400 Bad Request', 'Bad request'))
+            return
+        try:
+            response = await fetch(args.backend, head + body,
+                                   args.backend_timeout)
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            logging.warning('Backend failed for %s: %r', peer_host, e)
+            response = error_response('502 Bad Gateway',
+                                      'The PaperThin server is unavailable')
+        # This is the slow part, and it only costs us a buffer and a socket.
+        writer.write(response)
+        await asyncio.wait_for(writer.drain(), args.client_timeout)
+    except (OSError, asyncio.TimeoutError) as e:
+        logging.info('Gave up on %s: %r', peer_host, e)
+    finally:
+        writer.close()
+
+async def serve(args: argparse.Namespace) -> None:
+    server = await asyncio.start_server(
+        lambda reader, writer: handle(reader, writer, args),
+        args.bind[0], args.bind[1], limit=_MAX_HEAD)
+    logging.info('Proxying %s:%d to %s:%d', *args.bind, *args.backend)
+    async with server:
+        await server.serve_forever()
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description="Buffer PaperThin responses so slow clients don't hold "
+                    "server workers.")
+    arg_parser.add_argument("--bind", type=parse_address,
+        default=("0.0.0.0", 5000),
+        help="[HOST:]PORT to listen on for clients (default: 0.0.0.0:5000)")
+    arg_parser.add_argument("--backend", type=parse_address,
+        default=("127.0.0.1", 5001),
+        help="[HOST:]PORT of the gunicorn server (default: 127.0.0.1:5001)")
+    arg_parser.add_argument("--request-timeout", type=float, default=30.0,
+        help="Seconds to wait for a client to send its request "
+             "(default: %(default)s)")
+    arg_parser.add_argument("--backend-timeout", type=float, default=120.0,
+        help="Seconds to wait for the backend to respond, like gunicorn's "
+             "--timeout (default: %(default)s)")
+    arg_parser.add_argument("--client-timeout", type=float, default=600.0,
+        help="Seconds to allow a client to read its response "
+             "(default: %(default)s)")
+    arg_parser.add_argument("--verbose", action="store_true",
+        help="Log every connection that is given up on")
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    asyncio.run(serve(args))
+
+if __name__ == "__main__":
+    main()
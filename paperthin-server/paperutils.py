@@ -1,8 +1,18 @@
+import collections
+import concurrent.futures
 import flask
+import hashlib
 import io
+import itertools
+import logging
+import PIL
 import picorle
+import struct
+import time
 import wand.image  # Try --no-install-recommends with python3-wand in Debian.
-from PIL import Image, ImageEnhance
+import wand.version
+import zlib
+from PIL import Image, ImageChops, ImageEnhance
 from wand.color import Color
 from wand.drawing import Drawing
 
@@ -53,14 +63,56 @@ def add_refresh(response: flask.Response, seconds: int, url: str) -> None:
     response.headers.add('Refresh', f'{seconds}; {url}')
 
 def wand_to_pil(wand_image: wand.image.Image) -> Image.Image:
+    if not wand_image.alpha_channel:
+        # Raw RGB, which PIL wraps without copying again. (The result is
+        # read-only until PIL makes itself a copy to write to.)
+        depth = wand_image.depth
+        wand_image.depth = 8
+        rgb = wand_image.make_blob('rgb')
+        wand_image.depth = depth
+        return Image.frombuffer('RGB', wand_image.size, rgb,
+                                'raw', 'RGB', 0, 1)
     # The encode/decode here is kind of stupid, but.
     return Image.open(io.BytesIO(wand_image.make_blob('png')), formats=['PNG'])
 
 def pil_to_wand(pil_image: Image.Image) -> wand.image.Image:
+    if pil_image.mode == 'RGB':
+        # Raw pixels are one plain copy, rather than compressing a PNG and
+        # copying that about.
+        return wand.image.Image(blob=pil_image.tobytes(), format='rgb',
+                                width=pil_image.width,
+                                height=pil_image.height, depth=8)
     buf = io.BytesIO()
     pil_image.save(buf, format='PNG')
     return wand.image.Image(blob=buf.getvalue(), format='png')
 
+def _palette_image(use_taupe: bool) -> Image.Image:
+    """1-pixel-per-color image of the ink palette, for quantizing against."""
+    # Without taupe, only its last component is dropped, leaving a partial
+    # eighth color; that is how inky_dither() has always behaved.
+    ink_palette = _INK_PALETTE if use_taupe else _INK_PALETTE[:-1]
+    palimg = Image.new('P', (len(ink_palette), 1))
+    palimg.putpalette(ink_palette)
+    return palimg
+
+def _wand_palette_image(use_taupe: bool) -> wand.image.Image:
+    """_palette_image(), as inky_dither() needs it for ImageMagick."""
+    palimg = _palette_image(use_taupe)
+    # ImageMagick does not use the palette, it uses the *pixels*, because it
+    # is Like That. So set a pixel of each color, using PIL, because wand
+    # isn't really built for that.
+    for x in range(0, palimg.width):
+        palimg.putpixel((x, 0), x)
+    wand_palimg = pil_to_wand(palimg)
+    palimg.close()
+    # inky_dither() remaps in linear RGB; see there.
+    wand_palimg.transform_colorspace('rgb')
+    return wand_palimg
+
+# These are built once, by warm_up(), then only ever read.
+_palette_images: dict[bool, Image.Image] = {}
+_wand_palette_images: dict[bool, wand.image.Image] = {}
+
 def inky_dither(original: Image.Image, use_taupe = False, use_wand = True
                 ) -> Image.Image:
     """Dither an image down to the Inky palette."""
@@ -68,22 +120,17 @@ def inky_dither(original: Image.Image, use_taupe = False, use_wand = True
     # that. This instead dithers to some eyeballed approximations of the
     # actual ink colors, and then remaps that to the ones PicoGraphics will use
     # to try to stop it from misdithering the image again.
-    picographics_palette = _PICOGRAPHICS_PALETTE.copy()
-    ink_palette = _INK_PALETTE.copy()
-    if not use_taupe:
-        picographics_palette.pop()
-        ink_palette.pop()
-    palimg = Image.new('P', (len(ink_palette), 1))
-    palimg.putpalette(ink_palette)
+    picographics_palette = (_PICOGRAPHICS_PALETTE if use_taupe
+                            else _PICOGRAPHICS_PALETTE[:-1])
+    if use_taupe not in _palette_images:
+        _palette_images[use_taupe] = _palette_image(use_taupe)
+    palimg = _palette_images[use_taupe]
 
     if use_wand:
+        if use_taupe not in _wand_palette_images:
+            _wand_palette_images[use_taupe] = _wand_palette_image(use_taupe)
+        wand_palimg = _wand_palette_images[use_taupe]
         wand_img = pil_to_wand(original)
-        # ImageMagick does not use the palette, it uses the *pixels*, because it
-        # is Like That. So set a pixel of each color, using PIL, because wand
-        # isn't really built for that.
-        for x in range(0, len(ink_palette)):
-            palimg.putpixel((x, 0), x)
-        wand_palimg = pil_to_wand(palimg)
         # Try doing the remap in HSL space. See wand.image.COLORSPACE_TYPES.
         # Lots of these just break...LAB, HSV, YUV, even gray; the transform
         # is fine, but the remap is then busted...annoyingly ImageMagick
@@ -93,7 +140,6 @@ def inky_dither(original: Image.Image, use_taupe = False, use_wand = True
         # Detuning the red channel 4Ds to 0Ds in the green/blue inks doesn't
         # help much, but some gamma correction does, if a bit of a hack.
         wand_img.transform_colorspace('rgb')
-        wand_palimg.transform_colorspace(wand_img.colorspace)
         wand_img.gamma(1.2, channel='red')
         wand_img.gamma(0.9, channel='green')
         wand_img.gamma(0.9, channel='blue')
@@ -101,26 +147,107 @@ def inky_dither(original: Image.Image, use_taupe = False, use_wand = True
         # floyd_steinberg looks nicer than riemersma
         wand_img.remap(affinity=wand_palimg, method='floyd_steinberg')
         wand_img.transform_colorspace('srgb')  # If *this* is plain rgb, corrupt
+        # This comes out as RGB, so is wrapped rather than decoded; let
+        # ImageMagick's copy go before making our own palettized one.
         dithered = wand_to_pil(wand_img)
-        # ImageMagick will have output whatever colorspace it feels like; it may
-        # be a one-bit image, it may be palettized with different indicies. We'd
-        # quite like to use the right fixed palette, but to do *that* we first
-        # need to raise it up to RGB. It's all a bit of a farce.
-        dithered = dithered.convert('RGB')
+        wand_img.close()
+        if dithered.mode != 'RGB':
+            # With alpha, that came back as a PNG, which PIL won't quantize
+            # to a palette without converting it.
+            rgb = dithered.convert('RGB')
+            dithered.close()
+            dithered = rgb
+        # We'd quite like to use the right fixed palette, so map the colors
+        # ImageMagick picked back onto its indices.
         # This is spelled Image.Dither.NONE in newer PIL, but old is compatible.
         dithered = dithered.quantize(palette=palimg, dither=Image.NONE)
-        # Give the GC a hand.
-        wand_palimg.close()
-        wand_img.close()
+    elif original.mode != 'RGB':
+        with original.convert('RGB') as rgb:
+            dithered = rgb.quantize(palette=palimg)
     else:
         dithered = original.quantize(palette=palimg)
 
     # Forcefully remap indexwise to the palette.
     dithered.putpalette(picographics_palette)
-
-    palimg.close()
     return dithered
 
+# Rows above its own that each band of inky_dither_banded() starts from.
+_BAND_OVERLAP = 16
+
+def split_bands(image: Image.Image, bands: int,
+                overlap: int = _BAND_OVERLAP
+                ) -> list[tuple[Image.Image, int, int]]:
+    """Cut an image into horizontal bands to dither separately.
+
+    Each band starts overlap rows above the rows it is for, so that its
+    error diffusion has settled down by the time it gets to them. Returns
+    (band, top, skip) for each: the band's image, the row its kept part goes
+    at, and how many overlap rows to drop from its top once dithered."""
+    bands = max(1, min(bands, image.height // max(1, overlap)))
+    cuts = [image.height * band // bands for band in range(bands + 1)]
+    pieces = []
+    for (top, bottom) in zip(cuts, cuts[1:]):
+        start = max(0, top - overlap)
+        pieces.append((image.crop((0, start, image.width, bottom)),
+                       top, top - start))
+    return pieces
+
+def join_bands(size: tuple[int, int],
+               dithered: list[tuple[Image.Image, int, int]]) -> Image.Image:
+    """Reassemble split_bands() pieces, once dithered, into one image."""
+    joined = Image.new('P', size)
+    joined.putpalette(dithered[0][0].getpalette())
+    for (band, top, skip) in dithered:
+        with band.crop((0, skip, band.width, band.height)) as kept:
+            joined.paste(kept, (0, top))
+    return joined
+
+def inky_dither_banded(original: Image.Image,
+                       executor: concurrent.futures.Executor, bands: int,
+                       use_taupe = False, use_wand = True) -> Image.Image:
+    """inky_dither(), as bands run at the same time on an executor's processes.
+
+    Floyd-Steinberg carries each pixel's error rightwards and down, so the
+    bands can't reproduce a single pass exactly: each is an exact dither of
+    its own rows, but starts from no error _BAND_OVERLAP rows above its first
+    kept row. Error diffusion is chaotic, so from each cut down the ink pattern
+    generally differs from a single pass (a third or more of pixels), but the
+    colors it averages out to don't: the error carried into any area is
+    bounded the same way either way, so areas differ by about as much as any
+    two dithers of the same picture would. dither-bench.py measures this; at
+    800x480, 8x8 blocks' average colors differ by about 1% on average. The
+    output is deterministic for a given number of bands."""
+    pieces = split_bands(original, bands)
+    dithered = executor.map(inky_dither, [band for (band, _, _) in pieces],
+                            itertools.repeat(use_taupe),
+                            itertools.repeat(use_wand))
+    joined = join_bands(original.size, [
+        (band, top, skip)
+        for (band, (_, top, skip)) in zip(dithered, pieces)])
+    for (band, _, _) in pieces:
+        band.close()
+    return joined
+
+def warm_up() -> None:
+    """Do the one-off setup that would otherwise land on the first request.
+
+    Call this at import time, so that under gunicorn --preload it happens once
+    in the master and every worker forks with it done, sharing the memory
+    copy-on-write, rather than each recycled worker paying for it again: PIL's
+    format plugins, ImageMagick's coders and quantizer, and the palette images
+    inky_dither() reuses."""
+    Image.init()
+    for use_taupe in (False, True):
+        _palette_images[use_taupe] = _palette_image(use_taupe)
+        _wand_palette_images[use_taupe] = _wand_palette_image(use_taupe)
+    with Image.new('RGB', (8, 8), 'white') as tiny:
+        with inky_dither(tiny) as tiny_dithered:
+            encode_dithered(tiny_dithered, {3, 4})
+    # Sources and overlays with alpha take another route through ImageMagick;
+    # this also makes sure it still works before serving anything.
+    with Image.new('RGBA', (8, 8), (255, 255, 255, 128)) as tiny:
+        inky_dither(tiny).close()
+
 def plain_dither(original: Image.Image, use_taupe = False) -> Image.Image:
     """Dithered an image to the synthetic palette, uncorrected."""
     picographics_palette = _PICOGRAPHICS_PALETTE.copy()
@@ -139,36 +266,127 @@ def suggested_enhance(original: Image.Image) -> Image.Image:
     # Wand's level() seems to be the inverse of what we want.
     return ImageEnhance.Brightness(im).enhance(1.02)
 
-def resize_image(image: Image.Image, request: flask.Request) -> Image.Image:
-    """Resize an image to fit within the dimensions in the request."""
-    want_w = request.args.get('w', 800, type=int)
-    want_h = request.args.get('h', 480, type=int)
+def accepted_pri_versions(request: flask.Request) -> set[int]:
+    """Which PRI versions the client says it can decode, beyond 2."""
+    versions = set()
+    for accepted in request.headers.get('Accept', '').split(','):
+        (mimetype, _, params) = accepted.partition(';')
+        if mimetype.strip() != 'image/x.pico-rle':
+            continue
+        for param in params.split(';'):
+            (key, _, value) = param.partition('=')
+            if key.strip() == 'version' and value.strip().isdigit():
+                versions.add(int(value))
+    return versions
+
+def pri_versions(image: Image.Image, accepted: set[int]) -> list[int]:
+    """The PRI versions, of those accepted, that could encode this image."""
+    if picorle.can_encode_small_palette(image):
+        versions = [version for version in (3, 4) if version in accepted]
+        if versions:
+            return versions
+    return [2]
+
+def display_size(request: flask.Request) -> tuple[int, int]:
+    """The display dimensions the client asked for."""
+    return (request.args.get('w', 800, type=int),
+            request.args.get('h', 480, type=int))
+
+def fit_size(got_w: int, got_h: int, want_w: int, want_h: int
+             ) -> tuple[int, int]:
+    """Size to scale got_w x got_h to, to fit within want_w x want_h."""
     want_aspect = float(want_w) / float(want_h)
-    got_w = image.width
-    got_h = image.height
     got_aspect = float(got_w) / float(got_h)
-    w: int
-    h: int
     if got_aspect > want_aspect:
         # Width-constrained scaling
-        w = want_w
-        h = int(want_w / got_aspect)
+        return (want_w, int(want_w / got_aspect))
     else:
         # Height-constrained scaling
-        w = int(want_h * got_aspect)
-        h = want_h
-
-    resized = image.resize([w, h])
-    if resized.width != want_w or resized.height != want_h:
-        # Calculate the average color using another resize, then pad the image.
-        padding = image.resize([4, int(4 / want_aspect)])
-        padding = padding.resize([want_w, want_h])
-        offset_w = int((want_w - resized.width) / 2)
-        offset_h = int((want_h - resized.height) / 2)
-        padding.paste(resized, [offset_w, offset_h])
-        resized.close()
-        resized = padding
+        return (int(want_h * got_aspect), want_h)
+
+def resize_image(image: Image.Image, request: flask.Request) -> Image.Image:
+    """Resize an image to fit within the dimensions in the request."""
+    return resize_image_to(image, *display_size(request))
+
+# Pillow resizes horizontally first, into an image as wide as the result but
+# as tall as the source; doing a band of result rows at a time keeps that small.
+_RESIZE_BAND_ROWS = 64
+
+def resize_image_to(image: Image.Image, want_w: int, want_h: int
+                    ) -> Image.Image:
+    """Resize an image to fit within the given dimensions, padding as needed."""
+    (w, h) = fit_size(image.width, image.height, want_w, want_h)
+    if image.mode not in ('L', 'RGB', 'RGBA'):
+        return _pad_to(image.resize([w, h]), want_w, want_h)
+    if w == want_w and h == want_h:
+        resized = Image.new(image.mode, (w, h))
+    else:
+        resized = _padding(image, want_w, want_h)
+    offset_w = int((want_w - w) / 2)
+    offset_h = int((want_h - h) / 2)
+    scale = image.height / h
+    for top in range(0, h, _RESIZE_BAND_ROWS):
+        bottom = min(h, top + _RESIZE_BAND_ROWS)
+        band = image.resize([w, bottom - top], box=(0, top * scale,
+                                                    image.width,
+                                                    bottom * scale))
+        resized.paste(band, [offset_w, offset_h + top])
+        band.close()
+    return resized
+
+def _padding(image: Image.Image, want_w: int, want_h: int) -> Image.Image:
+    """A background of the image's average colours, for padding it out."""
+    # Calculate the average color using another resize. Do it from the
+    # already-shrunk image where there is one; the full-size one is no better
+    # for averaging and may be enormous.
+    want_aspect = float(want_w) / float(want_h)
+    average = image.resize([4, max(1, int(4 / want_aspect))])
+    padding = average.resize([want_w, want_h])
+    average.close()
+    return padding
+
+def _pad_to(resized: Image.Image, want_w: int, want_h: int) -> Image.Image:
+    """Pad an image that already fits to exactly the given dimensions.
+
+    Closes and replaces the image if it needed padding."""
+    if resized.width == want_w and resized.height == want_h:
+        return resized
+    padding = _padding(resized, want_w, want_h)
+    offset_w = int((want_w - resized.width) / 2)
+    offset_h = int((want_h - resized.height) / 2)
+    padding.paste(resized, [offset_w, offset_h])
+    resized.close()
+    return padding
 
+def load_and_fit(image: Image.Image, request: flask.Request) -> Image.Image:
+    """Decode a freshly-opened image at reduced size and fit it to the request.
+
+    This is resize_image() for images that have been Image.open()ed but not
+    yet loaded. JPEGs are decoded using DCT scaling at the smallest 1/2, 1/4 or
+    1/8 scale that is still at least the fitted size, and other formats are
+    box-reduced by an integer factor first, so a huge camera photo never exists
+    at full resolution in memory. Returns the image itself, loaded, if it
+    already matches the display size; otherwise a new image, and closing the
+    original remains the caller's job."""
+    return load_and_fit_to(image, *display_size(request))
+
+def load_and_fit_to(image: Image.Image, want_w: int, want_h: int
+                    ) -> Image.Image:
+    """load_and_fit() for explicit dimensions, rather than a request's."""
+    (fit_w, fit_h) = fit_size(image.width, image.height, want_w, want_h)
+    if image.format == 'JPEG':
+        # draft() only picks a scale where the result is still >= requested.
+        image.draft('RGB', (fit_w, fit_h))
+    image.load()
+    factor = min(image.width // max(1, fit_w), image.height // max(1, fit_h))
+    reduced = image
+    if factor >= 2 and image.mode in ('L', 'RGB', 'RGBA'):
+        reduced = image.reduce(factor)
+    if reduced.width == want_w and reduced.height == want_h:
+        return reduced
+    resized = resize_image_to(reduced, want_w, want_h)
+    if reduced is not image:
+        reduced.close()
     return resized
 
 def caption(image: Image.Image, caption: str) -> Image.Image:
@@ -195,25 +413,108 @@ def caption(image: Image.Image, caption: str) -> Image.Image:
     return image
 
 
+# PNG row filter types, from the PNG specification.
+_PNG_FILTER_NONE = 0
+_PNG_FILTER_SUB = 1
+_PNG_FILTER_UP = 2
+# Row filter, zlib level and zlib strategy for indexed_png() to try, cheapest
+# and most often best first. Dithered pixels rarely repeat, so filters seldom
+# help, but text and UI screens can gain from them.
+_PNG_TRIALS = [
+    (_PNG_FILTER_NONE, 6, zlib.Z_DEFAULT_STRATEGY),
+    (_PNG_FILTER_NONE, 9, zlib.Z_FILTERED),
+    (_PNG_FILTER_NONE, 9, zlib.Z_DEFAULT_STRATEGY),
+    (_PNG_FILTER_SUB, 9, zlib.Z_DEFAULT_STRATEGY),
+    (_PNG_FILTER_UP, 9, zlib.Z_DEFAULT_STRATEGY),
+]
+# Stop starting new trials after this long; the first always runs.
+_PNG_BUDGET_SECONDS = 0.25
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data)))
+
+def _png_filter(rows: list[bytes], filter_type: int) -> bytes:
+    """Scanlines, each prefixed with its filter type, ready to compress."""
+    filtered = []
+    previous = bytes(len(rows[0]))
+    for row in rows:
+        if filter_type == _PNG_FILTER_SUB:
+            # Sub-byte pixels count as one byte, per the specification.
+            row_data = bytes((a - b) & 0xFF
+                             for (a, b) in zip(row, b'\0' + row))
+        elif filter_type == _PNG_FILTER_UP:
+            row_data = bytes((a - b) & 0xFF for (a, b) in zip(row, previous))
+        else:
+            row_data = row
+        filtered.append(bytes((filter_type,)) + row_data)
+        previous = row
+    return b''.join(filtered)
+
+def indexed_png(image: Image.Image,
+                budget_seconds: float = _PNG_BUDGET_SECONDS) -> bytes:
+    """Encode a palette image as compactly as we can afford to.
+
+    PIL writes palette images at 8 bits per pixel unless told otherwise, and
+    with one fixed set of compression settings. This packs pixels as tightly
+    as the palette indices used allow (PNG has 1, 2, 4 or 8 bits, so the Inky's
+    seven or eight inks take 4), then tries _PNG_TRIALS in turn, keeping the
+    smallest, until budget_seconds runs out."""
+    if image.mode != 'P':
+        raise ValueError(f'indexed_png() needs a P image, not {image.mode}')
+    (_, highest) = image.getextrema()
+    colors = highest + 1
+    bits = next(bits for bits in (1, 2, 4, 8) if colors <= (1 << bits))
+    raw = image.tobytes('raw', 'P' if bits == 8 else f'P;{bits}')
+    stride = (image.width * bits + 7) // 8
+    rows = [raw[offset:offset + stride]
+            for offset in range(0, len(raw), stride)]
+    palette = (image.getpalette() or [])[:colors * 3]
+    palette += [0] * (colors * 3 - len(palette))
+
+    start = time.perf_counter()
+    filtered: dict[int, bytes] = {}
+    best: bytes|None = None
+    for (filter_type, level, strategy) in _PNG_TRIALS:
+        if best is not None and time.perf_counter() - start > budget_seconds:
+            break
+        if filter_type not in filtered:
+            filtered[filter_type] = _png_filter(rows, filter_type)
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9, strategy)
+        compressed = (compressor.compress(filtered[filter_type]) +
+                      compressor.flush())
+        if best is None or len(compressed) < len(best):
+            best = compressed
+    return (b'\x89PNG\r\n\x1a\n' +
+            _png_chunk(b'IHDR', struct.pack('>IIBBBBB', image.width,
+                                            image.height, bits, 3, 0, 0, 0)) +
+            _png_chunk(b'PLTE', bytes(palette)) +
+            _png_chunk(b'IDAT', best) +
+            _png_chunk(b'IEND', b''))
+
 def respond_png(image: Image.Image, dither = False) -> flask.Response:
     """Build a response from a PIL image by PNG-encoding it."""
     # If the image has been pre-dithered, this is potentially small enough to
     # not need to be buffered to flash---tens of kilobytes. There is no JPEG
     # version of this because it seems very unlikely you want lossy, truecolor,
     # photo-suitable compression for an in-memory image.
-    buf = io.BytesIO()
-    image.save(buf, format='PNG')
+    if image.mode == 'P':
+        body = indexed_png(image)
+    else:
+        buf = io.BytesIO()
+        image.save(buf, format='PNG')
+        body = buf.getvalue()
     # If we just give flask the BytesIO, it will stream it as chunked, which
     # the PaperThin client cannot handle.
-    response: flask.Response = flask.make_response(buf.getvalue())
+    response: flask.Response = flask.make_response(body)
     response.mimetype = 'image/png'
     if dither:
         response.headers['X-Dither'] = 'True'
     return response
 
-def respond_pri(image: Image.Image) -> flask.Response:
+def respond_pri(image: Image.Image, version: int = 2) -> flask.Response:
     """Build a response from a PIL image by PRI-encoding it."""
-    buf = picorle.encode(image)
+    buf = picorle.encode(image, version)
     response: flask.Response = flask.make_response(buf)
     response.mimetype = 'image/x.pico-rle'
     return response
@@ -246,10 +547,333 @@ def respond_file(directory: str, filename: str, dither: bool) -> flask.Response:
         response.headers['X-Dither'] = 'True'
     return response
 
-def encode_for_inky(image: Image.Image, request: flask.Request
-                    ) -> flask.Response:
+# Images the client can keep in its content cache, and replay on request.
+_CACHEABLE_MIMETYPES = ('image/x.pico-rle', 'image/png', 'image/jpeg')
+REPLAY_MIMETYPE = 'application/x.paperthin-cached'
+
+# What each display was last sent, for clients too old to tell us, keyed by
+# (hostname, width, height). This is per-process; the client's own
+# X-PaperThin-Showing header is what survives restarts.
+_last_sent: dict[tuple[str, int, int], str] = {}
+
+def content_hash(data: bytes, dither: bool) -> str:
+    """Short stable ID for a response body, as the client's cache knows it."""
+    digest = hashlib.sha256(data)
+    digest.update(b'D' if dither else b'-')
+    return digest.hexdigest()[:16]
+
+def _body(response: flask.Response) -> bytes:
+    # send_from_directory() responses stream from the file; read it in.
+    response.direct_passthrough = False
+    return response.get_data()
+
+def _tag_hash(response: flask.Response) -> str:
+    """Set (if needed) and return a response's X-Content-Hash."""
+    body_hash = response.headers.get('X-Content-Hash')
+    if body_hash is None:
+        body_hash = content_hash(_body(response),
+                                 response.headers.get('X-Dither') is not None)
+        response.headers['X-Content-Hash'] = body_hash
+    return body_hash
+
+def skip_unchanged(response: flask.Response, request: flask.Request
+                   ) -> flask.Response:
+    """Replace a response with an empty no-op if the display already shows it.
+
+    This saves the client the download, and more importantly the e-ink
+    refresh. The client reports its last-displayed hash in
+    X-PaperThin-Showing; for older clients that don't, fall back to what this
+    process last sent that hostname and display size. Anything else, such as
+    a browser, always gets the full response."""
+    if (request.user_agent.string != "PaperThin/1" or
+        response.status_code != 200 or not _body(response)):
+        return response
+    body_hash = _tag_hash(response)
+    showing = request.headers.get('X-PaperThin-Showing')
+    hostname = request.args.get('hostname')
+    if hostname is not None:
+        (w, h) = display_size(request)
+        key = (hostname, w, h)
+        if showing is None:
+            showing = _last_sent.get(key)
+        _last_sent[key] = body_hash
+    if showing != body_hash:
+        return response
+    unchanged: flask.Response = flask.make_response('', 200)
+    unchanged.mimetype = response.mimetype
+    unchanged.headers['X-Content-Hash'] = body_hash
+    return unchanged
+
+def offer_cached(response: flask.Response, request: flask.Request
+                 ) -> flask.Response:
+    """Tag an image response for the client's cache, or replace it with a
+    replay of the copy the client says it already has.
+
+    The client lists the hashes it holds in X-PaperThin-Cached; if this body
+    is one of them, it only needs the hash back, saving the transfer (and for
+    PRI, none of the decode work changes). Old clients don't send the header,
+    so they always get the full response."""
+    if (response.status_code != 200 or
+        response.mimetype not in _CACHEABLE_MIMETYPES or
+        not _body(response)):
+        return response
+    body_hash = _tag_hash(response)
+    held = request.headers.get('X-PaperThin-Cached', '')
+    if body_hash in (h.strip() for h in held.split(',')):
+        replay: flask.Response = flask.make_response(body_hash)
+        replay.mimetype = REPLAY_MIMETYPE
+        replay.headers['X-Content-Hash'] = body_hash
+        return replay
+    return response
+
+# Partial updates: a PRI of just the changed rectangle of a frame.
+PATCH_MIMETYPE = 'image/x.pico-rle-patch'
+# Only bother if the changed rectangle is at most this much of the frame.
+_PATCH_MAX_AREA = 0.5
+# Recently sent frames, by content hash, to diff new ones against.
+_MAX_FRAMES = 8
+_frames: collections.OrderedDict[str, Image.Image] = collections.OrderedDict()
+# What respond_dithered() found patch_box() to be, by (base hash, frame hash),
+# so that offer_patch() doesn't diff the same two frames again.
+_boxes: collections.OrderedDict[tuple[str, str],
+                                tuple[int, int, int, int]|None] = (
+    collections.OrderedDict())
+
+def remember_frame(response: flask.Response, image: Image.Image) -> None:
+    """Keep the exact image a PRI response encodes, for offer_patch()."""
+    body_hash = _tag_hash(response)
+    _frames[body_hash] = image
+    _frames.move_to_end(body_hash)
+    while len(_frames) > _MAX_FRAMES:
+        _frames.popitem(last=False)
+
+def _remember_box(base_hash: str, frame_hash: str,
+                  box: tuple[int, int, int, int]|None) -> None:
+    _boxes[(base_hash, frame_hash)] = box
+    _boxes.move_to_end((base_hash, frame_hash))
+    while len(_boxes) > _MAX_FRAMES:
+        _boxes.popitem(last=False)
+
+def patch_box(base: Image.Image, frame: Image.Image
+              ) -> tuple[int, int, int, int]|None:
+    """The rectangle offer_patch() would send to turn base into frame, or None
+    if nothing changed (skip_unchanged() should catch that) or too much."""
+    if (base.mode == 'P' and frame.mode == 'P' and
+        base.getpalette() == frame.getpalette()):
+        # The indices alone say what changed, without expanding both to RGB.
+        with ImageChops.difference(base, frame) as difference:
+            box = difference.getbbox()
+    else:
+        with base.convert('RGB') as base_rgb:
+            with frame.convert('RGB') as frame_rgb:
+                with ImageChops.difference(base_rgb, frame_rgb) as difference:
+                    box = difference.getbbox()
+    if box is None:
+        return None
+    (left, top, right, bottom) = box
+    if ((right - left) * (bottom - top) >
+        _PATCH_MAX_AREA * frame.width * frame.height):
+        return None
+    return box
+
+def offer_patch(response: flask.Response, request: flask.Request
+                ) -> flask.Response:
+    """Replace a full-frame PRI with just the rectangle that changed.
+
+    The client names the frame it can draw underneath in X-PaperThin-Base;
+    it's either still in its framebuffer, or in its content cache. If we
+    don't remember that frame (restarted, another worker, a pre-baked file),
+    or most of it has changed, the full frame goes out as usual."""
+    base_hash = request.headers.get('X-PaperThin-Base')
+    if (base_hash is None or response.status_code != 200 or
+        response.mimetype != 'image/x.pico-rle' or not _body(response)):
+        return response
+    base = _frames.get(base_hash)
+    frame_hash = _tag_hash(response)
+    frame = _frames.get(frame_hash)
+    if base is None or frame is None or base.size != frame.size:
+        return response
+    if (base_hash, frame_hash) in _boxes:
+        box = _boxes[(base_hash, frame_hash)]
+    else:
+        box = patch_box(base, frame)
+    if box is None:
+        return response
+    (left, top, _, _) = box
+    with frame.crop(box) as changed:
+        (pri, _) = encode_pri(changed, accepted_pri_versions(request))
+    patch: flask.Response = flask.make_response(pri)
+    patch.mimetype = PATCH_MIMETYPE
+    # This is the hash of the whole frame the client will end up showing.
+    patch.headers['X-Content-Hash'] = response.headers['X-Content-Hash']
+    patch.headers['X-Patch-Base'] = base_hash
+    patch.headers['X-Patch-Offset'] = f'{left},{top}'
+    return patch
+
+# A rough model of how long the client takes to fetch and draw a response, to
+# choose between formats with. picorle.DEVICE_COSTS_US covers drawing PRI;
+# these are the rest, in microseconds, in step with paperthin-emulator.py.
+CLIENT_COSTS_US = {
+    'wifi_byte': 1000000.0 / (100 * 1024),  # About 100KiB/s, in practice.
+    'flash_byte': 11.0,  # Writing a byte to the temporary file, and reading it.
+    'png_pixel': 5.0,  # PNGDEC is native, so this is per pixel.
+}
+# Larger bodies are buffered to flash; keep in step with paperthin_config.py.
+CLIENT_TEMPFILE_THRESHOLD = 32 * 1024
+
+def estimate_pri_seconds(pri: bytes,
+                         counts: dict[str, int]|None = None) -> float:
+    """Estimated client time to receive and draw a PRI, which it streams.
+
+    Pass the counts picorle.encode() gathered for it, if there are any, to
+    save walking the whole thing again with picorle.analyze()."""
+    if counts is None:
+        counts = picorle.analyze(pri)['image']
+    return (len(pri) * CLIENT_COSTS_US['wifi_byte'] / 1000000.0 +
+            picorle.estimate_device_seconds(counts))
+
+def fits_client_ram(body: bytes) -> bool:
+    """Whether the client can decode a PNG or JPEG body from RAM, rather than
+    buffering it to flash first."""
+    return len(body) <= CLIENT_TEMPFILE_THRESHOLD
+
+def estimate_png_seconds(png: bytes, size: tuple[int, int]) -> float:
+    """Estimated client time to receive and draw a PNG of this size."""
+    micros = len(png) * CLIENT_COSTS_US['wifi_byte']
+    if not fits_client_ram(png):
+        micros += len(png) * CLIENT_COSTS_US['flash_byte']
+    micros += size[0] * size[1] * CLIENT_COSTS_US['png_pixel']
+    return micros / 1000000.0
+
+def encode_pri(image: Image.Image, accepted: set[int]
+               ) -> tuple[bytes, dict[str, int]]:
+    """Encode an image in whichever of its pri_versions() the client should
+    draw soonest, with the counts picorle.encode() gathered for it.
+
+    PRI4 is PRI3 plus opcodes for rows like the one above, which text and UI
+    screens are full of. To make room for them its unspans are shorter,
+    though, so on dithered photos, where rows rarely match, it can come out
+    larger and slower than PRI3. When there's a choice, both are tried."""
+    tried = []
+    for version in pri_versions(image, accepted):
+        counts: dict[str, int] = {}
+        pri = picorle.encode(image, version, counts)
+        tried.append((estimate_pri_seconds(pri, counts), len(pri), pri,
+                      counts))
+    # Ties go to the smaller, then the earlier version.
+    (_, _, pri, counts) = min(tried, key=lambda entry: entry[0:2])
+    return (pri, counts)
+
+def encode_candidates(dithered: Image.Image, pri: bytes,
+                      counts: dict[str, int]|None = None
+                      ) -> dict[str, tuple[bytes, float]]:
+    """The formats a dithered image could be sent in, by mimetype, each with
+    its body and estimated client seconds; counts are as for
+    estimate_pri_seconds().
+
+    The PNG is exactly the dithered image, and its colors already PicoGraphics'
+    own, so the client draws it without X-Dither, posterizing. It is only
+    built if it could be sent: however small it compressed, the client still
+    decodes every pixel, so if the PRI is done sooner than that, it wins."""
+    pri_seconds = estimate_pri_seconds(pri, counts)
+    candidates = {'image/x.pico-rle': (pri, pri_seconds)}
+    if estimate_png_seconds(b'', dithered.size) < pri_seconds:
+        png = indexed_png(dithered)
+        candidates['image/png'] = (png,
+                                   estimate_png_seconds(png, dithered.size))
+    return candidates
+
+def encode_dithered(dithered: Image.Image, accepted: set[int]
+                    ) -> dict[str, tuple[bytes, float]]:
+    """The encode_candidates() for a dithered image, with its PRI from
+    encode_pri()."""
+    return encode_candidates(dithered, *encode_pri(dithered, accepted))
+
+def dither_and_encode(image: Image.Image, accepted: set[int]
+                      ) -> tuple[Image.Image, dict[str, tuple[bytes, float]]]:
+    """The CPU-heavy half of encode_for_inky(): dithered image and the
+    encode_candidates() for it.
+
+    This needs no request, so can run in another process."""
+    dithered = inky_dither(image)
+    return (dithered, encode_dithered(dithered, accepted))
+
+def _code_digest() -> str:
+    digest = hashlib.sha256()
+    for path in (__file__, picorle.__file__):
+        with open(path, 'rb') as code:
+            digest.update(code.read())
+    return digest.hexdigest()
+
+_CODE_DIGEST = _code_digest()
+
+def encoding_fingerprint() -> str:
+    """Short ID for everything dither_and_encode() depends on besides its
+    arguments, for keeping its results on disk: this code and picorle's, the
+    PIL and ImageMagick doing the dithering, and the palettes and cost tables,
+    which overlay.py may have changed."""
+    digest = hashlib.sha256(_CODE_DIGEST.encode('ascii'))
+    digest.update(repr((
+        PIL.__version__, wand.version.MAGICK_VERSION,
+        _PICOGRAPHICS_PALETTE, _INK_PALETTE, _PNG_TRIALS,
+        sorted(CLIENT_COSTS_US.items()), CLIENT_TEMPFILE_THRESHOLD,
+        sorted(picorle.DEVICE_COSTS_US.items()), picorle.CLIENT_READ_BLOCK,
+        picorle.CLIENT_PEN_CACHE_SIZE)).encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+def respond_dithered(dithered: Image.Image,
+                     candidates: dict[str, tuple[bytes, float]],
+                     request: flask.Request, thrifty = False
+                     ) -> flask.Response:
+    """The other half of encode_for_inky(), from dither_and_encode().
+
+    This sends whichever candidate the client should finish drawing soonest,
+    except that it keeps to PRI if offer_patch() will cut it down to just what
+    changed. If thrifty, as for a client low on battery, it estimates the
+    patch too, and only keeps to PRI if that makes it the soonest."""
+    seconds = {mimetype: estimate
+               for (mimetype, (_, estimate)) in candidates.items()}
+    base_hash = request.headers.get('X-PaperThin-Base', '')
+    base = _frames.get(base_hash)
+    box = None
+    if base is not None and base.size == dithered.size:
+        box = patch_box(base, dithered)
+    patchable = box is not None
+    if box is not None and thrifty:
+        # Drawing scales with area, near enough, and so does sending.
+        (left, top, right, bottom) = box
+        seconds['image/x.pico-rle'] *= ((right - left) * (bottom - top) /
+                                        (dithered.width * dithered.height))
+    if patchable and not thrifty:
+        mimetype = 'image/x.pico-rle'
+    else:
+        mimetype = min(seconds, key=seconds.__getitem__)
+    (w, h) = display_size(request)
+    png_fate = 'not worth building'
+    if 'image/png' in candidates:
+        (png, _) = candidates['image/png']
+        png_fate = 'fits in RAM' if fits_client_ram(png) else 'goes via flash'
+    logging.info('Sending %s%s to %s (%dx%d): %s; the PNG %s', mimetype,
+                 ' (to patch)' if patchable and mimetype != 'image/png'
+                 else '',
+                 request.args.get('hostname', request.remote_addr), w, h,
+                 ', '.join(f'{m} {len(candidates[m][0])} bytes '
+                           f'~{estimate:.2f}s'
+                           for (m, estimate) in seconds.items()),
+                 png_fate)
+    response: flask.Response = flask.make_response(candidates[mimetype][0])
+    response.mimetype = mimetype
+    # Either way, this is what the display will show, to patch from later.
+    remember_frame(response, dithered)
+    if base is not None and mimetype == 'image/x.pico-rle':
+        _remember_box(base_hash, _tag_hash(response), box)
+    return response
+
+def encode_for_inky(image: Image.Image, request: flask.Request,
+                    thrifty = False) -> flask.Response:
     if request.user_agent.string == "PaperThin/1":
-        return respond_pri(inky_dither(image))
+        return respond_dithered(*dither_and_encode(
+            image, accepted_pri_versions(request)), request, thrifty)
     else:
         # Add an inky_dither here (but keep PNG) to test in a browser.
         return respond_png(image)
@@ -3,32 +3,207 @@
 #
 # Note: this is *not* compatible with convertimg for Tufty, since that uses the
 # similar v1 file format without the header or truecolor support. It also
-# doesn't do any resizing or palletizing of the image for you.
+# doesn't do any resizing or palletizing of the image for you, except in
+# --batch mode, which fits and dithers a whole tree of images for the Inky
+# Frame as paperutils.encode_for_inky() does, so that the server can send them
+# with no per-request processing. Unlike encode_for_inky(), it always writes
+# the one --pri-version, rather than choosing PRI3 or PRI4 by what each client
+# accepts, or a PNG when that would be quicker for the client to draw.
 #
 # Copyright 2023 Philip Boulain.
 # Licensed under the EUPL-1.2-or-later.
 
 import argparse
+import concurrent.futures
+import json
 import sys
 import os
 import picorle
+import time
 from PIL import Image
 
-arg_parser = argparse.ArgumentParser(
-    description="Pico RLE Image encoder.",
-    epilog="Encodes any image PIL can read to PicoRLE, or decodes PicoRLE to "
-           "any image PIL can write (type determined by file extension).")
-arg_parser.add_argument("infile", help="File to read")
-arg_parser.add_argument("outfile", help="File to write, will be overwritten")
-arg_parser.add_argument("--decode", action="store_true",
-    help="Decode the input to the output, instead of encode")
-args = arg_parser.parse_args()
-
-if args.decode:
-    with open(args.infile, "rb") as prifile:
-        image = picorle.decode_stream(prifile)
-        image.save(args.outfile)
-else:
-    image = Image.open(args.infile)
-    with open(args.outfile, "wb") as prifile:
-        picorle.encode_stream(image, prifile)
+_MANIFEST_NAME = "manifest.json"
+
+def parse_size(size: str) -> tuple[int, int]:
+    try:
+        w, h = size.lower().split('x', 1)
+        return (int(w), int(h))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'"{size}" is not WIDTHxHEIGHT')
+
+def bake(source: str, dest: str, width: int, height: int, version: int
+         ) -> dict:
+    """Fit, dither and PRI-encode one image; return stats for the manifest."""
+    # Only batch mode needs these, and they drag in Flask and ImageMagick.
+    import paperutils
+    start = time.monotonic()
+    with Image.open(source) as im:
+        fitted = paperutils.load_and_fit_to(im, width, height)
+        if fitted.mode != 'RGB':
+            converted = fitted.convert('RGB')
+            fitted.close()
+            fitted = converted
+        dithered = paperutils.inky_dither(fitted)
+        fitted.close()
+    encoded = picorle.encode(dithered, version)
+    dithered.close()
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    temp_dest = dest + ".tmp"
+    with open(temp_dest, "wb") as prifile:
+        prifile.write(encoded)
+    os.replace(temp_dest, dest)
+    return {
+        "source": source,
+        "width": width,
+        "height": height,
+        "bytes": len(encoded),
+        "bytes_per_pixel": len(encoded) / (width * height),
+        "seconds": time.monotonic() - start,
+    }
+
+def batch(indir: str, outdir: str, sizes: list[tuple[int, int]],
+          jobs: int|None, force: bool, version: int) -> None:
+    """Bake every image under indir into PRI files under outdir."""
+    manifest_path = os.path.join(outdir, _MANIFEST_NAME)
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        manifest = {}
+
+    # Each size gets its own WIDTHxHEIGHT subtree, as app.choose_file() looks
+    # for, so baking SOURCES/a/... into responses/ serves the 800x480 PRIs
+    # from responses/800x480/a/... to 800x480 displays only.
+    work = []
+    skipped = 0
+    for root, _, filenames in os.walk(indir):
+        for filename in sorted(filenames):
+            if not filename.lower().endswith(("jpg", "jpeg", "png")):
+                continue
+            source = os.path.join(root, filename)
+            relative = os.path.splitext(os.path.relpath(source, indir))[0]
+            for (width, height) in sizes:
+                key = os.path.join(f"{width}x{height}", relative + ".pri")
+                dest = os.path.join(outdir, key)
+                if (not force and os.path.exists(dest) and
+                    os.stat(dest).st_mtime >= os.stat(source).st_mtime):
+                    skipped += 1
+                    continue
+                work.append((key, source, dest, width, height))
+
+    start = time.monotonic()
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(bake, source, dest, width, height, version):
+                   key for (key, source, dest, width, height) in work}
+        for future in concurrent.futures.as_completed(futures):
+            key = futures[future]
+            try:
+                manifest[key] = future.result()
+                print(f"{key}: {manifest[key]['bytes']} bytes")
+            except Exception as e:
+                failed += 1
+                print(f"{key}: FAILED: {e}", file=sys.stderr)
+    elapsed = time.monotonic() - start
+
+    os.makedirs(outdir, exist_ok=True)
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    baked = len(work) - failed
+    rate = (baked / elapsed) if elapsed > 0 else 0.0
+    print(f"{baked} baked, {skipped} up to date, {failed} failed, "
+          f"in {elapsed:.1f}s ({rate:.2f} images/s)")
+
+def print_analysis(analysis: dict, show_rows: bool) -> None:
+    """Human-readable summary of a picorle.analyze() report."""
+    image = analysis["image"]
+    kind = ("truecolor" if analysis["truecolor"]
+            else f"{analysis['palette_size']}-color palette")
+    print(f"PRI{analysis['version']} {analysis['width']}x{analysis['height']}, "
+          f"{kind}, {image['bytes']} bytes")
+    print(f"{image['spans']} spans ({image['span_pixels']} pixels), "
+          f"{image['unspans']} unspans ({image['unspan_pixels']} pixels)")
+    if image['copies']:
+        print(f"{image['copies']} copies from the row above "
+              f"({image['copy_pixels']} pixels)")
+    print(f"Client calls: {image['read']} reads, {image['set_pen']} set_pen, "
+          f"{image['create_pen']} create_pen, {image['pixel']} pixel, "
+          f"{image['pixel_span']} pixel_span")
+    print(f"Estimated device decode: {image['estimated_seconds']:.1f}s")
+    print("Run length histogram (length: spans):")
+    buckets: dict[str, int] = {}
+    for length, count in analysis["run_lengths"].items():
+        # Power-of-two buckets keep this readable.
+        low = 1 << (int(length).bit_length() - 1)
+        label = f"{low}-{(low * 2) - 1}" if low > 1 else "1"
+        buckets[label] = buckets.get(label, 0) + count
+    for label, count in buckets.items():
+        print(f"  {label:>7}: {count}")
+    rows = analysis["rows"]
+    if show_rows:
+        print("  row  spans unspans unspan_px  bytes  est_ms")
+        for y, row in enumerate(rows):
+            print(f"{y:5} {row['spans']:6} {row['unspans']:7} "
+                  f"{row['unspan_pixels']:9} {row['bytes']:6} "
+                  f"{row['estimated_seconds'] * 1000:7.1f}")
+    else:
+        slowest = sorted(range(len(rows)),
+                         key=lambda y: rows[y]["estimated_seconds"],
+                         reverse=True)[:5]
+        print("Slowest rows: " + ", ".join(
+            f"{y} ({rows[y]['estimated_seconds'] * 1000:.1f}ms)"
+            for y in slowest))
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Pico RLE Image encoder.",
+        epilog="Encodes any image PIL can read to PicoRLE, or decodes PicoRLE "
+               "to any image PIL can write (type determined by file "
+               "extension). With --batch, infile and outfile are directories. "
+               "With --analyze, outfile is optional, and gets a JSON report.")
+    arg_parser.add_argument("infile", help="File to read")
+    arg_parser.add_argument("outfile", nargs="?",
+        help="File to write, will be overwritten")
+    arg_parser.add_argument("--decode", action="store_true",
+        help="Decode the input to the output, instead of encode")
+    arg_parser.add_argument("--analyze", action="store_true",
+        help="Report on a PRI file's structure and estimated decode time")
+    arg_parser.add_argument("--rows", action="store_true",
+        help="With --analyze, print statistics for every row")
+    arg_parser.add_argument("--pri-version", type=int, choices=(2, 3, 4),
+        default=2,
+        help="PRI version to encode; 3 and 4 are smaller, but only for palette "
+             "images of up to 16 colors, and older PaperThin clients cannot "
+             "display them (default: %(default)s)")
+    arg_parser.add_argument("--batch", action="store_true",
+        help="Resize, dither and encode a directory tree, in parallel")
+    arg_parser.add_argument("--size", type=parse_size, action="append",
+        help="Batch display size as WIDTHxHEIGHT; repeatable (default 800x480)")
+    arg_parser.add_argument("--jobs", type=int, default=None,
+        help="Batch worker processes (default: one per core)")
+    arg_parser.add_argument("--force", action="store_true",
+        help="Batch re-encode even if outputs are up to date")
+    args = arg_parser.parse_args()
+    if args.outfile is None and not args.analyze:
+        arg_parser.error("outfile is required")
+
+    if args.analyze:
+        with open(args.infile, "rb") as prifile:
+            analysis = picorle.analyze_stream(prifile)
+        print_analysis(analysis, args.rows)
+        if args.outfile is not None:
+            with open(args.outfile, "w") as reportfile:
+                json.dump(analysis, reportfile, indent=1)
+    elif args.batch:
+        if args.decode:
+            arg_parser.error("--batch only encodes")
+        batch(args.infile, args.outfile, args.size or [(800, 480)],
+              args.jobs, args.force, args.pri_version)
+    elif args.decode:
+        with open(args.infile, "rb") as prifile:
+            image = picorle.decode_stream(prifile)
+            image.save(args.outfile)
+    else:
+        image = Image.open(args.infile)
+        with open(args.outfile, "wb") as prifile:
+            picorle.encode_stream(image, prifile, args.pri_version)
@@ -16,6 +16,32 @@
 # There is deliberately no header expansibility, alpha support, alternate
 # colorspace support, etc. Use a real image format like PNG if you need that.
 #
+# Version 3, for small palettes (such as dithered Inky images):
+#   "PRI3" literal header
+#   Width, height, palette size minus one and palette as version 2, except
+#     there is no truecolor, and the palette is at most 16 entries.
+#   Indices are 3 bits if the palette is at most 8 entries, else 4 bits.
+#   Then data is a sequence of spans and unspans, which never cross rows:
+#     A byte 0LLLIIII is a span of palette index I. L is the length minus one,
+#     except that 7 means the length is 8 plus a varint that follows.
+#     A byte 1NNNNNNN is an unspan of N pixels, except that 0 means 128 plus a
+#     varint that follows. Then come the pixels' indices, packed least
+#     significant bit first, padded up to a whole byte.
+#   Varints are little-endian groups of seven bits; the top bit of each byte is
+#   set if there is another byte to follow.
+#
+# Version 4 adds opcodes for rows like the one above, as in text and UI images:
+#   "PRI4" literal header, then as version 3, except that:
+#     A byte 10NNNNNN is an unspan of N pixels, except that 0 means 64 plus a
+#     varint that follows, and packed indices follow as in version 3.
+#     A byte 110NNNNN copies the next N pixels from the row above, except that
+#     0 means 32 plus a varint that follows.
+#     A byte 111NNNNN, only at the start of a row, repeats the row above N
+#     times (so covers N rows), except that 0 means 32 plus a varint.
+#
+# Clients that can decode these say so with "image/x.pico-rle; version=3" (or
+# 4) in their Accept header.
+#
 # Copyright 2023 Philip Boulain.
 # Licensed under the EUPL-1.2-or-later.
 
@@ -26,17 +52,47 @@
 # ...which is not fixed until 9.1.0. Make sure you're not on old Debian.
 
 import io
+import math
+import operator
 import typing
 from PIL import Image
 
-def encode(image: Image.Image) -> bytes:
+# Most palette entries PRI3 and PRI4 can index.
+SMALL_PALETTE_MAX = 16
+
+def encode(image: Image.Image, version: int = 2,
+           counts: typing.Optional[typing.Dict[str, int]] = None) -> bytes:
+    """Encode an image as PRI. If counts is given, it is filled in with the
+    totals analyze() would report for the result under 'image', so that
+    estimate_device_seconds() needs no second pass over it."""
     buf = io.BytesIO()
     writer = io.BufferedWriter(buf)  # Must stay alive until getvalue().
-    encode_stream(image, writer)
+    encode_stream(image, writer, version, counts)
     writer.flush()  # Else it silently truncates, which is nice.
-    return buf.getvalue()
+    encoded = buf.getvalue()
+    if counts is not None:
+        counts['bytes'] = len(encoded)
+        counts['read'] = math.ceil(len(encoded) / CLIENT_READ_BLOCK)
+    return encoded
 
-def encode_stream(image: Image.Image, out: io.BufferedWriter) -> None:
+def can_encode_small_palette(image: Image.Image) -> bool:
+    """True if the image has a small enough palette for version 3 or 4."""
+    return (image.mode == 'P' and
+            image.getextrema()[1] < SMALL_PALETTE_MAX)
+
+def encode_stream(image: Image.Image, out: io.BufferedWriter,
+                  version: int = 2,
+                  counts: typing.Optional[typing.Dict[str, int]] = None
+                  ) -> None:
+    """As encode(), but to a stream; counts then leaves out 'bytes' and
+    'read', which the stream's length gives."""
+    if counts is not None:
+        counts.update(_new_counts())
+    if version in (3, 4):
+        _encode_stream_small_palette(image, out, version, counts)
+        return
+    elif version != 2:
+        raise ValueError(f"Unsupported PRI version {version}")
     truecolor: bool
     if image.mode == 'P':
         truecolor = False
@@ -59,9 +115,12 @@ def encode_stream(image: Image.Image, out: io.BufferedWriter) -> None:
         palette_size = (len(pal) // 3) - 1
         out.write(palette_size.to_bytes(length=1, byteorder='little'))
         out.write(bytes(pal))  # List of ints, each <=255, allows this.
+        if counts is not None:
+            counts['create_pen'] += len(pal) // 3
 
     # Image data
     bytes_per_pixel = 3 if truecolor else 1
+    pens = _ClientPens(truecolor)
     for y in range(0, image.height):
         span_pixel = -1
         span_count = 0
@@ -73,14 +132,35 @@ def encode_stream(image: Image.Image, out: io.BufferedWriter) -> None:
                 # Simpler to just write this as a size-one span.
                 out.write(b'\x01')
                 out.write(unspan[0].to_bytes(length=bytes_per_pixel, byteorder='little'))
+                if counts is not None:
+                    count_span(unspan[0], 1)
             else:
                 # Write a zero, a size, and then the non-RLE'd pixels.
                 out.write(b'\x00')
                 out.write(len(unspan).to_bytes(length=1, byteorder='little'))
                 for p in unspan:
                     out.write(p.to_bytes(length=bytes_per_pixel, byteorder='little'))
+                if counts is not None:
+                    for p in unspan:
+                        pens.use(pen_key(p), counts)
+                    counts['unspans'] += 1
+                    counts['unspan_pixels'] += len(unspan)
+                    counts['pixel'] += len(unspan)
             unspan.clear()
 
+        def pen_key(pixel: int) -> int:
+            # Truecolor pixels are kept here as 0xBBGGRR, so written RGB.
+            if truecolor:
+                return (((pixel & 0xFF) << 16) | (pixel & 0xFF00) |
+                        (pixel >> 16))
+            return pixel
+
+        def count_span(pixel: int, length: int) -> None:
+            pens.use(pen_key(pixel), counts)
+            counts['spans'] += 1
+            counts['span_pixels'] += length
+            counts['pixel_span'] += 1
+
         def write_span():
             if span_count == 0:
                 write_unspan()  # Flush any unspan as well.
@@ -94,6 +174,8 @@ def encode_stream(image: Image.Image, out: io.BufferedWriter) -> None:
                 write_unspan()  # If we'd built one up.
                 out.write(span_count.to_bytes(length=1, byteorder='little'))
                 out.write(span_pixel.to_bytes(length=bytes_per_pixel, byteorder='little'))
+                if counts is not None:
+                    count_span(span_pixel, span_count)
 
         for x in range(0, image.width):
             pil_pixel = image.getpixel((x,y))
@@ -121,13 +203,278 @@ def encode_stream(image: Image.Image, out: io.BufferedWriter) -> None:
         # last column was a unique pixel.
         write_unspan()
 
+def _varint(value: int) -> bytes:
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def _read_varint(pri: io.BufferedReader) -> int:
+    value = 0
+    shift = 0
+    while True:
+        byte = pri.read(1)
+        if len(byte) != 1:
+            raise ValueError("File truncated")
+        value |= (byte[0] & 0x7F) << shift
+        if byte[0] < 0x80:
+            return value
+        shift += 7
+
+def _read_byte(pri: io.BufferedReader) -> int:
+    byte = pri.read(1)
+    if len(byte) != 1:
+        raise ValueError("File truncated")
+    return byte[0]
+
+def _small_palette(image: Image.Image) -> typing.List[int]:
+    if not can_encode_small_palette(image):
+        raise ValueError("PRI3 and PRI4 need a palette image with at most "
+                         f"{SMALL_PALETTE_MAX} colors in use")
+    # Older PIL pads palettes out to 256 entries; drop the unused tail.
+    used = image.getextrema()[1] + 1
+    return image.getpalette()[0:max(2, used) * 3]
+
+def _encode_stream_small_palette(image: Image.Image, out: io.BufferedWriter,
+                                 version: int,
+                                 counts: typing.Optional[typing.Dict[str, int]]
+                                 ) -> None:
+    pal = _small_palette(image)
+    bits = 3 if len(pal) <= 8 * 3 else 4
+    row_ops = (version >= 4)
+    unspan_field = 0x3F if row_ops else 0x7F
+    out.write(f"PRI{version}".encode())
+    out.write(image.width.to_bytes(length=2, byteorder='little'))
+    out.write(image.height.to_bytes(length=2, byteorder='little'))
+    out.write(((len(pal) // 3) - 1).to_bytes(length=1, byteorder='little'))
+    out.write(bytes(pal))
+    # The client's current pen, for counting the set_pen() calls it makes.
+    pen = -1
+    if counts is not None:
+        counts['create_pen'] += len(pal) // 3
+
+    def use_pens(pixels: bytes) -> int:
+        # As _ClientPens.use() per pixel; returns how many runs there were.
+        nonlocal pen
+        changes = sum(map(operator.ne, pixels[1:], pixels))
+        counts['set_pen'] += changes + (pixels[0] != pen)
+        pen = pixels[-1]
+        return changes + 1
+
+    def count_copy(pixels: bytes) -> None:
+        # The client redraws these a pixel_span() per run of the same color.
+        counts['copies'] += 1
+        counts['copy_pixels'] += len(pixels)
+        counts['pixel_span'] += use_pens(pixels)
+
+    def write_counted(opcode: int, field: int, count: int) -> None:
+        # Counts that don't fit in the opcode's field follow as a varint.
+        if count <= field:
+            out.write(bytes((opcode | count,)))
+        else:
+            out.write(bytes((opcode,)))
+            out.write(_varint(count - (field + 1)))
+
+    def write_span(index: int, length: int) -> None:
+        if length <= 7:
+            out.write(bytes(((length - 1) << 4 | index,)))
+        else:
+            out.write(bytes((0x70 | index,)))
+            out.write(_varint(length - 8))
+        if counts is not None:
+            nonlocal pen
+            if index != pen:
+                pen = index
+                counts['set_pen'] += 1
+            counts['spans'] += 1
+            counts['span_pixels'] += length
+            counts['pixel_span'] += 1
+
+    def write_unspan(pixels: bytearray) -> None:
+        if len(pixels) <= 2:
+            # A header byte and padding cost more than one or two spans.
+            for index in pixels:
+                write_span(index, 1)
+            return
+        write_counted(0x80, unspan_field, len(pixels))
+        packed = bytearray()
+        acc = 0
+        acc_bits = 0
+        for index in pixels:
+            acc |= index << acc_bits
+            acc_bits += bits
+            while acc_bits >= 8:
+                packed.append(acc & 0xFF)
+                acc >>= 8
+                acc_bits -= 8
+        if acc_bits > 0:
+            packed.append(acc)
+        out.write(packed)
+        if counts is not None:
+            use_pens(pixels)
+            counts['unspans'] += 1
+            counts['unspan_pixels'] += len(pixels)
+            counts['pixel'] += len(pixels)
+
+    data = image.tobytes()
+    width = image.width
+    above: typing.Optional[bytes] = None
+    above_hash = 0
+    y = 0
+    while y < image.height:
+        row = data[y * width:(y + 1) * width]
+        row_hash = hash(row)
+        if row_ops and row_hash == above_hash and row == above:
+            # Hashes find runs of identical rows without comparing each pair.
+            repeats = 1
+            while y + repeats < image.height:
+                following = data[(y + repeats) * width:
+                                 (y + repeats + 1) * width]
+                if hash(following) != row_hash or following != row:
+                    break
+                repeats += 1
+            write_counted(0xE0, 0x1F, repeats)
+            if counts is not None:
+                for _ in range(0, repeats):
+                    count_copy(row)
+            y += repeats
+            continue
+        # How many pixels from each x onward match the row above.
+        matching = [0] * (width + 1)
+        if row_ops and above is not None:
+            for x in range(width - 1, -1, -1):
+                if row[x] == above[x]:
+                    matching[x] = matching[x + 1] + 1
+        unspan = bytearray()
+        x = 0
+        while x < width:
+            index = row[x]
+            end = x + 1
+            while end < width and row[end] == index:
+                end += 1
+            length = end - x
+            if matching[x] >= 4 and matching[x] > length:
+                write_unspan(unspan)
+                unspan.clear()
+                write_counted(0xC0, 0x1F, matching[x])
+                if counts is not None:
+                    count_copy(row[x:x + matching[x]])
+                x += matching[x]
+            elif length == 1 or (length == 2 and len(unspan) > 0):
+                # Packed, a couple of pixels cost less than a span byte.
+                unspan += row[x:end]
+                x = end
+            else:
+                write_unspan(unspan)
+                unspan.clear()
+                write_span(index, length)
+                x = end
+        write_unspan(unspan)
+        above = row
+        above_hash = row_hash
+        y += 1
+
+def _small_palette_rows(pri: io.BufferedReader, width: int, height: int,
+                        version: int, bits: int
+                        ) -> typing.Iterator[typing.Tuple[
+                            bytes, typing.List[typing.Tuple[str, int, int,
+                                                            int]]]]:
+    """Parse PRI3/PRI4 image data, yielding each row's palette indices, and
+    the tokens that drew it as (kind, x, count, bytes). Kinds are 'span',
+    'unspan', 'copy' (from above) and 'repeat' (the whole row above)."""
+    row_ops = (version >= 4)
+    unspan_field = 0x3F if row_ops else 0x7F
+    mask = (1 << bits) - 1
+    above: typing.Optional[bytes] = None
+    y = 0
+    while y < height:
+        row = bytearray(width)
+        tokens: typing.List[typing.Tuple[str, int, int, int]] = []
+        repeats = 0
+        x = 0
+        while x < width:
+            start = pri.tell()
+            token = _read_byte(pri)
+            if row_ops and (token & 0xC0) == 0xC0:
+                count = token & 0x1F
+                if count == 0:
+                    count = 32 + _read_varint(pri)
+                if above is None:
+                    raise ValueError(f"No row above to copy at y={y}")
+                if token & 0x20:
+                    if x != 0 or y + count > height:
+                        raise ValueError(f"Bad row repeat at x={x}, y={y}")
+                    repeats = count
+                    tokens.append(('repeat', 0, width, pri.tell() - start))
+                    break
+                if x + count > width:
+                    raise ValueError(f"Row {y} overruns width")
+                row[x:x + count] = above[x:x + count]
+                tokens.append(('copy', x, count, pri.tell() - start))
+            elif token & 0x80:
+                count = token & unspan_field
+                if count == 0:
+                    count = unspan_field + 1 + _read_varint(pri)
+                packed_size = ((count * bits) + 7) // 8
+                packed = pri.read(packed_size)
+                if len(packed) != packed_size:
+                    raise ValueError(f"File truncated after x={x}, y={y}")
+                if x + count > width:
+                    raise ValueError(f"Row {y} overruns width")
+                indices = int.from_bytes(packed, byteorder='little')
+                for i in range(0, count):
+                    row[x + i] = (indices >> (i * bits)) & mask
+                tokens.append(('unspan', x, count, pri.tell() - start))
+            else:
+                count = (token >> 4) + 1
+                if count == 8:
+                    count += _read_varint(pri)
+                if x + count > width:
+                    raise ValueError(f"Row {y} overruns width")
+                row[x:x + count] = bytes((token & 0x0F,)) * count
+                tokens.append(('span', x, count, pri.tell() - start))
+            x += count
+        if repeats:
+            for _ in range(0, repeats):
+                yield above, tokens
+                # Only the first repeated row pays for the opcode.
+                tokens = [('repeat', 0, width, 0)]
+            y += repeats
+            continue
+        above = bytes(row)
+        yield above, tokens
+        y += 1
+
+def _decode_stream_small_palette(pri: io.BufferedReader, version: int
+                                 ) -> Image.Image:
+    width = int.from_bytes(pri.read(2), byteorder='little')
+    height = int.from_bytes(pri.read(2), byteorder='little')
+    palette_size = int.from_bytes(pri.read(1), byteorder='little') + 1
+    if palette_size > SMALL_PALETTE_MAX:
+        raise ValueError(f"Palette of {palette_size} is too large for "
+                         f"PRI{version}")
+    palette_data = pri.read(palette_size * 3)
+    if len(palette_data) != palette_size * 3:
+        raise ValueError("File truncated")
+    bits = 3 if palette_size <= 8 else 4
+    data = b"".join(row for (row, _) in _small_palette_rows(
+        pri, width, height, version, bits))
+    image = Image.frombytes('P', (width, height), data)
+    image.putpalette(palette_data)
+    return image
+
 def decode(pri: memoryview) -> Image.Image:
     # Convert our memoryview into a read stream.
     return decode_stream(io.BufferedReader(io.BytesIO(pri)))
 
 def decode_stream(pri: io.BufferedReader) -> Image.Image:
     # Header
-    if pri.read(4) != b"PRI2":
+    magic = pri.read(4)
+    if magic in (b"PRI3", b"PRI4"):
+        return _decode_stream_small_palette(pri, magic[3] - ord('0'))
+    if magic != b"PRI2":
         raise ValueError("Incorrect magic header")
     width = int.from_bytes(pri.read(2), byteorder='little')
     height = int.from_bytes(pri.read(2), byteorder='little')
@@ -188,3 +535,209 @@ def decode_stream(pri: io.BufferedReader) -> Image.Image:
                     count -= 1
 
     return image
+
+# Rough per-call costs, in microseconds, of what paperthin.py's picorle_decode()
+# does on the Inky Frame's RP2040 under MicroPython. These are ballpark figures
+# for comparing images against each other, not a promise; override them with
+# calibrated numbers if you have some.
+# The client reads the stream in blocks of this size (its _PRI_BUFFER_SIZE).
+CLIENT_READ_BLOCK = 2048
+# ...and caches truecolor pens in a direct-mapped table (its _PEN_CACHE_SIZE).
+CLIENT_PEN_CACHE_SIZE = 256
+DEVICE_COSTS_US = {
+    'read': 40.0,  # One socket readinto() call, plus...
+    'read_byte': 0.05,  # ...copying each byte it reads.
+    'create_pen': 6.0,
+    'set_pen': 4.0,
+    'pixel': 6.0,
+    'pixel_span': 8.0,  # Fixed cost of the call...
+    'span_pixel': 0.1,  # ...plus this per pixel it fills.
+    'span_loop': 15.0,  # Interpreter overhead per span/unspan decoded.
+    'unspan_loop': 6.0,  # Interpreter overhead per unspan pixel.
+    'copy_pixel': 0.5,  # Scanning the row above, per pixel copied (PRI4).
+}
+
+def _new_counts() -> typing.Dict[str, int]:
+    return {'spans': 0, 'unspans': 0, 'span_pixels': 0, 'unspan_pixels': 0,
+            'copies': 0, 'copy_pixels': 0, 'bytes': 0, 'read': 0,
+            'create_pen': 0, 'set_pen': 0, 'pixel': 0, 'pixel_span': 0}
+
+def estimate_device_seconds(counts: typing.Dict[str, int],
+                            costs: typing.Dict[str, float] = DEVICE_COSTS_US
+                            ) -> float:
+    """Estimate client decode time from analyze() call counts."""
+    micros = (counts['read'] * costs['read'] +
+              counts['bytes'] * costs['read_byte'] +
+              counts['create_pen'] * costs['create_pen'] +
+              counts['set_pen'] * costs['set_pen'] +
+              counts['pixel'] * costs['pixel'] +
+              counts['pixel_span'] * costs['pixel_span'] +
+              counts['span_pixels'] * costs['span_pixel'] +
+              (counts['spans'] + counts['unspans'] + counts['copies']) *
+              costs['span_loop'] +
+              counts['unspan_pixels'] * costs['unspan_loop'] +
+              counts['copy_pixels'] * (costs['span_pixel'] +
+                                       costs['copy_pixel']))
+    return micros / 1000000.0
+
+class _ClientPens:
+    """Mimics the client's pen cache and set_pen() skipping, to count calls."""
+    def __init__(self, truecolor: bool):
+        self.truecolor = truecolor
+        self.keys = [-1] * CLIENT_PEN_CACHE_SIZE
+        self.current = -1
+
+    def use(self, pixel: int, counts: typing.Dict[str, int]) -> None:
+        """Count the calls to set the pen to a palette index or 0xRRGGBB."""
+        if self.truecolor:
+            # Same hash as paperthin.py's picorle_decode(); keep them in step.
+            slot = ((pixel ^ (pixel >> 7) ^ (pixel >> 15)) &
+                    (CLIENT_PEN_CACHE_SIZE - 1))
+            if self.keys[slot] != pixel:
+                self.keys[slot] = pixel
+                counts['create_pen'] += 1
+        if pixel != self.current:
+            self.current = pixel
+            counts['set_pen'] += 1
+
+def analyze(pri: memoryview,
+            costs: typing.Dict[str, float] = DEVICE_COSTS_US
+            ) -> typing.Dict[str, typing.Any]:
+    return analyze_stream(io.BufferedReader(io.BytesIO(pri)), costs)
+
+def analyze_stream(pri: io.BufferedReader,
+                   costs: typing.Dict[str, float] = DEVICE_COSTS_US
+                   ) -> typing.Dict[str, typing.Any]:
+    """Walk a PRI stream without decoding it, and report on its structure.
+
+    As well as span statistics, this counts the socket reads and PicoGraphics
+    calls the PaperThin client's picorle_decode() makes for it, and uses those
+    to estimate how long the device will take to draw it. Totals are in the
+    'image' key, and there is a matching entry per row in 'rows'. Since the
+    client reads in blocks, a row's share of socket reads is fractional."""
+    # Header
+    magic = pri.read(4)
+    if magic not in (b"PRI2", b"PRI3", b"PRI4"):
+        raise ValueError("Incorrect magic header")
+    version = magic[3] - ord('0')
+    width = int.from_bytes(pri.read(2), byteorder='little')
+    height = int.from_bytes(pri.read(2), byteorder='little')
+    header_bytes = 9
+
+    # Palette
+    image = _new_counts()
+    palette_size = int.from_bytes(pri.read(1), byteorder='little')
+    truecolor = (palette_size == 0 and version == 2)
+    if not truecolor:
+        palette_size += 1
+        if len(pri.read(palette_size * 3)) != palette_size * 3:
+            raise ValueError("File truncated")
+        header_bytes += palette_size * 3
+        image['create_pen'] += palette_size
+    image['bytes'] += header_bytes
+    image['read'] = header_bytes / CLIENT_READ_BLOCK
+
+    # Image data
+    bytes_per_pixel = 3 if truecolor else 1
+    pens = _ClientPens(truecolor)
+    if version >= 3:
+        small_rows = _small_palette_rows(pri, width, height, version,
+                                         3 if palette_size <= 8 else 4)
+    run_lengths: typing.Dict[int, int] = {}
+    unspan_lengths: typing.Dict[int, int] = {}
+    rows: typing.List[typing.Dict[str, typing.Any]] = []
+    for y in range(0, height):
+        row = _new_counts()
+        x = 0
+        if version >= 3:
+            (indices, tokens) = next(small_rows)
+            for (kind, start, count, size) in tokens:
+                row['bytes'] += size
+                if kind == 'span':
+                    pens.use(indices[start], row)
+                    row['spans'] += 1
+                    row['span_pixels'] += count
+                    row['pixel_span'] += 1
+                    run_lengths[count] = run_lengths.get(count, 0) + 1
+                elif kind == 'unspan':
+                    for i in range(start, start + count):
+                        pens.use(indices[i], row)
+                    row['unspans'] += 1
+                    row['unspan_pixels'] += count
+                    row['pixel'] += count
+                    unspan_lengths[count] = unspan_lengths.get(count, 0) + 1
+                else:
+                    # The client redraws these from its copy of the row above,
+                    # a pixel_span() per run of the same color.
+                    row['copies'] += 1
+                    row['copy_pixels'] += count
+                    i = start
+                    while i < start + count:
+                        pens.use(indices[i], row)
+                        row['pixel_span'] += 1
+                        run_end = i + 1
+                        while (run_end < start + count and
+                               indices[run_end] == indices[i]):
+                            run_end += 1
+                        i = run_end
+            x = width
+        while x < width:
+            span_data = pri.read(2)
+            if len(span_data) != 2:
+                raise ValueError(f"File truncated after x={x}, y={y}")
+            count = span_data[0]
+            value = span_data[1]
+            if count == 0:
+                unspan_data = pri.read(value * bytes_per_pixel)
+                if len(unspan_data) != value * bytes_per_pixel:
+                    raise ValueError(f"File truncated after x={x}, y={y}")
+                for i in range(0, len(unspan_data), bytes_per_pixel):
+                    if truecolor:
+                        pens.use((unspan_data[i] << 16) |
+                                 (unspan_data[i+1] << 8) |
+                                 unspan_data[i+2], row)
+                    else:
+                        pens.use(unspan_data[i], row)
+                row['unspans'] += 1
+                row['unspan_pixels'] += value
+                row['bytes'] += 2 + (value * bytes_per_pixel)
+                row['pixel'] += value
+                unspan_lengths[value] = unspan_lengths.get(value, 0) + 1
+                x += value
+            else:
+                if truecolor:
+                    green_blue = pri.read(2)
+                    if len(green_blue) != 2:
+                        raise ValueError(f"File truncated after x={x}, y={y}")
+                    pens.use((value << 16) | (green_blue[0] << 8) |
+                             green_blue[1], row)
+                else:
+                    pens.use(value, row)
+                row['spans'] += 1
+                row['span_pixels'] += count
+                row['bytes'] += 1 + bytes_per_pixel
+                row['pixel_span'] += 1
+                run_lengths[count] = run_lengths.get(count, 0) + 1
+                x += count
+        if x != width:
+            raise ValueError(f"Row {y} overruns width ({x} > {width})")
+        row['read'] = row['bytes'] / CLIENT_READ_BLOCK
+        for key, value in row.items():
+            image[key] += value
+        row['estimated_seconds'] = estimate_device_seconds(row, costs)
+        rows.append(row)
+
+    image['read'] = math.ceil(image['read'])
+    image['estimated_seconds'] = estimate_device_seconds(image, costs)
+    return {
+        'version': version,
+        'width': width,
+        'height': height,
+        'truecolor': truecolor,
+        'palette_size': 0 if truecolor else palette_size,
+        'header_bytes': header_bytes,
+        'image': image,
+        'run_lengths': dict(sorted(run_lengths.items())),
+        'unspan_lengths': dict(sorted(unspan_lengths.items())),
+        'rows': rows,
+    }
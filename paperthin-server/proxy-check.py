@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# Check that slow clients can't tie up the server's workers behind the proxy.
+#
+# This starts the app as a single sync worker (one request at a time, like
+# one gunicorn sync worker; here the standard library's WSGI server), opens
+# --clients connections that ask for --path as PaperThin would and then read
+# it at --read-rate, and once they are all waiting or reading, times a
+# request to /hello. It does this twice: straight to the worker, where /hello
+# queues behind the slow clients, and through paperthin-proxy.py, where it
+# shouldn't.
+#
+# The check passes, exiting successfully, if through the proxy /hello was
+# answered within --limit seconds while every slow client was still reading.
+# The worker's socket send buffer is shrunk to --send-buffer so that, as with
+# a real picture over Wi-Fi, the response doesn't just vanish into the
+# kernel's buffers on localhost.
+#
+# Run it from the server directory, like the server, so it finds responses/.
+#
+# Copyright 2023 Philip Boulain.
+# Licensed under the EUPL-1.2-or-later.
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+_ACCEPT = "image/x.pico-rle; version=4, image/x.pico-rle; version=3"
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def worker(port: int, send_buffer: int) -> None:
+    """Serve the app one request at a time, until killed."""
+    import wsgiref.simple_server
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+
+    class Handler(wsgiref.simple_server.WSGIRequestHandler):
+        def setup(self) -> None:
+            self.request.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                    send_buffer)
+            super().setup()
+
+        def log_message(self, *args) -> None:
+            pass
+
+    wsgiref.simple_server.make_server(
+        "127.0.0.1", port, app.app, handler_class=Handler).serve_forever()
+
+def start(command: list[str], port: int) -> subprocess.Popen:
+    """Start a server process and wait for it to accept connections."""
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{command[1]} exited during startup")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"{command[1]} did not start listening")
+
+async def slow_client(port: int, path: str, hostname: str, read_rate: float,
+                      received: list[int], index: int) -> None:
+    """Request a picture, then read it no faster than read_rate."""
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2048)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", port))
+    reader, writer = await asyncio.open_connection(sock=sock, limit=1024)
+    writer.write((f"GET {path}?w=800&h=480&hostname={hostname} HTTP/1.0\r\n"
+                  f"Host: localhost\r\nUser-Agent: PaperThin/1\r\n"
+                  f"Accept: {_ACCEPT}\r\n\r\n").encode())
+    await writer.drain()
+    try:
+        while True:
+            data = await reader.read(1024)
+            if not data:
+                break
+            received[index] += len(data)
+            await asyncio.sleep(len(data) / read_rate)
+    finally:
+        writer.close()
+
+async def probe(port: int, timeout: float) -> float|None:
+    """Seconds for /hello to answer, or None if it didn't within timeout."""
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection("127.0.0.1", port), timeout)
+        writer.write(b"GET /hello HTTP/1.0\r\nHost: localhost\r\n\r\n")
+        await writer.drain()
+        status = await asyncio.wait_for(reader.readline(), timeout)
+        writer.close()
+    except (OSError, asyncio.TimeoutError):
+        return None
+    if not status.startswith(b"HTTP/"):
+        return None
+    return time.perf_counter() - start
+
+async def scenario(port: int, args: argparse.Namespace, name: str
+                   ) -> dict[str, object]:
+    received = [0] * args.clients
+    clients = [asyncio.create_task(slow_client(
+                   port, args.path, f"proxy-check-{name}-{i}-{os.getpid()}",
+                   args.read_rate, received, i))
+               for i in range(args.clients)]
+    # Long enough for the worker to render a picture or two.
+    await asyncio.sleep(args.settle)
+    seconds = await probe(port, args.timeout)
+    still_reading = sum(not client.done() for client in clients)
+    for client in clients:
+        client.cancel()
+    await asyncio.gather(*clients, return_exceptions=True)
+    return {"hello_seconds": seconds, "clients_still_reading": still_reading,
+            "bytes_received": received}
+
+def run(args: argparse.Namespace, proxied: bool) -> dict[str, object]:
+    here = os.path.dirname(os.path.abspath(__file__))
+    worker_port = free_port()
+    processes = [start([sys.executable, os.path.abspath(__file__),
+                        "--worker", str(worker_port),
+                        "--send-buffer", str(args.send_buffer)],
+                       worker_port)]
+    port = worker_port
+    try:
+        if proxied:
+            port = free_port()
+            processes.append(start(
+                [sys.executable, os.path.join(here, "paperthin-proxy.py"),
+                 "--bind", f"127.0.0.1:{port}",
+                 "--backend", f"127.0.0.1:{worker_port}"], port))
+        return asyncio.run(scenario(port, args,
+                                    "proxied" if proxied else "direct"))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description="Check that slow clients don't hold up a sync worker "
+                    "behind paperthin-proxy.py.")
+    arg_parser.add_argument("--path", default="/e",
+        help="Picture for the slow clients to request (default: %(default)s)")
+    arg_parser.add_argument("--clients", type=int, default=3,
+        help="Slow clients, each of which would hold the one worker "
+             "(default: %(default)s)")
+    arg_parser.add_argument("--read-rate", type=float, default=2048.0,
+        help="Bytes per second each slow client reads (default: %(default)s)")
+    arg_parser.add_argument("--send-buffer", type=int, default=4096,
+        help="Worker's socket send buffer in bytes (default: %(default)s)")
+    arg_parser.add_argument("--settle", type=float, default=5.0,
+        help="Seconds to let the slow clients start before timing /hello "
+             "(default: %(default)s)")
+    arg_parser.add_argument("--limit", type=float, default=2.0,
+        help="Most seconds /hello may take through the proxy "
+             "(default: %(default)s)")
+    arg_parser.add_argument("--timeout", type=float, default=30.0,
+        help="Seconds to give up waiting for /hello (default: %(default)s)")
+    arg_parser.add_argument("--json", action="store_true",
+        help="Print the results as JSON")
+    arg_parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+    if args.worker:
+        worker(args.worker, args.send_buffer)
+        return
+
+    results = {"direct": run(args, False), "proxied": run(args, True)}
+    proxied = results["proxied"]
+    passed = (proxied["hello_seconds"] is not None and
+              proxied["hello_seconds"] <= args.limit and
+              proxied["clients_still_reading"] == args.clients)
+    if args.json:
+        print(json.dumps({"passed": passed, **results}, indent=1))
+    else:
+        for (name, result) in results.items():
+            seconds = result["hello_seconds"]
+            answered = ("no answer" if seconds is None
+                        else f"answered in {seconds:.2f}s")
+            print(f"{name}: /hello {answered} with "
+                  f"{result['clients_still_reading']} of {args.clients} "
+                  f"slow clients still reading")
+        print("PASS" if passed else
+              f"FAIL: through the proxy, /hello should answer within "
+              f"{args.limit}s while all {args.clients} slow clients read")
+    sys.exit(0 if passed else 1)
+
+if __name__ == "__main__":
+    main()
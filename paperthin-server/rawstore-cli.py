@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# Pre-decode responses/ into the raw RGBX store (see rawstore.py).
+#
+# Run this from the server directory after adding images, e.g. from cron.
+# Sources are fitted to each display size exactly as the server would, and
+# are only reconverted if they are newer than their stored copy. Stored copies
+# whose sources have gone are removed.
+#
+# Copyright 2023 Philip Boulain.
+# Licensed under the EUPL-1.2-or-later.
+
+import argparse
+import os
+import paperutils
+import rawstore
+from PIL import Image
+
+def parse_size(size: str) -> tuple[int, int]:
+    try:
+        w, h = size.lower().split('x', 1)
+        return (int(w), int(h))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'"{size}" is not WIDTHxHEIGHT')
+
+arg_parser = argparse.ArgumentParser(
+    description="Pre-decode PaperThin response images to raw RGBX.",
+    epilog="Sources are responses/a to responses/e; only JPG and PNG files "
+           "are converted.")
+arg_parser.add_argument("--responses", default="responses",
+    help="Directory of per-button source folders (default: %(default)s)")
+arg_parser.add_argument("--store", default="predecoded",
+    help="Directory to write the store to (default: %(default)s)")
+arg_parser.add_argument("--size", type=parse_size, action="append",
+    help="Display size as WIDTHxHEIGHT; repeatable (default: all Inky Frames)")
+arg_parser.add_argument("--force", action="store_true",
+    help="Reconvert even if the stored copy is up to date")
+args = arg_parser.parse_args()
+sizes = args.size or rawstore.INKY_SIZES
+
+converted = 0
+skipped = 0
+removed = 0
+for button in "abcde":
+    directory = os.path.join(args.responses, button)
+    try:
+        filenames = [f for f in os.listdir(directory)
+                     if f.lower().endswith(('jpg', 'png'))]
+    except FileNotFoundError:
+        filenames = []
+    for (width, height) in sizes:
+        for filename in filenames:
+            source = os.path.join(directory, filename)
+            path = rawstore.path_for(args.store, button, filename,
+                                     width, height)
+            if (not args.force and os.path.exists(path) and
+                os.stat(path).st_mtime >= os.stat(source).st_mtime):
+                skipped += 1
+                continue
+            im = Image.open(source)
+            fitted = paperutils.load_and_fit_to(im, width, height)
+            rawstore.write(fitted, path)
+            fitted.close()
+            im.close()
+            converted += 1
+            print(f"{source} -> {path}")
+        # Tidy away anything whose source has gone.
+        stored_dir = os.path.dirname(
+            rawstore.path_for(args.store, button, "", width, height))
+        try:
+            stored = os.listdir(stored_dir)
+        except FileNotFoundError:
+            stored = []
+        for stored_name in stored:
+            if (stored_name.endswith(rawstore.EXTENSION) and
+                stored_name[:-len(rawstore.EXTENSION)] not in filenames):
+                os.remove(os.path.join(stored_dir, stored_name))
+                removed += 1
+
+print(f"{converted} converted, {skipped} up to date, {removed} removed.")
@@ -0,0 +1,97 @@
+# Pre-decoded, display-sized raw RGBX store for responses/.
+#
+# Decoding a JPEG or PNG and fitting it to the display is the same work every
+# time the same picture comes up, and each gunicorn worker ends up holding its
+# own decoded copy. Instead, rawstore-cli.py can convert every source once per
+# display size into a raw file, which the server then mmap()s and wraps with
+# Image.frombuffer(): no decompression, no copy, and all workers share the one
+# copy in the OS page cache.
+#
+# Pixels are stored as RGBX, not RGB, because that is PIL's own in-memory
+# layout for RGB; it will only map a buffer rather than unpack it into a copy
+# if the layout matches exactly. Converting the mapped RGBX image to RGB is
+# then a straight copy, not a decode.
+#
+# Format (all little-endian):
+#   "PRGX" literal header
+#   16-bit unsigned width, then height, of image
+#   Then width * height * 4 bytes of RGBX pixel data, row by row, where X is
+#   padding (written as 255).
+#
+# Store layout is <store>/<width>x<height>/<button letter>/<source filename>.rgb
+#
+# Copyright 2023 Philip Boulain.
+# Licensed under the EUPL-1.2-or-later.
+
+import mmap
+import os
+import tempfile
+import typing
+from PIL import Image
+
+MAGIC = b"PRGX"
+HEADER_SIZE = len(MAGIC) + 2 + 2
+EXTENSION = '.rgb'
+
+# Native resolutions of the Inky Frame 4.0", 5.7" and 7.3".
+INKY_SIZES = [(640, 400), (600, 448), (800, 480)]
+
+def path_for(store: str, button: str, filename: str, width: int, height: int
+             ) -> str:
+    return os.path.join(store, f'{width}x{height}', button,
+                        filename + EXTENSION)
+
+def write(image: Image.Image, path: str) -> None:
+    """Atomically write an image to path in raw RGBX format."""
+    if image.mode != 'RGBX':
+        image = image.convert('RGBX')
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(MAGIC)
+            out.write(image.width.to_bytes(length=2, byteorder='little'))
+            out.write(image.height.to_bytes(length=2, byteorder='little'))
+            out.write(image.tobytes())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+def open_mapped(path: str) -> Image.Image:
+    """Map a raw RGBX file into a read-only RGBX image without copying it.
+
+    The mapping lives as long as the image does. Writing to the image (e.g.
+    paste()) makes PIL take a private copy first, so this is safe to draw on,
+    it just loses the benefit. Most consumers (PNG encoding, quantize) want
+    RGB, so convert() it as late as you can."""
+    with open(path, 'rb') as raw:
+        mapped = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mapped) < HEADER_SIZE or mapped[0:4] != MAGIC:
+        mapped.close()
+        raise ValueError(f'{path} is not a raw RGBX store file')
+    width = int.from_bytes(mapped[4:6], byteorder='little')
+    height = int.from_bytes(mapped[6:8], byteorder='little')
+    if len(mapped) != HEADER_SIZE + (width * height * 4):
+        mapped.close()
+        raise ValueError(f'{path} is truncated')
+    # PIL keeps a reference to the buffer, which keeps the mapping alive.
+    return Image.frombuffer('RGBX', (width, height),
+                            memoryview(mapped)[HEADER_SIZE:],
+                            'raw', 'RGBX', 0, 1)
+
+def open_if_fresh(store: str, button: str, directory: str, filename: str,
+                  width: int, height: int) -> typing.Optional[Image.Image]:
+    """Open the stored version of a source, if present and not out of date."""
+    path = path_for(store, button, filename, width, height)
+    try:
+        if (os.stat(path).st_mtime <
+            os.stat(os.path.join(directory, filename)).st_mtime):
+            return None
+        return open_mapped(path)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,235 @@
+# On-disk cache of rendering work, shared by every worker and display size.
+#
+# A fleet with a mix of 4", 5.7" and 7.3" displays asks for the same source
+# pictures at three sizes, and each time a source comes up again, every worker
+# decodes it from scratch. This keeps two kinds of entry in one directory:
+#
+#   Working images: the decoded source, shrunk only as far as the largest
+#     Inky Frame (or the display asking, if larger) needs, in rawstore.py's
+#     raw RGBX format. These are memory-mapped, so all workers share one copy,
+#     and fitting one to any display size is just a resize of a few hundred
+#     thousand pixels rather than a JPEG or PNG decode.
+#   Renders: what encode_for_inky() made of a source fitted to a display size,
+#     the candidate bodies and their estimated client times, for when no
+#     overlay was drawn over it. The PNG candidate is exactly the dithered
+#     frame, so that is decoded from it again for offer_patch(); if there is
+#     no PNG candidate, a quickly compressed copy of the frame is kept instead.
+#
+# Entries are keyed by the source's path, size and modification time, so
+# editing or replacing a source just leaves the old entries to age out.
+# Renders are also keyed by paperutils.encoding_fingerprint(), so that a new
+# palette, cost table or version of the code doesn't serve renders made with
+# the old. Hits touch the entry's modification time. When an entry is added
+# and the store may be over its budget, the least recently used are removed
+# until it isn't. Writes are atomic renames, and a reader that loses a race
+# with eviction just misses, so workers need no other coordination.
+#
+# Layout is <store>/working/<key>.rgb for working images, and
+# <store>/<width>x<height>/<key>.<fingerprint>.v<PRI versions accepted>.render
+# for renders.
+#
+# Copyright 2023 Philip Boulain.
+# Licensed under the EUPL-1.2-or-later.
+
+import hashlib
+import io
+import json
+import math
+import os
+import paperutils
+import rawstore
+import tempfile
+from PIL import Image
+
+# Most bytes to keep on disk (and so, when in use, in the page cache).
+BUDGET_BYTES = 256 * 1024 * 1024
+RENDER_EXTENSION = '.render'
+# Stands in for a mimetype in a render's header, for the copy of the frame.
+_FRAME = 'frame'
+# Walking the whole store is slow once it's large, so evict() only runs when
+# this process's tally of it goes over budget, or after this many writes, as
+# the other workers will have been adding to it too.
+EVICT_EVERY_WRITES = 16
+# Per store, what evict() last left in it plus what was added since, and how
+# many writes that was.
+_tallies: dict[str, tuple[int, int]] = {}
+
+def source_key(path: str) -> str:
+    """Short ID for a source file as it is now."""
+    stat = os.stat(path)
+    digest = hashlib.sha256(os.path.abspath(path).encode('utf-8'))
+    digest.update(f':{stat.st_size}:{stat.st_mtime_ns}'.encode('ascii'))
+    return digest.hexdigest()[:24]
+
+def _touch(path: str) -> None:
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def _write_atomic(data: bytes, path: str) -> None:
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+def evict(store: str, budget: int = BUDGET_BYTES) -> None:
+    """Remove the least recently used entries until the store fits budget."""
+    entries = []
+    for (directory, _, filenames) in os.walk(store):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # Another worker got there first.
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for (_, size, _) in entries)
+    for (_, size, path) in sorted(entries):
+        if total <= budget:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+    _tallies[store] = (total, 0)
+
+def _added(store: str, size: int, budget: int = BUDGET_BYTES) -> None:
+    """Count an entry just written, and evict() if the store may be full."""
+    if store not in _tallies:
+        evict(store, budget)
+        return
+    (total, writes) = _tallies[store]
+    total += size
+    writes += 1
+    if total > budget or writes >= EVICT_EVERY_WRITES:
+        evict(store, budget)
+    else:
+        _tallies[store] = (total, writes)
+
+def working_size(width: int, height: int,
+                 sizes: list[tuple[int, int]]
+                 ) -> tuple[int, int]:
+    """Smallest size to keep a width x height source at, to fit it to all of
+    sizes without scaling up; never larger than the source."""
+    scale = 0.0
+    for (want_w, want_h) in sizes:
+        (fit_w, fit_h) = paperutils.fit_size(width, height, want_w, want_h)
+        scale = max(scale, fit_w / width, fit_h / height)
+    scale = min(1.0, scale)
+    return (min(width, math.ceil(width * scale)),
+            min(height, math.ceil(height * scale)))
+
+def _decode_working(path: str, want_w: int, want_h: int) -> Image.Image:
+    """Decode a source straight down to its working_size()."""
+    with Image.open(path) as image:
+        size = working_size(image.width, image.height,
+                            rawstore.INKY_SIZES + [(want_w, want_h)])
+        if image.format == 'JPEG':
+            image.draft('RGB', size)
+        image.load()
+        factor = min(image.width // size[0], image.height // size[1])
+        reduced = image
+        if factor >= 2 and image.mode in ('L', 'RGB', 'RGBA'):
+            reduced = image.reduce(factor)
+        working = reduced.convert('RGB')
+        if reduced is not image:
+            reduced.close()
+    if working.size != size:
+        resized = working.resize(size)
+        working.close()
+        working = resized
+    return working
+
+def load_fitted_to(store: str, path: str, want_w: int, want_h: int
+                   ) -> Image.Image:
+    """Load a source fitted to a display size, via its working image.
+
+    If the store has none, or it is too small for this display, the source is
+    decoded to a new one, which is kept for next time."""
+    key = source_key(path)
+    working_path = os.path.join(store, 'working', key + rawstore.EXTENSION)
+    working = None
+    try:
+        working = rawstore.open_mapped(working_path)
+        # Only the source's header is read, for how much this display needs.
+        with Image.open(path) as source:
+            needed = working_size(source.width, source.height,
+                                  [(want_w, want_h)])
+        if working.width < needed[0] or working.height < needed[1]:
+            working.close()
+            working = None
+        else:
+            _touch(working_path)
+    except (OSError, ValueError):
+        pass
+    if working is None:
+        working = _decode_working(path, want_w, want_h)
+        rawstore.write(working, working_path)
+        _added(store,
+               rawstore.HEADER_SIZE + working.width * working.height * 4)
+    fitted = paperutils.resize_image_to(working, want_w, want_h)
+    working.close()
+    if fitted.mode != 'RGB':
+        rgb = fitted.convert('RGB')
+        fitted.close()
+        fitted = rgb
+    return fitted
+
+def _render_path(store: str, path: str, want_w: int, want_h: int,
+                 accepted: set[int]) -> str:
+    # Only versions beyond 2 that paperutils.encode_pri() might pick matter.
+    versions = ''.join(str(v) for v in sorted(accepted & {3, 4}))
+    return os.path.join(store, f'{want_w}x{want_h}',
+                        f'{source_key(path)}.'
+                        f'{paperutils.encoding_fingerprint()}.'
+                        f'v{versions}{RENDER_EXTENSION}')
+
+def load_render(store: str, path: str, want_w: int, want_h: int,
+                accepted: set[int]
+                ) -> tuple[Image.Image, dict[str, tuple[bytes, float]]]|None:
+    """A dither_and_encode() result kept by save_render(), if there is one."""
+    try:
+        render_path = _render_path(store, path, want_w, want_h, accepted)
+        with open(render_path, 'rb') as render:
+            header = json.loads(render.readline())
+            candidates = {}
+            for (mimetype, length, seconds) in header:
+                body = render.read(length)
+                if len(body) != length:
+                    return None
+                candidates[mimetype] = (body, seconds)
+        (frame, _) = candidates.pop(_FRAME, None) or candidates['image/png']
+        dithered = Image.open(io.BytesIO(frame))
+        dithered.load()
+    except (OSError, ValueError, KeyError):
+        return None
+    _touch(render_path)
+    return (dithered, candidates)
+
+def save_render(store: str, path: str, want_w: int, want_h: int,
+                accepted: set[int], dithered: Image.Image,
+                candidates: dict[str, tuple[bytes, float]]
+                ) -> None:
+    """Keep a dither_and_encode() result of a source fitted to a display."""
+    entries = dict(candidates)
+    if 'image/png' not in entries:
+        frame = io.BytesIO()
+        dithered.save(frame, 'PNG', compress_level=1)
+        entries[_FRAME] = (frame.getvalue(), 0.0)
+    header = [(mimetype, len(body), seconds)
+              for (mimetype, (body, seconds)) in entries.items()]
+    data = (json.dumps(header).encode('utf-8') + b'\n' +
+            b''.join(body for (body, _) in entries.values()))
+    _write_atomic(data, _render_path(store, path, want_w, want_h, accepted))
+    _added(store, len(data))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# Measure how much memory a server worker needs at peak to answer a request.
+#
+# gunicorn's --max-requests is there because workers' memory grows; the less
+# each request needs at its peak, the higher that can go. For each path, this
+# answers one request to warm the app up, then forks and has the child answer
+# another, reporting how far the child's peak resident size rose above where
+# it started (which is what the operating system has to find, including the
+# pixels PIL and ImageMagick allocate in C) and tracemalloc's peak for the
+# Python objects alone (bytes such as blobs and encoded bodies).
+#
+# It exits unsuccessfully if any request's peak rises more than --budget
+# frames (full-size RGB images at the requested display size), so it can be
+# used as a check after changing the pipeline. Resident size includes any
+# pages of a predecoded/ mapping that are read, though those are shared.
+#
+# The default of four frames is what decoding a source somewhat bigger than
+# the display needs: both the decoded source and the display-sized result
+# exist at once. A 2400x1600 camera JPEG at 800x480 decodes at half scale, to
+# 2.5 frames, and stays within it; sources that decode much bigger than that
+# relative to the display, or that aren't JPEGs and can't be reduced by a
+# whole factor, may not.
+#
+# Run it from the server directory, like the server, so it finds responses/.
+#
+# Copyright 2023 Philip Boulain.
+# Licensed under the EUPL-1.2-or-later.
+
+import argparse
+import json
+import os
+import resource
+import sys
+import tracemalloc
+
+_ACCEPT = "image/x.pico-rle; version=4, image/x.pico-rle; version=3"
+
+def request(client, path: str, w: int, h: int, hostname: str) -> int:
+    """Make a PaperThin request; returns the body length."""
+    response = client.get(path, headers={
+        "User-Agent": "PaperThin/1", "Accept": _ACCEPT,
+    }, query_string={"w": w, "h": h, "hostname": hostname})
+    return len(response.get_data())
+
+def measure(client, path: str, w: int, h: int) -> dict[str, int]:
+    """Peak memory for one request, from a forked child."""
+    (read_end, write_end) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        # Kilobytes, on Linux; this includes what we inherited.
+        start_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        tracemalloc.start()
+        body = request(client, path, w, h, "request-memory")
+        (_, python_peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with os.fdopen(write_end, "w") as results:
+            results.write(json.dumps({
+                "body_bytes": body,
+                "rss_peak_bytes": (peak_kb - start_kb) * 1024,
+                "python_peak_bytes": python_peak,
+            }))
+        os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as results:
+        result = results.read()
+    (_, status) = os.waitpid(pid, 0)
+    if status != 0 or not result:
+        raise RuntimeError(f"Measuring {path} failed")
+    return json.loads(result)
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description="Measure a PaperThin server request's peak memory.")
+    arg_parser.add_argument("paths", nargs="*", default=["/a", "/b", "/c",
+                                                         "/d", "/e"],
+        help="Paths to request (default: the five buttons)")
+    arg_parser.add_argument("--w", type=int, default=800,
+        help="Display width to ask for (default: %(default)s)")
+    arg_parser.add_argument("--h", type=int, default=480,
+        help="Display height to ask for (default: %(default)s)")
+    arg_parser.add_argument("--budget", type=float, default=4.0,
+        help="Most full-size RGB frames a request may need at its peak "
+             "(default: %(default)s)")
+    arg_parser.add_argument("--json", action="store_true",
+        help="Print the results as JSON")
+    args = arg_parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    # A render cache hit would skip the very work being measured.
+    app._RENDER_CACHE_DIR = None
+    client = app.app.test_client()
+    frame_bytes = args.w * args.h * 3
+    results = {}
+    for path in args.paths:
+        # Anything done once per worker is not what we're measuring. That
+        # includes the C allocator settling: glibc only starts keeping blocks
+        # as big as a frame for reuse once it has freed one, so a worker's
+        # second request is the first like all the rest.
+        for _ in range(2):
+            request(client, path, args.w, args.h, "request-memory-warm-up")
+        results[path] = measure(client, path, args.w, args.h)
+        results[path]["frames"] = results[path]["rss_peak_bytes"] / frame_bytes
+    over = [path for path, result in results.items()
+            if result["frames"] > args.budget]
+
+    if args.json:
+        print(json.dumps(results, indent=1))
+    else:
+        print(f"Peak memory per request at {args.w}x{args.h}, where one RGB "
+              f"frame is {frame_bytes} bytes:")
+        for path, result in results.items():
+            print(f"  {path}: {result['rss_peak_bytes']} bytes resident "
+                  f"({result['frames']:.2f} frames), "
+                  f"{result['python_peak_bytes']} bytes of Python objects; "
+                  f"{result['body_bytes']} byte body")
+        if over:
+            print(f"Over the budget of {args.budget} frames: "
+                  + ", ".join(over))
+    sys.exit(1 if over else 0)
+
+if __name__ == "__main__":
+    main()
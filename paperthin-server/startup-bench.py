@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Time how long a fresh server worker takes to give its first response.
+#
+# gunicorn recycles workers every few requests (see --max-requests in the
+# README), so anything a worker sets up on its first request, rather than
+# inheriting, is paid over and over. Each run here is a fresh interpreter:
+#
+#   cold:      the worker imports app.py itself, then answers a request; this
+#              is every worker's startup without gunicorn --preload.
+#   preloaded: a parent imports app.py and forks, and only the child's first
+#              request is timed; this is a worker's startup with --preload.
+#
+# Both are run with and without app.py's warm-up, which --no-warm-up skips by
+# replacing paperutils.warm_up() (and the overlay's) before the import. The
+# second request's time is given too, as what a warm worker takes.
+#
+# Run it from the server directory, like the server, so it finds responses/.
+#
+# Copyright 2023 Philip Boulain.
+# Licensed under the EUPL-1.2-or-later.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+_ACCEPT = "image/x.pico-rle; version=4, image/x.pico-rle; version=3"
+
+def first_requests(path: str, w: int, h: int) -> list[float]:
+    """Seconds for the first and second requests to this process's app."""
+    import app
+    client = app.app.test_client()
+    times = []
+    for attempt in range(2):
+        start = time.perf_counter()
+        response = client.get(path, headers={
+            "User-Agent": "PaperThin/1", "Accept": _ACCEPT,
+        }, query_string={"w": w, "h": h,
+                         "hostname": f"startup-bench-{attempt}"})
+        response.get_data()
+        times.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} gave {response.status}")
+    return times
+
+def child(args: argparse.Namespace) -> None:
+    """One measurement, in this fresh interpreter; prints it as JSON."""
+    if args.no_warm_up:
+        import paperutils
+        paperutils.warm_up = lambda: None
+        try:
+            import overlay
+            if hasattr(overlay, 'warm_up'):
+                overlay.warm_up = lambda: None
+        except ModuleNotFoundError:
+            pass
+    start = time.perf_counter()
+    import app
+    imported = time.perf_counter() - start
+    # Earlier runs' renders would make every first request a cache hit.
+    app._RENDER_CACHE_DIR = None
+    if args.child == "cold":
+        (first, second) = first_requests(args.path, args.w, args.h)
+        print(json.dumps({"import": imported, "first": first,
+                          "second": second}))
+        return
+    (read_end, write_end) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        with os.fdopen(write_end, "w") as results:
+            results.write(json.dumps(first_requests(args.path, args.w,
+                                                    args.h)))
+        os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as results:
+        (first, second) = json.loads(results.read() or "[null, null]")
+    os.waitpid(pid, 0)
+    # The parent's import is paid once, not per worker.
+    print(json.dumps({"import": imported, "first": first, "second": second}))
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description="Time a fresh PaperThin server worker's first response.")
+    arg_parser.add_argument("--path", default="/a",
+        help="Path to request (default: %(default)s)")
+    arg_parser.add_argument("--w", type=int, default=800,
+        help="Display width to ask for (default: %(default)s)")
+    arg_parser.add_argument("--h", type=int, default=480,
+        help="Display height to ask for (default: %(default)s)")
+    arg_parser.add_argument("--runs", type=int, default=5,
+        help="Fresh interpreters per scenario; the median is shown "
+             "(default: %(default)s)")
+    arg_parser.add_argument("--json", action="store_true",
+        help="Print the results as JSON")
+    arg_parser.add_argument("--child", choices=("cold", "preloaded"),
+        help=argparse.SUPPRESS)
+    arg_parser.add_argument("--no-warm-up", action="store_true",
+        help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+    if args.child:
+        child(args)
+        return
+
+    results = {}
+    for mode in ("cold", "preloaded"):
+        for warm_up in (False, True):
+            command = [sys.executable, os.path.abspath(__file__),
+                       "--child", mode, "--path", args.path,
+                       "--w", str(args.w), "--h", str(args.h)]
+            if not warm_up:
+                command.append("--no-warm-up")
+            runs = [json.loads(subprocess.run(
+                        command, check=True, capture_output=True, text=True
+                    ).stdout.splitlines()[-1])
+                    for _ in range(args.runs)]
+            results[f"{mode}{'' if warm_up else ', no warm-up'}"] = {
+                key: statistics.median(run[key] for run in runs)
+                for key in ("import", "first", "second")}
+
+    if args.json:
+        print(json.dumps(results, indent=1))
+        return
+    print(f"Median of {args.runs} runs of {args.path}, in seconds:")
+    print(f"{'':24} {'import':>8} {'first':>8} {'second':>8}")
+    for name, times in results.items():
+        print(f"{name:24} {times['import']:8.3f} {times['first']:8.3f} "
+              f"{times['second']:8.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,9 @@
 # There *is* (currently) some LD+JSON buried at the bottom of the page that
 # might be nicer than HTML scraping, but it'd take HTML scraping to *find* it.
 
+import httpcache
 import logging
+import os
 import random
 import re
 import requests
@@ -21,8 +23,23 @@ _IMG_START_REGEX = re.compile(r'<img class="gallery__img')
 _ALT_REGEX = re.compile(r'alt="([^"]+)"')
 _SRC_REGEX = re.compile(r'src="([^"]+)"')
 _END_REGEX = re.compile(r'>')
+_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:124.0) Gecko/20100101 Firefox/124.0'
+# Relative to the server's working directory, like responses/.
+_CACHE_DIR = os.path.join('cache', 'wildlife')
+_CACHE_MAX_BYTES = 32 * 1024 * 1024
 
-def find_page_for_week(session: requests.Session) -> str|None:
+_cache: httpcache.HTTPCache|None = None
+
+def get_cache() -> httpcache.HTTPCache:
+    """The shared HTTP cache for scraping, created on first use."""
+    global _cache
+    if _cache is None:
+        session = requests.Session()
+        session.headers.update({'User-Agent': _USER_AGENT})
+        _cache = httpcache.HTTPCache(_CACHE_DIR, session, _CACHE_MAX_BYTES)
+    return _cache
+
+def find_page_for_week(session: httpcache.HTTPCache) -> str|None:
     """Find the gallery page URL for the most recent week."""
     try:
         response = session.get(_BASE_PAGE, stream=True)
@@ -41,7 +58,7 @@ def find_page_for_week(session: requests.Session) -> str|None:
     logging.error('Did not find URL for the week')
     return None
 
-def find_pictures_of_week(session: requests.Session, url: str|None
+def find_pictures_of_week(session: httpcache.HTTPCache, url: str|None
                           ) -> list[tuple[str, str]]:
     """Given a gallery page URL, return a list of [src, alt] for the images."""
     if not url:
@@ -99,8 +116,7 @@ def find_pictures_of_week(session: requests.Session, url: str|None
     return urls
 
 def wildlife() -> tuple[Image.Image|None, str]:
-    session = requests.Session()
-    session.headers.update({'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:124.0) Gecko/20100101 Firefox/124.0'})
+    session = get_cache()
     gallery_url = find_page_for_week(session)
     pictures = find_pictures_of_week(session, gallery_url)
     if not pictures:
@@ -113,12 +129,13 @@ def wildlife() -> tuple[Image.Image|None, str]:
     (src, alt) = pictures[0]
 
     try:
-        response = requests.get(src, headers={'Referer': gallery_url})
+        response = session.get(src, headers={'Referer': gallery_url})
         response.raise_for_status()
     except requests.exceptions.RequestException:
         logging.exception('Fetching picture failed')
         return None, ''
+    # Deliberately not load()ed yet; paperutils.load_and_fit() can decode it at
+    # a fraction of the size if it's a big JPEG.
     image = Image.open(BytesIO(response.content))
-    # Actually read the image data now, not later.
-    image.load()
+    logging.info(f'Wildlife HTTP cache: {session.stats}')
     return image, alt